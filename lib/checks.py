@@ -7,13 +7,174 @@ names or certain dimension names and for their values to conform to
 certain rules; positivity, within a certain range etc. As users may also
 want to create their own workflow rather than relying on some of the methods
 in pyshdom these checks are provided to help catch unexpected inputs.
+
+The checks which scan the values of variables can be expensive when repeatedly
+applied to large datasets with the same structure (e.g. during an optimization).
+Each time such a check passes, the 'schema' of the dataset (the names, dimensions,
+shapes and data types of its variables) is cached. Within the `trusted` context
+these checks are skipped for datasets whose schema has already been validated.
+The time spent in the checks is recorded and can be accessed using `timings`.
+The `trusted` context only applies to the thread that entered it, while the schema
+cache (bounded to SCHEMA_CACHE_SIZE schemas) and the timings are shared by all threads.
 """
 import typing
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
 
 import numpy as np
+import xarray as xr
 
 import pyshdom.exceptions
 
+#the maximum number of validated schemas that are remembered.
+SCHEMA_CACHE_SIZE = 1024
+
+#least recently used schemas are at the front.
+_VALIDATED_SCHEMAS = OrderedDict()
+_TIMINGS = OrderedDict()
+_LOCK = threading.Lock()
+#holds the per-thread `trusted` state and depth of nested checks.
+_LOCAL = threading.local()
+
+@contextmanager
+def trusted(enabled=True):
+    """
+    A context within which checks of values are skipped for datasets whose schema
+    (see `schema`) has already passed the same check.
+
+    The caller is responsible for ensuring that the values of the variables remain
+    valid, e.g. by bounding the state vector of an optimization. Checks of the
+    existence and dimensions of variables are always performed.
+
+    Parameters
+    ----------
+    enabled : bool
+        If False then all checks are performed as usual within the context.
+
+    Examples
+    --------
+    >>> with pyshdom.checks.trusted():
+    ...     optical_properties = pyshdom.medium.table_to_grid(microphysics, poly_table)
+    """
+    previous = is_trusted()
+    _LOCAL.trusted = enabled
+    try:
+        yield
+    finally:
+        _LOCAL.trusted = previous
+
+def is_trusted():
+    """Returns True if called within an enabled `trusted` context in this thread."""
+    return getattr(_LOCAL, 'trusted', False)
+
+def clear_schema_cache():
+    """Forgets all validated schemas so that every check is performed again."""
+    with _LOCK:
+        _VALIDATED_SCHEMAS.clear()
+
+def schema(dataset):
+    """
+    The names, dimensions, shapes and data types of all variables in `dataset`.
+
+    Parameters
+    ----------
+    dataset : xr.Dataset/ xr.DataArray
+        The dataset to describe.
+
+    Returns
+    -------
+    schema : Tuple
+        A hashable description of the structure of `dataset`.
+    """
+    if isinstance(dataset, xr.DataArray):
+        variables = dict(dataset.coords.variables)
+        variables[dataset.name] = dataset.variable
+    elif isinstance(dataset, xr.Dataset):
+        variables = dataset.variables
+    else:
+        return (type(dataset).__name__,)
+    return tuple(sorted((str(name), variable.dims, variable.shape, variable.dtype.str)
+                        for name, variable in variables.items()))
+
+def timings(reset=False):
+    """
+    The number of calls, the number of calls skipped (see `trusted`) and the total
+    time in seconds spent in each check since the last reset.
+
+    Time spent in checks called by other checks is only counted once.
+
+    Parameters
+    ----------
+    reset : bool
+        If True then the timings are reset after being returned.
+
+    Returns
+    -------
+    timings : OrderedDict
+        Keys are the names of the checks. Values are dictionaries with
+        'calls', 'skipped' and 'time' entries.
+    """
+    with _LOCK:
+        out = OrderedDict([(name, dict(timing)) for name, timing in _TIMINGS.items()])
+        if reset:
+            _TIMINGS.clear()
+    return out
+
+def _is_validated(key):
+    """Returns True if `key` has passed its check, marking it as recently used."""
+    with _LOCK:
+        if key in _VALIDATED_SCHEMAS:
+            _VALIDATED_SCHEMAS.move_to_end(key)
+            return True
+    return False
+
+def _add_validated(key):
+    """Remembers that `key` has passed its check, forgetting the least recently used."""
+    with _LOCK:
+        _VALIDATED_SCHEMAS[key] = None
+        _VALIDATED_SCHEMAS.move_to_end(key)
+        while len(_VALIDATED_SCHEMAS) > SCHEMA_CACHE_SIZE:
+            _VALIDATED_SCHEMAS.popitem(last=False)
+
+def _instrument(cacheable):
+    """
+    Decorates a check to record its timing and, if `cacheable`, to skip it
+    for previously validated schemas within the `trusted` context.
+    """
+    def decorator(check):
+        @functools.wraps(check)
+        def wrapper(dataset, *args, **kwargs):
+            depth = getattr(_LOCAL, 'depth', 0)
+            start = time.perf_counter()
+            skipped = False
+            _LOCAL.depth = depth + 1
+            try:
+                if cacheable:
+                    key = (check.__name__, schema(dataset), repr(args), repr(sorted(kwargs.items())))
+                    skipped = is_trusted() and _is_validated(key)
+                    if not skipped:
+                        check(dataset, *args, **kwargs)
+                        _add_validated(key)
+                else:
+                    check(dataset, *args, **kwargs)
+            finally:
+                _LOCAL.depth = depth
+                if depth == 0:
+                    elapsed = time.perf_counter() - start
+                    with _LOCK:
+                        timing = _TIMINGS.setdefault(check.__name__,
+                                                     {'calls': 0, 'skipped': 0, 'time': 0.0})
+                        timing['calls'] += 1
+                        timing['skipped'] += int(skipped)
+                        timing['time'] += elapsed
+        return wrapper
+    return decorator
+
+
+@_instrument(cacheable=False)
 def check_exists(dataset, *names):
     """Checks if certain Variables are present in a dataset.
 
@@ -35,6 +196,7 @@ def check_exists(dataset, *names):
         except KeyError as err:
             raise type(err)(str("Expected variable with name '{}' in dataset".format(name)))
 
+@_instrument(cacheable=True)
 def check_positivity(dataset, *names, precision=7):
     """
     Checks if certain variables are positive (>=0.0) up to a specified precision.
@@ -80,6 +242,7 @@ def check_positivity(dataset, *names, precision=7):
                     "Negative values found in '{}'".format(name)
                     )
 
+@_instrument(cacheable=True)
 def check_range(dataset, **checkkwargs):
     """
     Checks if variables within a dataset have values within a specified range.
@@ -109,6 +272,7 @@ def check_range(dataset, **checkkwargs):
                     low, high, name)
             )
 
+@_instrument(cacheable=False)
 def check_hasdim(dataset, **checkkwargs):
     """Checks if variables have specified dimensions.
 
@@ -140,6 +304,7 @@ def check_hasdim(dataset, **checkkwargs):
                         name, dim_name)
                     )
 
+@_instrument(cacheable=True)
 def check_grid(dataset):
     """
     Check if the dataset can act as a grid for SHDOM.
@@ -195,6 +360,7 @@ def check_grid(dataset):
             "have 2 or more elements."
             )
 
+@_instrument(cacheable=True)
 def check_legendre(dataset):
     """
     Check if the dataset contains a correctly formatted Legendre/Phase function
@@ -229,6 +395,7 @@ def check_legendre(dataset):
             "Asymmetry Parameter (1st Legendre coefficient divided by 3)"
             "is not in the range [-1.0, 1.0]")
 
+@_instrument(cacheable=True)
 def check_sensor(dataset):
     """
     Tests a dataset to make sure it has all of the requirements to be used as a sensor
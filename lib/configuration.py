@@ -1,11 +1,16 @@
 """
 Generates and saves/loads numerical parameters for SHDOM.
 json is used as it is human readable rather than netCDF.
+The memory parameters can also be tuned from previous solutions (see MemoryTuner).
 """
 
 import json
+from collections import OrderedDict
+import numpy as np
 import xarray as xr
 
+import pyshdom.solver
+
 def make_config(config_file_name, x_boundary_condition='open',
                 y_boundary_condition='open',
                 num_mu_bins=16, num_phi_bins=32,
@@ -128,3 +133,156 @@ def get_config(config_file_name):
         data_vars={key:attr['default_value'] for key, attr in configuration.items()}
     )
     return config_dataset
+
+class MemoryTuner:
+    """
+    Proposes memory parameters (adapt_grid_factor, num_sh_term_factor and
+    cell_to_point_ratio) for solver.RTE from the sizes actually used by
+    previous solutions.
+
+    The memory parameters set the allocated sizes of the grid and spherical harmonic
+    arrays (see solver.RTE.estimate_memory) but the sizes needed are only known
+    after a solution (solver.RTE.final_adapt_grid_factor etc.). Generous defaults
+    can over-allocate by gigabytes while tight values can run out of memory.
+    Observations of the final values are recorded from solutions of similar scenes
+    (e.g. previous iterations of a retrieval or other wavelengths), or from a cheap
+    solution at reduced angular resolution (MemoryTuner.pre_solve), and the largest
+    observed values multiplied by `safety_factor` are proposed.
+
+    Parameters
+    ----------
+    safety_factor : float
+        The factor by which to multiply the largest observed values.
+
+    Examples
+    --------
+    >>> tuner = pyshdom.configuration.MemoryTuner()
+    >>> tuner.record_solvers(solvers)
+    >>> config = tuner.propose(config)
+    """
+    def __init__(self, safety_factor=1.2):
+        if safety_factor < 1.0:
+            raise ValueError("`safety_factor` should be >= 1.0")
+        self.safety_factor = safety_factor
+        self._observations = OrderedDict()
+
+    def record(self, solver, key=None):
+        """
+        Records the memory parameters used by a solved solver.RTE.
+
+        Parameters
+        ----------
+        solver : pyshdom.solver.RTE
+            A solved solver.
+        key : Any
+            Identifies the type of scene (e.g. the wavelength). Observations
+            can be used for all keys or only for the same key (see MemoryTuner.propose).
+
+        Raises
+        ------
+        ValueError
+            If `solver` has not been solved.
+        """
+        if solver.final_adapt_grid_factor is None:
+            raise ValueError("`solver` has not been solved so its memory use is unknown.")
+        self._observations.setdefault(key, []).append(
+            (solver.final_adapt_grid_factor, solver.final_shterm_factor,
+             solver.final_cell_point_ratio)
+            )
+
+    def record_solvers(self, solvers):
+        """
+        Records the memory parameters of each solved solver in `solvers`
+        using its key.
+
+        Parameters
+        ----------
+        solvers : pyshdom.containers.SolversDict
+            The solvers to record.
+        """
+        for key, solver in solvers.items():
+            if solver.final_adapt_grid_factor is not None:
+                self.record(solver, key)
+
+    def pre_solve(self, solver, key=None, angular_reduction=2, maxiter=100):
+        """
+        Estimates the memory parameters of `solver` from a solution at reduced angular
+        resolution and records them.
+
+        The adaptive grid and spherical harmonic truncation depend on the angular
+        resolution so this is only approximate and the `safety_factor` should be
+        chosen accordingly.
+
+        Parameters
+        ----------
+        solver : pyshdom.solver.RTE
+            An (unsolved) solver. It is not modified.
+        key : Any
+            See MemoryTuner.record.
+        angular_reduction : int
+            The factor by which the numbers of zenith and azimuth bins are reduced.
+        maxiter : int
+            The maximum number of iterations of the reduced solution.
+
+        Returns
+        -------
+        reduced_solver : pyshdom.solver.RTE
+            The solved solver at reduced angular resolution.
+        """
+        numerical_params = solver.numerical_params.copy(deep=True)
+        numerical_params['num_mu_bins'] = max(2, int(numerical_params.num_mu_bins.data) //
+                                              angular_reduction)
+        numerical_params['num_phi_bins'] = max(1, int(numerical_params.num_phi_bins.data) //
+                                               angular_reduction)
+        reduced_solver = pyshdom.solver.RTE(
+            numerical_params=numerical_params,
+            medium=solver.medium,
+            source=solver.source,
+            surface=solver.surface,
+            num_stokes=solver._nstokes,
+            atmosphere=solver.atmosphere,
+            name=solver._name
+            )
+        reduced_solver.solve(maxiter=maxiter, verbose=False)
+        self.record(reduced_solver, key)
+        return reduced_solver
+
+    def propose(self, numerical_params, key=None, match_key=False):
+        """
+        Proposes memory parameters based on the recorded observations.
+
+        Parameters
+        ----------
+        numerical_params : xr.Dataset
+            The numerical parameters to modify (see configuration.get_config).
+        key : Any
+            Only used if `match_key` is True.
+        match_key : bool
+            If True only observations recorded with `key` are used, otherwise all
+            observations are used.
+
+        Returns
+        -------
+        tuned_params : xr.Dataset
+            A copy of `numerical_params` with updated 'adapt_grid_factor', 'num_sh_term_factor'
+            and 'cell_to_point_ratio'.
+
+        Raises
+        ------
+        KeyError
+            If there are no relevant observations.
+        """
+        if match_key:
+            observations = self._observations.get(key, [])
+        else:
+            observations = [observation for values in self._observations.values()
+                            for observation in values]
+        if not observations:
+            raise KeyError("No observations of memory parameters have been recorded.")
+        adapt_grid_factor, num_sh_term_factor, cell_to_point_ratio = \
+            self.safety_factor*np.max(np.array(observations), axis=0)
+        tuned_params = numerical_params.copy(deep=True)
+        tuned_params['adapt_grid_factor'] = max(1.0, float(adapt_grid_factor))
+        tuned_params['num_sh_term_factor'] = float(num_sh_term_factor)
+        tuned_params['cell_to_point_ratio'] = float(cell_to_point_ratio)
+        return tuned_params
@@ -3,7 +3,7 @@ This module defines containers for groups of RTE solvers and sensors
 and scattering tables to streamline retrievals or the generation of
 synthetic measurements in scripts.
 
-The three objects defined here are `SensorsDict`, `SolversDict` and
+The three main objects defined here are `SensorsDict`, `SolversDict` and
 `UnknownScatterers` and they are all wrappers around OrderedDict. Data
 are not stored as attributes meaning they can be modified without
 utilizing the additional 'add_X' methods.
@@ -18,11 +18,21 @@ The solver.RTE objects are stored in `SolversDict`. This object contains method
 for solving a set of solver.RTE objects in parallel or calling a couple of methods
 on all solvers in the `SolversDict.`
 
+`SolutionStore` saves the solutions of solver.RTE objects to memory-mapped files
+so that they can be shared between rendering processes. `SolutionCache` is a
+size-bounded store of solutions keyed by the inputs of the solver.RTE objects
+which `SolversDict.parallel_solve` uses to avoid re-solving identical media.
+
 `UnknownScatterers` is only utilized during the optimization and it stores the
 data and methods for calculating the partial derivatives of optical properties
 with respect to the unknowns.
 """
 
+import os
+import hashlib
+import pickle
+import struct
+import zlib
 from collections import OrderedDict
 from joblib import Parallel, delayed
 
@@ -46,6 +56,14 @@ class SensorsDict(OrderedDict):
     list of sensors and an accompanying uncertainty model.
 
     """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        #the latest output of SensorsDict.sort_sensors for each `measurements` (or None)
+        #and the arrays it was computed from (see SensorsDict._sort_cache_key).
+        self._sort_cache = OrderedDict()
+        #flat index arrays for each sensor mapping (see SensorsDict._flat_mapping).
+        self._mapping_cache = OrderedDict()
+
     def add_sensor(self, instrument, sensor):
         """
         Adds a sensor Dataset to a given instrument's sensor list.
@@ -113,7 +131,7 @@ class SensorsDict(OrderedDict):
 
     def get_measurements(self, solvers, n_jobs=1, mpi_comm=None, maxiter=100, verbose=True,
                          init_solution=True, setup_grid=True, destructive=False,
-                         overwrite_solver=False):
+                         overwrite_solver=False, backend='threading', balance_rays=False):
         """
         Calculates the observables specified in the sensors in self using
         RTE solvers.
@@ -153,6 +171,17 @@ class SensorsDict(OrderedDict):
             by RTE.load_solution or use a 1D two-stream model.
         verbose: boolean
             True will output solution iteration information into stdout.
+        backend : str
+            The joblib backend used to solve the RTE when `n_jobs` > 1.
+            See SolversDict.parallel_solve. Rendering is always multi-threaded as
+            the rendering routines release the GIL. With the 'threading' backend the
+            solutions are scheduled longest-first and rendering of the solved solvers
+            overlaps with the remaining solutions (see pyshdom.parallel.solve_and_render).
+        balance_rays : bool
+            If True then the multi-threaded rendering is divided into jobs of similar
+            estimated cost rather than similar numbers of rays. The costs are
+            estimated from the optical paths through the solvers of the previous call
+            (see SolversDict.record_ray_costs) so the first call is divided by the number of rays.
         """
         if not isinstance(solvers, SolversDict):
             raise TypeError(
@@ -163,25 +192,22 @@ class SensorsDict(OrderedDict):
             raise TypeError("`destructive` should be a boolean.")
 
         rte_sensors, sensor_mappings = self.sort_sensors(solvers)
-        keys, to_solve = solvers.to_solve(overwrite_solver)
 
         if mpi_comm is not None:
             out = []
             keys = []
-            for i in range(0, len(to_solve), mpi_comm.Get_size()):
-                index = i + mpi_comm.Get_rank()
-                if index < len(to_solve):
-                    key = keys[index]
-                    to_solve[index].solve(
+            for key, solver in solvers.owned_by_rank(mpi_comm).items():
+                if overwrite_solver or not solver.check_solved(verbose=False):
+                    solver.solve(
                         maxiter=maxiter, verbose=verbose, init_solution=init_solution,
                         setup_grid=setup_grid)
-                    out.append(solvers[key].integrate_to_sensor(rte_sensors[key]))
-                    keys.append(key)
-                    if destructive:
-                        # memory management. After rendering, the large arrays are
-                        # released to ensure that the largest
-                        # max_total_mb is not exceeded.
-                        solvers[key]._release_big_arrays()
+                out.append(solver.integrate_to_sensor(rte_sensors[key]))
+                keys.append(key)
+                if destructive:
+                    # memory management. After rendering, the large arrays are
+                    # released to ensure that the largest
+                    # max_total_mb is not exceeded.
+                    solver._release_big_arrays()
 
             out = mpi_comm.gather(out, root=0)
             keys = mpi_comm.gather(keys, root=0)
@@ -191,10 +217,24 @@ class SensorsDict(OrderedDict):
                 organized_out = [out_flat[keys_flat.index(key)] for key in solvers]
                 self.add_measurements_forward(sensor_mappings, organized_out, list(solvers))
 
+        elif n_jobs > 1 and backend == 'threading':
+            #solutions are scheduled longest first and rendering of solved
+            #solvers overlaps with the remaining solutions.
+            solve_keys, _ = solvers.to_solve(overwrite_solver)
+            keys, out = pyshdom.parallel.solve_and_render(
+                solvers, rte_sensors, n_jobs, list(solve_keys),
+                solve_kwargs={'maxiter': maxiter, 'verbose': verbose,
+                              'init_solution': init_solution, 'setup_grid': setup_grid},
+                ray_costs=solvers.ray_costs(rte_sensors) if balance_rays else None)
+            self.add_measurements_forward(sensor_mappings, out, keys)
+            if balance_rays:
+                solvers.record_ray_costs(rte_sensors, n_jobs=n_jobs)
+
         else:
             solvers.parallel_solve(n_jobs=n_jobs, mpi_comm=mpi_comm, maxiter=maxiter,
                                    verbose=verbose, init_solution=init_solution,
-                                   setup_grid=setup_grid, overwrite_solver=overwrite_solver)
+                                   setup_grid=setup_grid, overwrite_solver=overwrite_solver,
+                                   backend=backend)
             if n_jobs == 1 or n_jobs >= self.npixels:
                 out = [solvers[key].integrate_to_sensor(rte_sensors[key]) for key in solvers]
                 keys = list(solvers)
@@ -203,7 +243,8 @@ class SensorsDict(OrderedDict):
                 #Note that the number of n_jobs here doesn't have to be the number of workers but can instead
                 #be the number of subdivided job. This could be modified to ensure that all jobs are the correct size.
                 #as is, this will make slightly more tasks than there are workers (n_jobs).
-                keys, ray_start_end, pixel_start_end = pyshdom.parallel.subdivide_raytrace_jobs(rte_sensors, n_jobs)
+                keys, ray_start_end, pixel_start_end = pyshdom.parallel.subdivide_raytrace_jobs(
+                    rte_sensors, n_jobs, ray_costs=solvers.ray_costs(rte_sensors) if balance_rays else None)
 
                 out = Parallel(n_jobs=n_jobs, backend='threading')(
                     delayed(solvers[key].integrate_to_sensor)(rte_sensors[key].sel(
@@ -212,6 +253,8 @@ class SensorsDict(OrderedDict):
                     zip(keys, ray_start_end, pixel_start_end))
 
             self.add_measurements_forward(sensor_mappings, out, keys)
+            if balance_rays:
+                solvers.record_ray_costs(rte_sensors, n_jobs=n_jobs)
 
     def sort_sensors(self, solvers, measurements=None):
         """Groups sensors by RTE solver for evaluation of observables.
@@ -248,6 +291,17 @@ class SensorsDict(OrderedDict):
         TypeError
             If `solvers` is not pyshdom.containers.SolversDict or `measurements` is
             not None or pyshdom.containers.SensorsDict.
+
+        Notes
+        -----
+        The output is cached (separately for each `measurements`, including None) and
+        returned again without being recomputed, e.g. between iterations of an optimization.
+        The cache is invalidated when the solver keys or the number of Stokes components
+        change, when a variable of the sensors in `self` is replaced (e.g.
+        sensor['ray_x'] = ...) or when the values of the measured Stokes components or
+        uncertainties of `measurements` change. In-place edits of the ray variables
+        of the sensors in `self` (e.g. sensor.ray_x.data[:] = ...) are NOT detected, call
+        SensorsDict.clear_sort_cache after such edits.
         """
         if not isinstance(solvers, SolversDict):
             raise TypeError("`solvers` should be of type '{}' not '{}'".format(SolversDict, type(solvers)))
@@ -255,6 +309,13 @@ class SensorsDict(OrderedDict):
             if not isinstance(measurements, SensorsDict):
                 raise TypeError("`measurements` should be of type '{}' not '{}'".format(SensorsDict, type(measurements)))
 
+        cache_key, references = self._sort_cache_key(solvers, measurements)
+        slot = None if measurements is None else id(measurements)
+        cached = self._sort_cache.get(slot)
+        if cached is not None and cached[0] == cache_key:
+            self._sort_cache.move_to_end(slot)
+            return cached[2], cached[3]
+
         rte_sensors = OrderedDict()
         sensor_mappings = OrderedDict()
 
@@ -288,15 +349,15 @@ class SensorsDict(OrderedDict):
                 warnings.warn("No sensors found matching solver with key '{}'".format(key))
             else:
                 for var in var_list:
-                    concatenated = xr.concat([sensor[var] for sensor in sensor_list], dim='nrays')
-                    output[var] = ('nrays', concatenated)
+                    output[var] = ('nrays', np.concatenate([sensor[var].data
+                                                            for sensor in sensor_list]))
 
                 output['stokes'] = xr.concat([sensor.stokes for sensor in sensor_list], dim='nimage')
                 output['rays_per_image'] = ('nimage', np.array([sensor.sizes['nrays']
                                                                 for sensor in sensor_list]))
-                output['rays_per_pixel'] = ('npixels', np.concatenate([np.unique(sensor.pixel_index,
-                                                                                 return_counts=True)[1]
-                                                                       for sensor in sensor_list]))
+                output['rays_per_pixel'] = ('npixels', np.concatenate([
+                    np.bincount(sensor.pixel_index.data, minlength=sensor.sizes['npixels'])
+                    for sensor in sensor_list]))
 
                 if measurements is not None:
 
@@ -331,8 +392,201 @@ class SensorsDict(OrderedDict):
             rte_sensors[key] = merged_sensors
             sensor_mappings[key] = mapping_list
 
+        #`measurements` is kept alive so that its identity (the slot) is not reused.
+        self._sort_cache[slot] = (cache_key, references + [measurements], rte_sensors,
+                                  sensor_mappings)
+        self._sort_cache.move_to_end(slot)
+        while len(self._sort_cache) > self._SORT_CACHE_SIZE:
+            self._sort_cache.popitem(last=False)
         return rte_sensors, sensor_mappings
 
+    def clear_sort_cache(self):
+        """
+        Forgets the cached output of SensorsDict.sort_sensors, e.g. after the
+        ray variables of the sensors have been modified in place.
+        """
+        self._sort_cache.clear()
+        self._mapping_cache.clear()
+
+    #the number of different `measurements` for which the output of sort_sensors is cached.
+    _SORT_CACHE_SIZE = 4
+
+    def _sort_cache_key(self, solvers, measurements):
+        """
+        The key that identifies the inputs of SensorsDict.sort_sensors.
+
+        The key is formed from the solver keys (and their number of Stokes components
+        if `measurements` are given), the identities of the variables of the sensors
+        in `self` that are used and checksums of the values of the (per-pixel)
+        variables of `measurements`.
+        Replacing a variable of the sensors therefore invalidates the cache but
+        modifying its values in place does not, while any change to the
+        measurements does. The variables are also returned so that they are kept
+        alive (and their identities are not reused) while they are cached.
+
+        Returns
+        -------
+        key : Tuple
+            The cache key.
+        references : List
+            The arrays whose identities are in the key.
+        """
+        references = []
+        names = ('wavelength', 'stokes', 'ray_x', 'ray_y', 'ray_z', 'ray_mu', 'ray_phi',
+                 'ray_weight', 'pixel_index')
+        for instrument in self.values():
+            for sensor in instrument['sensor_list']:
+                references.extend([sensor.variables[name].data for name in names])
+        checksums = []
+        if measurements is None:
+            #the solvers may be placeholders (e.g. None) as only their keys are used.
+            solver_key = tuple(solvers.keys())
+        else:
+            solver_key = tuple([(key, solver._nstokes) for key, solver in solvers.items()])
+            for instrument in measurements.values():
+                for sensor in instrument['sensor_list']:
+                    for name in ('wavelength', 'stokes', 'uncertainties', 'I', 'Q', 'U', 'V'):
+                        if name in sensor.variables:
+                            array = np.ascontiguousarray(sensor.variables[name].data)
+                            checksums.append((name, array.shape, array.dtype.str,
+                                              zlib.crc32(array)))
+        key = (solver_key, tuple([id(array) for array in references]), tuple(checksums))
+        return key, references
+
+    def sample_sensors(self, rte_sensors, sensor_mappings, fraction, sampling='pixels',
+                       rng=None):
+        """
+        Randomly samples a subset of the pixels of the output of SensorsDict.sort_sensors
+        for a stochastic (mini-batch) evaluation of the cost function and its gradient.
+
+        For each solver key, a `fraction` of the pixels (or of the sensors) is sampled
+        uniformly without replacement. The inverse error-covariance of the sampled
+        pixels is multiplied by the ratio of the number of pixels (or sensors) to the
+        number sampled so that the cost function and its gradient evaluated with the
+        sampled sensors are unbiased estimates of those evaluated with all of them.
+
+        Parameters
+        ----------
+        rte_sensors : OrderedDict
+            The merged sensors from SensorsDict.sort_sensors which should have been
+            called with `measurements`.
+        sensor_mappings : OrderedDict
+            The mapping from SensorsDict.sort_sensors.
+        fraction : float
+            The fraction of the pixels (or sensors) of each key to sample, in (0, 1].
+            At least one is always sampled.
+        sampling : str
+            'pixels' to sample individual pixels or 'sensors' to sample whole sensors
+            (e.g. views).
+        rng : np.random.Generator
+            The random number generator to sample with. If None, a new (unseeded)
+            generator is used.
+
+        Returns
+        -------
+        sampled_sensors : OrderedDict
+            The sampled subsets of `rte_sensors` (with the same keys) which can be used
+            in place of `rte_sensors` in the gradient calculation
+            (see pyshdom.parallel.parallel_gradient).
+
+        Raises
+        ------
+        ValueError
+            If `fraction` or `sampling` are not valid or `rte_sensors` have no uncertainties.
+        """
+        if not 0.0 < fraction <= 1.0:
+            raise ValueError("`fraction` should be in (0, 1] not '{}'".format(fraction))
+        if sampling not in ('pixels', 'sensors'):
+            raise ValueError("`sampling` should be 'pixels' or 'sensors' not '{}'".format(sampling))
+        if rng is None:
+            rng = np.random.default_rng()
+
+        sampled_sensors = OrderedDict()
+        for key, rte_sensor in rte_sensors.items():
+            if 'uncertainties' not in rte_sensor:
+                raise ValueError(
+                    "`rte_sensors` should be sorted with `measurements` to be sampled.")
+            image_offsets = self._flat_mapping(sensor_mappings[key])['pixel_offsets']
+            if sampling == 'pixels':
+                offsets = np.arange(rte_sensor.sizes['npixels'] + 1)
+            else:
+                offsets = image_offsets
+            nsamples = offsets.size - 1
+            nchosen = max(int(round(fraction*nsamples)), 1)
+            chosen = np.sort(rng.choice(nsamples, size=nchosen, replace=False))
+            pixels = self._concatenate_ranges(offsets[chosen], offsets[chosen + 1])
+
+            rays_per_pixel = rte_sensor.rays_per_pixel.data
+            ray_offsets = np.cumsum(np.append(0, rays_per_pixel))
+            rays = self._concatenate_ranges(ray_offsets[pixels], ray_offsets[pixels + 1])
+            sampled = rte_sensor.isel(npixels=pixels, nrays=rays)
+            #the rays are renumbered by their sampled pixel so that the sampled sensor can be
+            #subdivided like any other (see pyshdom.parallel.subdivide_raytrace_jobs).
+            sampled['pixel_index'] = ('nrays', np.repeat(np.arange(pixels.size),
+                                                         rays_per_pixel[pixels]))
+            images = np.searchsorted(image_offsets, pixels, side='right') - 1
+            sampled['rays_per_image'] = ('nimage', np.bincount(
+                images, weights=rays_per_pixel[pixels],
+                minlength=image_offsets.size - 1).astype(rte_sensor.rays_per_image.dtype))
+            sampled['uncertainties'] = sampled.uncertainties*(nsamples/nchosen)
+            sampled_sensors[key] = sampled
+        return sampled_sensors
+
+    @staticmethod
+    def _concatenate_ranges(starts, ends):
+        """
+        The concatenation of np.arange(start, end) for each of `starts` and `ends`.
+        """
+        lengths = ends - starts
+        shifts = starts - np.cumsum(np.append(0, lengths[:-1]))
+        return np.repeat(shifts, lengths) + np.arange(np.sum(lengths))
+
+    def _flat_mapping(self, mapping):
+        """
+        The flat index arrays that map the rays and pixels of the sensors in `mapping`
+        (an entry of the sensor_mappings from SensorsDict.sort_sensors) back to the sensors.
+
+        These are cached until the ray variables of the sensors are replaced.
+
+        Returns
+        -------
+        flat : OrderedDict
+            'sensors' : the sensors in `mapping`.
+            'pixel_offsets' : the start of the pixels of each sensor (and the total number
+            of pixels) in the concatenated pixels.
+            'ray_pixel' : the index of the pixel in the concatenated pixels of each ray.
+            'ray_weight' : the weight of each ray.
+            'arrays' : the ray variables the mapping was computed from.
+        """
+        sensors = [self[instrument]['sensor_list'][index] for instrument, index in mapping]
+        arrays = [(sensor.variables['pixel_index'].data, sensor.variables['ray_weight'].data)
+                  for sensor in sensors]
+        cache_key = tuple(mapping)
+        flat = self._mapping_cache.get(cache_key)
+        if flat is not None and len(flat['arrays']) == len(arrays) and \
+            all([old[0] is new[0] and old[1] is new[1] for old, new in zip(flat['arrays'], arrays)]):
+            return flat
+        pixel_offsets = np.cumsum([0] + [sensor.sizes['npixels'] for sensor in sensors])
+        flat = OrderedDict()
+        flat['sensors'] = sensors
+        flat['pixel_offsets'] = pixel_offsets
+        flat['ray_pixel'] = np.concatenate([pixel_index + offset for (pixel_index, _), offset
+                                            in zip(arrays, pixel_offsets[:-1])])
+        flat['ray_weight'] = np.concatenate([ray_weight for _, ray_weight in arrays])
+        flat['arrays'] = arrays
+        self._mapping_cache[cache_key] = flat
+        return flat
+
+    @staticmethod
+    def _group_by_key(sensor_mappings, measurements, measurement_keys):
+        """
+        Groups the output of a (possibly parallel) rendering by solver key.
+        """
+        grouped = OrderedDict([(key, []) for key in sensor_mappings])
+        for key, measurement in zip(measurement_keys, measurements):
+            grouped.setdefault(key, []).append(measurement)
+        return grouped
+
     def get_unique_solvers(self):
         """
         Finds the set of unique wavelengths among all sensors.
@@ -467,57 +721,27 @@ class SensorsDict(OrderedDict):
         while ray quantities are output by input to self.add_measurements_forward.
         See sensor.py for the difference between ray and pixel variables.
         """
-
-        for key in sensor_mappings:
-            #group output from different (possibly parallel) workers by
-            #unique solver key (sensor_mappings.keys() == solvers.keys()).
-            #if not parallel then measurement_keys == solvers.keys().
-            indices = np.where(key == np.array(measurement_keys))[0]
-            measurements_by_key = [measurements[i] for i in indices]
-
-            variable_list_nray = [str(name) for name in measurements_by_key[0].data_vars
-                                  if str(name) not in ('rays_per_image', 'stokes',
-                                                       'rays_per_pixel', 'uncertainties',
-                                                       'measurement_data', 'stokes_weights',
-                                                       'I', 'Q', 'U', 'V')
-                                  ]
-            variable_list_npixel = [str(name) for name in measurements_by_key[0].data_vars
-                                    if str(name) in ('rays_per_pixel', 'uncertainties',
-                                                     'measurement_data', 'stokes_weights',
-                                                     'I', 'Q', 'U', 'V')
-                                    ]
-            merged = {}
-            for name in variable_list_nray:
-                merged[name] = xr.concat([data[name] for data in measurements_by_key], dim='nrays')
-            #process pixel variables for inverse problem.
-            merged_pixel_variables = {}
-            for name in variable_list_npixel:
-                merged_pixel_variables[name] = xr.concat([data[name]
-                                                          for data in measurements_by_key],
-                                                         dim='npixels')
-            merged.update(merged_pixel_variables)
-            merged['stokes'] = measurements_by_key[0].stokes
-            merged['rays_per_image'] = measurements_by_key[0].rays_per_image
-            merged_measurements = xr.Dataset(merged)
-
-            pixel_inds = np.cumsum(np.concatenate([np.array([0]),
-                                                   merged_measurements.rays_per_pixel.data
-                                                   ])).astype(np.int)
-            pixels_per_image = [np.where(pixel_inds == ray_image)[0][0]
-                                for ray_image in merged_measurements.rays_per_image.data]
-
-            count = 0
-            for i in range(merged_measurements.sizes['nimage']):
-                split_index = pixels_per_image[i]
-                sensor_measurements = merged_measurements.sel({
-                    'npixels': slice(count, count+split_index),
-                    'nimage':i})
-                forward_sensor = self[sensor_mappings[key][i][0]]['sensor_list'][sensor_mappings[key][i][1]]
-                for stokes in forward_sensor.stokes_index:
-                    if forward_sensor['stokes'].sel({'stokes_index':stokes}):
-                        forward_sensor[str(stokes.data)] = sensor_measurements[str(stokes.data)]
-                count += split_index
-
+        grouped = self._group_by_key(sensor_mappings, measurements, measurement_keys)
+        for key, mapping in sensor_mappings.items():
+            #the pixels of the (possibly parallel) output are in the order of the
+            #concatenated pixels of the sensors in `mapping`.
+            measurements_by_key = grouped[key]
+            if not measurements_by_key:
+                continue
+            flat = self._flat_mapping(mapping)
+            pixel_offsets = flat['pixel_offsets']
+            stokes_names = [name for name in ('I', 'Q', 'U', 'V')
+                            if name in measurements_by_key[0].data_vars]
+            pixel_values = {}
+            for name in stokes_names:
+                pixel_values[name] = np.concatenate([data[name].data
+                                                     for data in measurements_by_key])
+
+            for i, sensor in enumerate(flat['sensors']):
+                start, end = pixel_offsets[i], pixel_offsets[i+1]
+                for stokes, use_stokes in zip(sensor.stokes_index.data, sensor.stokes.data):
+                    if use_stokes and str(stokes) in pixel_values:
+                        sensor[str(stokes)] = ('npixels', pixel_values[str(stokes)][start:end])
 
     def add_measurements_forward(self, sensor_mappings, measurements, measurement_keys):
         """Takes the output of a (possibly parallel) rendering of synthetic measurements
@@ -540,94 +764,68 @@ class SensorsDict(OrderedDict):
 
         Notes
         -----
-        Calls self._calculate_observables to evaluate the pixel-averaged observables.
+        Calls self._calculate_observables to evaluate the pixel-averaged observables
+        of all sensors of each solver at once.
         See also SensorsDict.add_measurements_inverse and sensor.py for definition
         of ray and pixel quantities.
         """
-        for key in sensor_mappings:
-            #group output from different (possibly parallel) workers by unique solver key (sensor_mappings.keys() == solvers.keys()).
-            #if not parallel then measurement_keys == solvers.keys().
-            indices = np.where(key == np.array(measurement_keys))[0]
-            measurements_by_key = [measurements[i] for i in indices]
-
-            #Separately treat inverse and forward problem as inverse has different variables
-            #and pixel variables have already been created.
-            variable_list_nray = [str(name) for name in measurements_by_key[0].data_vars
-                                  if str(name) not in ('rays_per_image',
-                                                       'stokes',
-                                                       'rays_per_pixel')
-                                  ]
-            merged = {}
-            for name in variable_list_nray:
-                merged[name] = xr.concat([data[name]
-                                          for data in measurements_by_key],
-                                         dim='nrays')
-            merged['stokes'] = measurements_by_key[0].stokes
-            merged['rays_per_image'] = measurements_by_key[0].rays_per_image
-            merged_measurements = xr.Dataset(merged)
-
-            #split merged_measurements back into a list of individual images.
-            #update each stored sensor with observables from each image. Use sensor mappings for this.
-            count = 0
-            for i in range(merged_measurements.sizes['nimage']):
-                split_index = merged_measurements.rays_per_image[i].data
-                sensor_measurements = merged_measurements.sel({
-                    'nrays': slice(count, count+split_index),
-                    'nimage':i})
-                #calculate observables.
-                self._calculate_observables(sensor_mappings[key][i], sensor_measurements)
-                count += split_index
+        grouped = self._group_by_key(sensor_mappings, measurements, measurement_keys)
+        for key, mapping in sensor_mappings.items():
+            #the rays of the (possibly parallel) output are in the order of the
+            #concatenated rays of the sensors in `mapping`.
+            if grouped[key]:
+                self._calculate_observables(mapping, grouped[key])
 
     def _calculate_observables(self, mapping, rendered_rays):
         """
         Calculates the observables (pixel averaged Stokes components)
-        required by the sensor using the ray Stokes variables output
+        required by the sensors using the ray Stokes variables output
         from pyshdom.solver.RTE.integrate_to_sensor.
 
         Parameters
         ----------
-        mapping : Tuple
-            First component is the instrument key in `self` and
-            second component is the index of the sensor in that
-            instrument's sensor_list.
-        rendered_rays : xr.Dataset
-            Contains the ray variables including Stokes components
-            calculated by pyshdom.solver.RTE.integrate_to_sensor.
+        mapping : List
+            The instrument key in `self` and the index of the sensor
+            in that instrument's sensor_list for each of the concatenated
+            sensors that were rendered.
+        rendered_rays : List
+            xr.Datasets containing the ray variables including Stokes components
+            calculated by pyshdom.solver.RTE.integrate_to_sensor. The rays are
+            in the order of the concatenated rays of the sensors in `mapping`.
 
         Notes
         -----
         Calls pyshdom.core.average_subpixel_rays to do the averaging.
-        See src/util.f90.
+        See src/util.f90. The weighted ray Stokes components are gathered into a
+        buffer which is reused between calls (see SensorsDict._flat_mapping).
         """
-        sensor = self[mapping[0]]['sensor_list'][mapping[1]]
-        if not sensor.use_subpixel_rays:
-            merge_list = []
-        else:
-            merge_list = [sensor.pixel_index]
-        for stokes in sensor.stokes_index:
-            if rendered_rays['stokes'].sel({'stokes_index':stokes}):
-                weighted_stokes = (sensor.ray_weight*rendered_rays[str(stokes.data)])
-                weighted_stokes.name = '{}'.format(str(stokes.data))
-                merge_list.append(weighted_stokes)
-
-        merged = xr.merge(merge_list)
-
-        if not sensor.use_subpixel_rays:
-            for stokes in merged.data_vars:
-                sensor[stokes] = ('npixels', merged[stokes].data)
-        else:
-            observed_stokes = np.stack([var.data for name, var in
-                                        merged.data_vars.items()
-                                        if name != 'pixel_index'], axis=0)
-            stokes_names = [name for name, var in merged.data_vars.items() if name != 'pixel_index']
-            observables = pyshdom.core.average_subpixel_rays(
-                pixel_index=merged.pixel_index.data,
-                nstokes=observed_stokes.shape[0],
-                weighted_stokes=observed_stokes,
-                nrays=merged.nrays.size,
-                npixels=sensor.npixels.size)
-            for i, name in enumerate(stokes_names):
-                sensor[name] = ('npixels', observables[i])
+        flat = self._flat_mapping(mapping)
+        stokes_names = [name for name in ('I', 'Q', 'U', 'V')
+                        if name in rendered_rays[0].data_vars]
+        nrays = flat['ray_pixel'].size
+        buffer = flat.get('weighted_stokes')
+        if buffer is None or buffer.shape != (len(stokes_names), nrays):
+            buffer = np.zeros((len(stokes_names), nrays), dtype=np.float32, order='F')
+            flat['weighted_stokes'] = buffer
+
+        for i, name in enumerate(stokes_names):
+            np.concatenate([data[name].data for data in rendered_rays], out=buffer[i])
+            buffer[i] *= flat['ray_weight']
+
+        observables = pyshdom.core.average_subpixel_rays(
+            pixel_index=flat['ray_pixel'],
+            nstokes=buffer.shape[0],
+            weighted_stokes=buffer,
+            nrays=nrays,
+            npixels=flat['pixel_offsets'][-1])
+
+        pixel_offsets = flat['pixel_offsets']
+        for i, sensor in enumerate(flat['sensors']):
+            start, end = pixel_offsets[i], pixel_offsets[i+1]
+            for stokes, use_stokes in zip(sensor.stokes_index.data, sensor.stokes.data):
+                if use_stokes and str(stokes) in stokes_names:
+                    sensor[str(stokes)] = ('npixels',
+                                           observables[stokes_names.index(str(stokes)), start:end])
 
     @property
     def nmeasurements(self):
@@ -657,9 +855,33 @@ class SolversDict(OrderedDict):
     Stores multiple solver.RTE objects and has methods for solving in parallel
     as well as pre-processing for the evaluation of the cost/gradient.
     """
-    def add_solver(self, key, solver):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        #number of iterations of the latest solution for each key which is used to
+        #estimate the cost of the next solution, even if the solver is replaced.
+        self._previous_iterations = OrderedDict()
+        #estimated cost of each ray of the sensors for each key from the latest
+        #rendering, which is used to balance the next rendering.
+        self._ray_costs = OrderedDict()
+        #bookkeeping for warm starts (see SolversDict.add_solver). The number of
+        #iterations of the latest cold start for each key, the keys whose next solution
+        #is warm started and the total iterations saved by warm starts for each key.
+        self._cold_start_iterations = OrderedDict()
+        self._warm_start_keys = set()
+        self._iterations_saved = OrderedDict()
+
+    def add_solver(self, key, solver, warm_start=False, max_relative_change=0.1):
         """Adds a pyshdom.solver.RTE object to self.
 
+        If `warm_start` is True and `solver` replaces a solved solver
+        (e.g. when updating the solvers with a new state during an optimization)
+        then the adaptive grid and radiance/source spherical harmonics of the
+        replaced solver are loaded into `solver` (see solver.RTE.load_solution)
+        and used to initialize its solution, which typically needs many fewer
+        iterations than one initialized from the two-stream model. If the optical
+        properties have changed too much or the solvers are incompatible then
+        `solver` is cold started as usual.
+
         Parameters
         ----------
         key : Any
@@ -667,6 +889,11 @@ class SolversDict(OrderedDict):
             the monochromatic wavelength as a float.
         solver : pyshdom.solver.RTE
             The solver ojbect to add to `self`.
+        warm_start : bool
+            If True, initialize the solution of `solver` from the solver it replaces.
+        max_relative_change : float
+            The largest relative change (L2 norm) in the extinction or scattering
+            coefficients on the property grid for which `solver` is warm started.
 
         Raises
         ------
@@ -675,17 +902,58 @@ class SolversDict(OrderedDict):
         """
         if not isinstance(solver, pyshdom.solver.RTE):
             raise TypeError("solver should be of type '{}'".format(pyshdom.solver.RTE))
+        self._warm_start_keys.discard(key)
+        if warm_start and key in self and self[key] is not solver and \
+            self[key].check_solved(verbose=False):
+            previous = self[key]
+            if self._relative_change(previous, solver) <= max_relative_change:
+                try:
+                    solver.load_solution(previous.save_solution())
+                except (ValueError, pyshdom.exceptions.SHDOMError):
+                    pass
+                else:
+                    self._warm_start_keys.add(key)
         self[key] = solver
 
+    @staticmethod
+    def _relative_change(previous, solver):
+        """
+        The relative change (L2 norm) of the extinction and scattering coefficients
+        on the property grid between two solvers, or np.inf if they are not comparable.
+        """
+        if previous._pa.extinctp.shape != solver._pa.extinctp.shape:
+            return np.inf
+        change = 0.0
+        for field in (lambda pa: pa.extinctp, lambda pa: pa.extinctp*pa.albedop):
+            old = field(previous._pa).astype(np.float64)
+            new = field(solver._pa).astype(np.float64)
+            norm = np.linalg.norm(old)
+            if norm > 0.0:
+                change = max(change, np.linalg.norm(new - old)/norm)
+            elif np.any(new != old):
+                return np.inf
+        return change
+
+    @property
+    def iterations_saved(self):
+        """
+        The total number of iterations saved by warm starts (see SolversDict.add_solver)
+        for each key. For each warm started solution this is the number of iterations
+        of the latest cold start minus those of the warm start.
+        """
+        return self._iterations_saved
+
     def parallel_solve(self, n_jobs=1, mpi_comm=None, overwrite_solver=False, maxiter=100,
-                       verbose=True, init_solution=True, setup_grid=True):
+                       verbose=True, init_solution=True, setup_grid=True, backend='threading',
+                       compact=False, cache=None):
         """
-        Solves in parallel all solver.RTE objects using MPI or multi-threading.
+        Solves in parallel all solver.RTE objects using MPI, multi-threading or
+        multi-processing.
 
         Parameters
         ----------
         n_jobs : int
-            The number of workers if using multi-threaded parallelization.
+            The number of workers if using shared memory or process-based parallelization.
         mpi_comm : mpi4py.MPI.Intracomm
             The MPI communicator forces the MPI parallelization to run.
             Note that there is no type check on mpi_comm.
@@ -704,25 +972,219 @@ class SolversDict(OrderedDict):
             by RTE.load_solution or use a 1D two-stream model.
         verbose: boolean
             True will output solution iteration information into stdout.
+        backend : str
+            The joblib backend used when `n_jobs` > 1. 'threading' solves in the
+            current process. 'loky' or 'multiprocessing' ship each solver to a worker
+            process which returns only the compact solution state
+            (see solver.RTE._get_solution_state) which is then restored into the solvers
+            in `self`. Process-based backends avoid contention for the GIL and Python-level
+            overheads at the cost of pickling the solvers.
+        compact : bool
+            If True then the arrays of each solved solver are trimmed to their used
+            extent to reduce memory (see solver.RTE.compact).
+        cache : pyshdom.containers.SolutionCache
+            If provided, solvers whose inputs have a cached solution are restored from
+            the cache instead of being solved and the converged new solutions are
+            added to the cache.
+
+        Raises
+        ------
+        ValueError
+            If `backend` is not supported.
         """
-        key_list, to_solve = self.to_solve(overwrite_solver)
+        if backend not in ('threading', 'loky', 'multiprocessing'):
+            raise ValueError(
+                "`backend` should be one of ('threading', 'loky', 'multiprocessing') "
+                "not '{}'".format(backend))
         if mpi_comm is not None:
-            for i in range(0, len(to_solve), mpi_comm.Get_size()):
-                index = i + mpi_comm.Get_rank()
-                if index < len(to_solve):
-                    to_solve[index].solve(
-                        maxiter=maxiter, verbose=verbose, init_solution=init_solution,
-                        setup_grid=setup_grid)
+            key_list, to_solve = self.owned_by_rank(mpi_comm).to_solve(overwrite_solver)
+            if cache is not None:
+                key_list, to_solve = self._lookup_cache(cache, key_list)
+            for solver in to_solve:
+                solver.solve(maxiter=maxiter, verbose=verbose, init_solution=init_solution,
+                             setup_grid=setup_grid)
         else:
+            key_list, to_solve = self.to_solve(overwrite_solver)
+            if cache is not None:
+                key_list, to_solve = self._lookup_cache(cache, key_list)
+            #start the longest solutions first for better load balancing.
+            key_list = self.order_by_cost(key_list)
+            to_solve = [self[key] for key in key_list]
             if n_jobs == 1:
                 for solver in to_solve:
                     solver.solve(maxiter=maxiter, init_solution=init_solution,
                                  verbose=verbose, setup_grid=setup_grid)
-            else:
+            elif backend == 'threading':
                 Parallel(n_jobs=n_jobs, backend="threading")(
                     delayed(solver.solve)(maxiter=maxiter, init_solution=init_solution,
                                           verbose=verbose, setup_grid=setup_grid)
                     for solver in to_solve)
+            else:
+                states = Parallel(n_jobs=n_jobs, backend=backend)(
+                    delayed(pyshdom.parallel.solve_in_process)(
+                        solver, maxiter=maxiter, init_solution=init_solution,
+                        verbose=verbose, setup_grid=setup_grid)
+                    for solver in to_solve)
+                for solver, state in zip(to_solve, states):
+                    solver._set_solution_state(state)
+        if cache is not None:
+            for solver in to_solve:
+                cache.insert(solver)
+        if compact:
+            for solver in to_solve:
+                solver.compact()
+        for key in key_list:
+            self.record_iterations(key)
+
+    def _lookup_cache(self, cache, keys):
+        """
+        Restores the solvers in `keys` that have a solution in `cache`
+        (see SolutionCache.lookup).
+
+        Returns
+        -------
+        key_list : List
+            The keys of the solvers that were not found in the cache.
+        to_solve : List
+            The corresponding solvers.
+        """
+        key_list = [key for key in keys if not cache.lookup(self[key])]
+        return key_list, [self[key] for key in key_list]
+
+    def order_by_cost(self, keys):
+        """
+        Orders solver keys by the estimated cost of solving, longest first.
+
+        The cost is estimated by pyshdom.parallel.estimate_solve_cost using the number
+        of iterations of the previous solution for each key. Solvers without a previous
+        solution are assumed to take the mean number of iterations of the others.
+
+        Parameters
+        ----------
+        keys : list
+            The keys of solvers in `self`.
+
+        Returns
+        -------
+        ordered_keys : list
+            `keys` ordered by decreasing estimated cost.
+        """
+        keys = list(keys)
+        iterations = OrderedDict()
+        for key in keys:
+            if key in self._previous_iterations:
+                iterations[key] = self._previous_iterations[key]
+            elif self[key].num_iterations > 0:
+                iterations[key] = self[key].num_iterations
+        default_iterations = np.mean(list(iterations.values())) if iterations else 1
+        costs = [pyshdom.parallel.estimate_solve_cost(self[key], iterations.get(key, default_iterations))
+                 for key in keys]
+        return [keys[i] for i in np.argsort(-1*np.array(costs), kind='stable')]
+
+    def record_iterations(self, key):
+        """
+        Records the number of iterations of the solution of the solver at `key`
+        for use in SolversDict.order_by_cost and SolversDict.iterations_saved.
+        """
+        iterations = self[key].num_iterations
+        self._previous_iterations[key] = iterations
+        if key in self._warm_start_keys:
+            self._warm_start_keys.discard(key)
+            if key in self._cold_start_iterations:
+                self._iterations_saved[key] = self._iterations_saved.get(key, 0) + \
+                    self._cold_start_iterations[key] - iterations
+        else:
+            self._cold_start_iterations[key] = iterations
+
+    def dry_run(self, verbose=True):
+        """
+        Reports the projected peak memory of solving each solver before
+        the large solution arrays are allocated (see solver.RTE.estimate_memory).
+
+        Parameters
+        ----------
+        verbose : bool
+            If True then the projected memory of each solver and their total
+            is printed.
+
+        Returns
+        -------
+        memory : OrderedDict
+            The projected peak memory (MB) of each solver.
+        """
+        memory = OrderedDict([(key, solver.estimate_memory()) for key, solver in self.items()])
+        if verbose:
+            print('{:>16s} {:>12s} {:>12s} {:>14s}'.format('key', 'nbpts', 'max points', 'memory [MB]'))
+            for key, solver in self.items():
+                print('{:>16s} {:>12d} {:>12d} {:>14.1f}'.format(
+                    str(key), solver._nbpts, solver._maxig, memory[key]))
+            print('{:>16s} {:>12s} {:>12s} {:>14.1f}'.format('total', '', '', sum(memory.values())))
+        return memory
+
+    def ray_costs(self, rte_sensors):
+        """
+        Returns the cached estimates of the cost of each ray in `rte_sensors`.
+
+        Parameters
+        ----------
+        rte_sensors : OrderedDict
+            The sensors grouped by solver key (see SensorsDict.sort_sensors).
+
+        Returns
+        -------
+        ray_costs : OrderedDict
+            The cost of each ray for each key in `rte_sensors` or None if costs are not
+            available for every key (e.g. on the first rendering), in which case
+            all rays should be treated as having equal cost.
+        """
+        ray_costs = OrderedDict()
+        for key, rte_sensor in rte_sensors.items():
+            if key not in self._ray_costs or \
+                self._ray_costs[key].size != rte_sensor.sizes['nrays']:
+                return None
+            ray_costs[key] = self._ray_costs[key]
+        return ray_costs
+
+    def record_ray_costs(self, rte_sensors, n_jobs=1):
+        """
+        Estimates and caches the cost of each ray in `rte_sensors` using
+        the current solvers (see pyshdom.parallel.estimate_ray_costs) for use in
+        the subdivision of the next rendering (pyshdom.parallel.subdivide_raytrace_jobs).
+
+        Parameters
+        ----------
+        rte_sensors : OrderedDict
+            The sensors grouped by solver key (see SensorsDict.sort_sensors).
+        n_jobs : int
+            The number of threads to estimate the costs with
+            (see pyshdom.parallel.parallel_estimate_ray_costs).
+        """
+        self._ray_costs.update(pyshdom.parallel.parallel_estimate_ray_costs(
+            self, rte_sensors, n_jobs=n_jobs, ray_costs=self.ray_costs(rte_sensors)))
+
+    def owned_by_rank(self, mpi_comm):
+        """
+        Returns the solvers owned by this MPI rank.
+
+        Solvers are distributed among the ranks of `mpi_comm` in a round-robin
+        fashion by their position in `self`. The same solvers are used by a rank
+        to solve the RTE (SolversDict.parallel_solve), render (SensorsDict.get_measurements)
+        and evaluate the gradient (pyshdom.parallel.parallel_gradient).
+
+        Parameters
+        ----------
+        mpi_comm : mpi4py.MPI.Intracomm
+            The MPI communicator.
+
+        Returns
+        -------
+        owned : SolversDict
+            The solvers owned by the rank of `mpi_comm`.
+        """
+        owned = SolversDict()
+        for key in list(self)[mpi_comm.Get_rank()::mpi_comm.Get_size()]:
+            owned.add_solver(key, self[key])
+        return owned
 
     def to_solve(self, overwrite_solver):
         """
@@ -782,8 +1244,419 @@ class SolversDict(OrderedDict):
         for key in self:
             self[key].calculate_microphysical_partial_derivatives(
                 unknown_scatterers.table_to_grid_method,
-                unknown_scatterers.table_data[key]
+                unknown_scatterers.table_data[key],
+                derivative_tables=unknown_scatterers.derivative_phase_tables(key)
+                )
+
+class SolutionStore:
+    """
+    An on-disk store of solved solver.RTE objects with one memory-mapped file per key.
+
+    Each file has a fixed binary layout: a header (see SolutionStore._HEADER) followed by
+    the grid and solution arrays in the order of SolutionStore._LAYOUT, each in Fortran
+    order and aligned to SolutionStore._ALIGNMENT bytes, followed by the (small) remainder
+    of the solution state (see solver.RTE._get_solution_state) which is pickled.
+
+    Loading a solution maps the arrays from the file read-only rather than reading them
+    into memory. The solver is left compacted (see solver.RTE.compact) and renders
+    (RTE.integrate_to_sensor) and gradients read the arrays directly from the page cache,
+    so a solution that is saved once can be opened by many rendering processes without
+    duplicating its memory. The arrays are copied into memory if the solution is continued,
+    updated or replaced.
+
+    Parameters
+    ----------
+    directory : str
+        The directory of the files, which is created if it does not exist.
+
+    Examples
+    --------
+    >>> store = pyshdom.containers.SolutionStore('solutions')
+    >>> solvers.parallel_solve()
+    >>> store.save_solvers(solvers)
+
+    In another process with the solvers initialized with the same inputs:
+
+    >>> store.load_solvers(solvers)
+    >>> sensors.get_measurements(solvers)
+    """
+    _MAGIC = b'SHDOMSOL'
+    _VERSION = 1
+    #magic, version, nstokes, npart, npts, ncells, nsh, nrad, nx, ny, nz,
+    #state_offset, state_length.
+    _HEADER = struct.Struct('<8s12q')
+    _ALIGNMENT = 64
+    #name, dtype and shape of each array. The shapes are in terms of the header sizes.
+    _LAYOUT = (
+        ('_gridpos', np.float32, (3, 'npts')),
+        ('_gridptr', np.int32, (8, 'ncells')),
+        ('_neighptr', np.int32, (6, 'ncells')),
+        ('_treeptr', np.int32, (2, 'ncells')),
+        ('_cellflags', np.int16, ('ncells',)),
+        ('_shptr', np.int32, ('npts+1',)),
+        ('_rshptr', np.int32, ('npts+2',)),
+        ('_source', np.float32, ('nstokes', 'nsh')),
+        ('_radiance', np.float32, ('nstokes', 'nrad')),
+        ('_oshptr', np.int32, ('npts+1',)),
+        ('_fluxes', np.float32, (2, 'npts')),
+        ('_dirflux', np.float32, ('npts',)),
+        ('_temp', np.float32, ('npts',)),
+        ('_total_ext', np.float32, ('npts',)),
+        ('_extinct', np.float32, ('npts', 'npart')),
+        ('_albedo', np.float32, ('npts', 'npart')),
+        ('_iphase', np.int32, ('npts', 'npart')),
+        ('_planck', np.float32, ('npts', 'npart')),
+    )
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """
+        The path to the file of the solution stored under `key`.
+        """
+        return os.path.join(self.directory,
+                            'solution_{}.bin'.format(str(key).replace(os.sep, '_')))
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def save(self, key, solver):
+        """
+        Writes the solution of `solver` to the file for `key`.
+
+        The file is written to a temporary path and then moved into place so that
+        processes which have the previous solution for `key` open are unaffected.
+
+        Parameters
+        ----------
+        key : float or str
+            The key of the solution e.g. the key of `solver` in a SolversDict.
+        solver : pyshdom.solver.RTE
+            A solved (possibly compacted or compressed) solver.
+
+        Returns
+        -------
+        path : str
+            The path to the file.
+
+        Raises
+        ------
+        pyshdom.exceptions.SHDOMError
+            If `solver` has not been solved.
+        """
+        if not solver.check_solved(verbose=False):
+            raise pyshdom.exceptions.SHDOMError(
+                "Solver for key '{}' has not been solved and can't be stored.".format(key)
+            )
+        state = solver._get_solution_state()
+        sizes = {'nstokes': solver._nstokes, 'npart': solver._npart, 'npts': solver._npts,
+                 'ncells': solver._ncells, 'nsh': int(solver._shptr[solver._npts]),
+                 'nrad': int(solver._rshptr[solver._npts])}
+        offsets, state_offset = self._offsets(sizes)
+        arrays = OrderedDict()
+        for name, dtype, shape in self._LAYOUT:
+            arrays[name] = np.asfortranarray(state.pop(name), dtype=dtype)
+            if arrays[name].shape != self._shape(shape, sizes):
+                raise ValueError(
+                    "The shape {} of '{}' does not match the layout {}.".format(
+                        arrays[name].shape, name, self._shape(shape, sizes))
                 )
+        state_bytes = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+        path = self.path(key)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as file:
+            file.write(self._HEADER.pack(
+                self._MAGIC, self._VERSION, sizes['nstokes'], sizes['npart'], sizes['npts'],
+                sizes['ncells'], sizes['nsh'], sizes['nrad'], solver._nx, solver._ny,
+                solver._nz, state_offset, len(state_bytes)))
+            for name, array in arrays.items():
+                file.seek(offsets[name])
+                #the transpose of a Fortran ordered array is C ordered so this
+                #writes the array in Fortran order without a copy.
+                array.T.tofile(file)
+            file.seek(state_offset)
+            file.write(state_bytes)
+        os.replace(temp_path, path)
+        return path
+
+    def load(self, key, solver):
+        """
+        Restores the solution stored under `key` into `solver` with its arrays
+        memory-mapped read-only from the file.
+
+        Parameters
+        ----------
+        key : float or str
+            The key of the solution.
+        solver : pyshdom.solver.RTE
+            A solver initialized with the same inputs as the stored one.
+
+        Raises
+        ------
+        KeyError
+            If there is no solution stored under `key`.
+        ValueError
+            If the file is not a valid solution or doesn't match the grid of `solver`.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            raise KeyError("There is no solution stored for key '{}' in '{}'".format(
+                key, self.directory))
+        mapped = np.memmap(path, dtype=np.uint8, mode='r')
+        if mapped.size < self._HEADER.size:
+            raise ValueError("'{}' is not a valid solution file.".format(path))
+        magic, version, nstokes, npart, npts, ncells, nsh, nrad, nx, ny, nz, \
+            state_offset, state_length = self._HEADER.unpack(
+                mapped[:self._HEADER.size].tobytes())
+        if magic != self._MAGIC or version != self._VERSION:
+            raise ValueError("'{}' is not a valid solution file of version {}.".format(
+                path, self._VERSION))
+        if (nstokes, npart, nx, ny, nz) != (solver._nstokes, solver._npart,
+                                            solver._nx, solver._ny, solver._nz):
+            raise ValueError(
+                "The solution stored for key '{}' (nstokes={}, npart={}, grid {}) does not "
+                "match the solver (nstokes={}, npart={}, grid {}).".format(
+                    key, nstokes, npart, (nx, ny, nz), solver._nstokes, solver._npart,
+                    (solver._nx, solver._ny, solver._nz))
+            )
+        sizes = {'nstokes': nstokes, 'npart': npart, 'npts': npts, 'ncells': ncells,
+                 'nsh': nsh, 'nrad': nrad}
+        offsets, _ = self._offsets(sizes)
+        state = pickle.loads(mapped[state_offset:state_offset+state_length].tobytes())
+        for name, dtype, shape in self._LAYOUT:
+            state[name] = np.ndarray(self._shape(shape, sizes), dtype=dtype, buffer=mapped,
+                                     offset=offsets[name], order='F')
+        solver._set_solution_state(state, expand=False)
+
+    def save_solvers(self, solvers):
+        """
+        Writes the solutions of all solvers in a SolversDict using their keys.
+
+        Parameters
+        ----------
+        solvers : pyshdom.containers.SolversDict
+            The solved solvers.
+        """
+        for key, solver in solvers.items():
+            self.save(key, solver)
+
+    def load_solvers(self, solvers):
+        """
+        Restores the stored solutions into all solvers in a SolversDict
+        using their keys (see SolutionStore.load).
+
+        Parameters
+        ----------
+        solvers : pyshdom.containers.SolversDict
+            Solvers initialized with the same inputs as the stored ones.
+        """
+        for key, solver in solvers.items():
+            self.load(key, solver)
+
+    @staticmethod
+    def _shape(shape, sizes):
+        """
+        Evaluates a shape from SolutionStore._LAYOUT for the header sizes.
+        """
+        out = []
+        for dim in shape:
+            if isinstance(dim, str):
+                name, _, extra = dim.partition('+')
+                dim = sizes[name] + int(extra or 0)
+            out.append(dim)
+        return tuple(out)
+
+    def _offsets(self, sizes):
+        """
+        The byte offset of each array in the file and of the pickled state.
+        """
+        offsets = OrderedDict()
+        offset = self._HEADER.size
+        for name, dtype, shape in self._LAYOUT:
+            offset = -(-offset // self._ALIGNMENT)*self._ALIGNMENT
+            offsets[name] = offset
+            offset += int(np.prod(self._shape(shape, sizes)))*np.dtype(dtype).itemsize
+        return offsets, offset
+
+class SolutionCache(SolutionStore):
+    """
+    A size-bounded, content-addressed on-disk cache of converged solver.RTE solutions.
+
+    Solutions are stored as in SolutionStore under a hash of the inputs that determine
+    the solution (see SolutionCache.solver_key) so that identical media
+    (e.g. in forward-model sweeps that only change the sensors) are not solved again.
+    When the total size of the cache exceeds `max_size_mb`, the least recently used
+    solutions are evicted.
+
+    Parameters
+    ----------
+    directory : str
+        The directory of the cache, which is created if it does not exist.
+    max_size_mb : float
+        The maximum total size of the cached files in megabytes.
+
+    See Also
+    --------
+    SolversDict.parallel_solve
+    """
+    def __init__(self, directory, max_size_mb=1024.0):
+        super().__init__(directory)
+        self.max_size_mb = max_size_mb
+        self._stats = OrderedDict([('hits', 0), ('misses', 0), ('evictions', 0)])
+
+    @staticmethod
+    def solver_key(solver):
+        """
+        The hash of the inputs of `solver` that determine its solution: the medium,
+        `numerical_params`, source, surface, atmosphere and number of Stokes components.
+
+        Parameters
+        ----------
+        solver : pyshdom.solver.RTE
+            The solver.
+
+        Returns
+        -------
+        key : str
+            The hexadecimal SHA-256 digest.
+        """
+        hasher = hashlib.sha256()
+        for value in (solver.medium, solver.numerical_params, solver.source, solver.surface,
+                      solver.atmosphere, solver._nstokes):
+            _update_hash(hasher, value)
+        return hasher.hexdigest()
+
+    def lookup(self, solver):
+        """
+        Restores the cached solution for the inputs of `solver` if there is one
+        (see SolutionStore.load).
+
+        Parameters
+        ----------
+        solver : pyshdom.solver.RTE
+            The solver.
+
+        Returns
+        -------
+        hit : bool
+            True if the solution was found and restored.
+        """
+        key = self.solver_key(solver)
+        if key not in self:
+            self._stats['misses'] += 1
+            return False
+        self.load(key, solver)
+        #the modification time records the last use for the LRU eviction.
+        os.utime(self.path(key))
+        self._stats['hits'] += 1
+        return True
+
+    def insert(self, solver):
+        """
+        Adds the solution of `solver` to the cache if it has converged and
+        evicts the least recently used solutions if the cache is too large.
+
+        Parameters
+        ----------
+        solver : pyshdom.solver.RTE
+            The solver.
+
+        Returns
+        -------
+        inserted : bool
+            False if the solution has not converged and was not cached.
+        """
+        if not solver.check_solved(verbose=False):
+            return False
+        self.save(self.solver_key(solver), solver)
+        self.evict()
+        return True
+
+    def evict(self):
+        """
+        Deletes the least recently used solutions until the size of the cache is
+        at most `max_size_mb`. The most recently used solution is always kept.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        size = sum([entry[2] for entry in entries])
+        for path, _, nbytes in entries[:-1]:
+            if size <= self.max_size_mb*2**20:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= nbytes
+            self._stats['evictions'] += 1
+
+    def clear(self):
+        """
+        Deletes all cached solutions.
+        """
+        for path, _, _ in self._entries():
+            os.remove(path)
+
+    @property
+    def stats(self):
+        """
+        The number of hits, misses and evictions since the cache was created
+        and the current number of entries and total size in megabytes.
+        """
+        stats = OrderedDict(self._stats)
+        entries = self._entries()
+        stats['entries'] = len(entries)
+        stats['size_mb'] = sum([entry[2] for entry in entries])/2**20
+        return stats
+
+    def _entries(self):
+        """
+        The path, last use time and size of each cached solution.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('solution_') and name.endswith('.bin'):
+                path = os.path.join(self.directory, name)
+                info = os.stat(path)
+                entries.append((path, info.st_mtime_ns, info.st_size))
+        return entries
+
+def _update_hash(hasher, value):
+    """
+    Updates `hasher` with the content of `value` which may be (nested containers of)
+    xr.Dataset, xr.DataArray, np.ndarray or scalars.
+    """
+    if isinstance(value, xr.Dataset):
+        hasher.update(b'Dataset')
+        for name in sorted(value.variables):
+            hasher.update(str(name).encode())
+            _update_hash(hasher, value.variables[name])
+        _update_hash(hasher, value.attrs)
+    elif isinstance(value, (xr.DataArray, xr.Variable)):
+        hasher.update(str(value.dims).encode())
+        _update_hash(hasher, value.values)
+        _update_hash(hasher, value.attrs)
+    elif isinstance(value, np.ndarray) and value.dtype != object:
+        hasher.update('{}{}'.format(value.dtype.str, value.shape).encode())
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, np.ndarray):
+        #the repr of large object arrays is truncated so their items are hashed.
+        hasher.update('object{}'.format(value.shape).encode())
+        for item in value.ravel(order='C'):
+            _update_hash(hasher, item)
+    elif isinstance(value, dict):
+        hasher.update(b'dict')
+        for name in sorted(value, key=str):
+            hasher.update(str(name).encode())
+            _update_hash(hasher, value[name])
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b'list')
+        for item in value:
+            _update_hash(hasher, item)
+    else:
+        hasher.update(repr(value).encode())
 
 class UnknownScatterers(OrderedDict):
     """
@@ -802,11 +1675,15 @@ class UnknownScatterers(OrderedDict):
         #currently only this slight adaptation of pyshdom.medium.table_to_grid is possible.
         #The API must be updated to accomodate more flexibility if more
         #methods become avaialble.
-        def regular_grid(scatterer, table_data, inverse_mode=False):
-            return pyshdom.medium.table_to_grid(scatterer, table_data, inverse_mode=inverse_mode)
+        def regular_grid(scatterer, table_data, inverse_mode=False, subset_table=True):
+            return pyshdom.medium.table_to_grid(scatterer, table_data, inverse_mode=inverse_mode,
+                                                subset_table=subset_table)
 
         self._table_to_grid_method = regular_grid
         self.table_data = None
+        #the phase function derivative tables of each solver key which are reused by
+        #the solvers that replace each other during a retrieval.
+        self._derivative_phase_tables = OrderedDict()
 
     def add_unknown(self, scatterer_name, variable_name_list, table_data):
         """
@@ -921,6 +1798,27 @@ class UnknownScatterers(OrderedDict):
             partial_derivative_tables[key] = partial_derivative_dict
 
         self.table_data = partial_derivative_tables
+        self._derivative_phase_tables = OrderedDict()
+
+    def derivative_phase_tables(self, key):
+        """
+        The store of the phase function derivative tables for the solver at `key`.
+
+        Parameters
+        ----------
+        key : Any
+            The key of the solver (typically the wavelength) in a SolversDict.
+
+        Returns
+        -------
+        store : OrderedDict
+            Updated in place by solver.RTE.calculate_microphysical_partial_derivatives.
+
+        See Also
+        --------
+        pyshdom.solver.RTE._derivative_phase_tables
+        """
+        return self._derivative_phase_tables.setdefault(key, OrderedDict())
 
     @property
     def table_to_grid_method(self):
@@ -10,10 +10,14 @@ LevisApproxGradient (e.g. LevisApproxGradientUncorrelated).
 """
 import copy
 import warnings
+from collections import OrderedDict
 
 import numpy as np
 import xarray as xr
 import pandas as pd
+import scipy.sparse
+import scipy.sparse.linalg
+from joblib import Parallel, delayed
 
 import pyshdom.core
 import pyshdom.parallel
@@ -26,8 +30,12 @@ class LevisApproxGradient:
     """
     def __init__(self, measurements, solvers, forward_sensors,
                  unknown_scatterers, parallel_solve_kwargs, gradient_kwargs,
-                 uncertainty_kwargs):
+                 uncertainty_kwargs, mpi_root=None, batch_kwargs=None):
         #TODO do type checks here.
+        if 'precomputed_stokes' in gradient_kwargs:
+            raise ValueError(
+                "'precomputed_stokes' should be passed when the gradient is called "
+                "not in `gradient_kwargs` as the forward sensors are only valid for one state.")
         self.measurements = measurements
         self.solvers = solvers
         self.forward_sensors = forward_sensors
@@ -35,8 +43,20 @@ class LevisApproxGradient:
         self.parallel_solve_kwargs = parallel_solve_kwargs
         self.gradient_kwargs = gradient_kwargs
         self.uncertainty_kwargs = uncertainty_kwargs
+        #if not None, the forward sensors are only updated on this MPI rank.
+        #See pyshdom.parallel.parallel_gradient.
+        self.mpi_root = mpi_root
+        #if not None, the cost function and its gradient are estimated from a random
+        #subset of the pixels at each evaluation. The keys are 'fraction', 'sampling'
+        #and 'seed' (see pyshdom.containers.SensorsDict.sample_sensors).
+        self.batch_kwargs = batch_kwargs
+        self._rng = None
+        if batch_kwargs is not None:
+            self._rng = np.random.default_rng(batch_kwargs.get('seed'))
         self._rte_sensors = None
         self._sensor_mapping = None
+        #the solvers for which derivatives are prepared (those owned by this rank if using MPI).
+        self._local_solvers = None
 
         #These are variables that are not used in standard gradient calculations.
         #They were used to debug the radiance calculation in the gradient
@@ -49,6 +69,9 @@ class LevisApproxGradient:
         # this was added as an option for testing. But it is hardcoded
         # to the original value used in SHDOM radiance integration of 0.2.
         self._tautol = 0.2
+        #the number of nonzero entries per pixel of the sparse Jacobian of each solver
+        #key (wavelength) from the previous evaluation (see levis_approximation_grad).
+        self._sparse_density = {}
 
         for name, instrument in self.measurements.items():
             if instrument['uncertainty_model'] is None:
@@ -73,7 +96,19 @@ class LevisApproxGradient:
                 if self.uncertainty_kwargs['add_noise']:
                     self.measurements.add_noise(sensor)
 
-    def _prep_gradient(self):
+    def _prep_gradient(self, precomputed_stokes=False):
+        """
+        Solves the RTEs and evaluates the cost function and its gradient
+        (see pyshdom.parallel.parallel_gradient).
+
+        Parameters
+        ----------
+        precomputed_stokes : bool
+            If True then the Stokes vectors of the pixels are taken from the forward
+            sensors rather than integrated. This only applies to this call and the
+            forward sensors must already hold the Stokes vectors at the current
+            state, e.g. from SensorsDict.get_measurements with self.solvers.
+        """
 
         # for solver in self.solvers.values():
         #     if solver._srctype != 'S':
@@ -81,33 +116,80 @@ class LevisApproxGradient:
         #             "Only Solar Source is supported for gradient calculations.")
 
         self.solvers.parallel_solve(**self.parallel_solve_kwargs)
+        mpi_comm = self.parallel_solve_kwargs['mpi_comm'] if 'mpi_comm' in self.parallel_solve_kwargs else None
+        n_jobs = self.parallel_solve_kwargs['n_jobs'] if 'n_jobs' in self.parallel_solve_kwargs else None
+        #with MPI, each rank only holds solutions for (and evaluates the gradient of)
+        #the solvers it owns.
+        if mpi_comm is not None:
+            local_solvers = self.solvers.owned_by_rank(mpi_comm)
+            if not local_solvers:
+                raise ValueError(
+                    "There must be at least as many solvers ({}) as MPI ranks ({}) "
+                    "for the gradient calculation.".format(len(self.solvers), mpi_comm.Get_size()))
+        else:
+            local_solvers = self.solvers
+        self._local_solvers = local_solvers
         #does some preprocessing for calculating the sensitivity of a gridpoint's
         #solar source to the optical properties along the path to the sun.
-        self.solvers.add_direct_beam_derivatives()
+        local_solvers.add_direct_beam_derivatives()
         #adds the _dext/_dleg/_dalb/_diphase etc to the solvers.
-        self.solvers.add_microphysical_partial_derivatives(self.unknown_scatterers)
+        local_solvers.add_microphysical_partial_derivatives(self.unknown_scatterers)
         #prepare the sensors for the fortran subroutine for calculating gradient.
         rte_sensors, sensor_mapping = self.forward_sensors.sort_sensors(
             self.solvers, self.measurements
             )
+        if precomputed_stokes:
+            #the forward sensors already hold the Stokes vectors at this state
+            #(e.g. from SensorsDict.get_measurements) so they aren't integrated again.
+            rte_sensors = OrderedDict([
+                (key, rte_sensor.assign(forward_data=(
+                    ['nstokes', 'npixels'],
+                    self._forward_stokes(sensor_mapping[key], rte_sensor.sizes['nstokes']))))
+                for key, rte_sensor in rte_sensors.items()])
+        forward_sensors = self.forward_sensors
+        if self.batch_kwargs is not None:
+            #every MPI rank draws the same sample as the generators have the same seed
+            #and are used for every solver key on every rank.
+            rte_sensors = self.forward_sensors.sample_sensors(
+                rte_sensors, sensor_mapping, self.batch_kwargs['fraction'],
+                sampling=self.batch_kwargs.get('sampling', 'pixels'), rng=self._rng
+                )
+            #only the sampled pixels are rendered so the forward sensors are not updated.
+            forward_sensors = None
         self._rte_sensors = rte_sensors
         self._sensor_mapping = sensor_mapping
-        mpi_comm = self.parallel_solve_kwargs['mpi_comm'] if 'mpi_comm' in self.parallel_solve_kwargs else None
-        n_jobs = self.parallel_solve_kwargs['n_jobs'] if 'n_jobs' in self.parallel_solve_kwargs else None
 
         #The treatment of the gradient_kwargs is quite clumsy here as they are known in self
         #but are sent, instead of redefining gradient_fun to be self.levis_approximation_grad
         #WITH the kwargs set.
         outputs = pyshdom.parallel.parallel_gradient(
-            self.solvers, rte_sensors, sensor_mapping, self.forward_sensors,
+            self.solvers, rte_sensors, sensor_mapping, forward_sensors,
             gradient_fun=self.levis_approximation_grad,
-            mpi_comm=mpi_comm,
-            n_jobs=n_jobs, **self.gradient_kwargs
+            mpi_comm=mpi_comm, mpi_root=self.mpi_root,
+            n_jobs=n_jobs, precomputed_stokes=precomputed_stokes, **self.gradient_kwargs
             )
         return outputs
 
+    def _forward_stokes(self, mapping, nstokes):
+        """
+        The Stokes vectors of the pixels of the forward sensors in `mapping` (an entry of
+        the sensor_mappings from SensorsDict.sort_sensors) concatenated like the pixels of
+        the merged sensors. Components that are not observed are zero.
+        """
+        stokes_data = []
+        for instrument, index in mapping:
+            sensor = self.forward_sensors[instrument]['sensor_list'][index]
+            data = np.zeros((nstokes, sensor.sizes['npixels']))
+            for i, (stokes, use_stokes) in enumerate(zip(sensor.stokes_index.data[:nstokes],
+                                                         sensor.stokes.data[:nstokes])):
+                if use_stokes and str(stokes) in sensor.data_vars:
+                    data[i] = sensor[str(stokes)].data
+            stokes_data.append(data)
+        return np.concatenate(stokes_data, axis=-1)
+
     def levis_approximation_grad(self, rte_solver, sensor, cost_function='L2',
-                                 indices_for_jacobian=None, exact_single_scatter=True):
+                                 indices_for_jacobian=None, exact_single_scatter=True,
+                                 sparse_jacobian=False, precomputed_stokes=False):
         """
         Calculates the gradient of a cost function according to the Levis approximation to the Frechet
         derivatives of the RTE equation.
@@ -122,6 +204,23 @@ class LevisApproxGradient:
             A sensor which should contain pixel-level uncertainties and measurement data
             as well as the ray & pixel geometry for calculating the forward model
             pixel values for evaluation of the cost function and its gradient.
+        cost_function : str
+            The cost function to evaluate (see src/polarized/shdomsub4.f UPDATE_COSTFUNCTION).
+        indices_for_jacobian : Tuple
+            The (x, y, z) indices of the base grid points to output the dense Jacobian for.
+        exact_single_scatter : bool
+            Whether to calculate the single scattering contribution to the derivatives
+            exactly.
+        sparse_jacobian : bool
+            If True then the Jacobian with respect to every base grid point is output as
+            a sparse matrix (see Returns) and `indices_for_jacobian` is ignored.
+        precomputed_stokes : bool
+            If True then the Stokes vectors of the pixels are taken from the 'forward_data'
+            of `sensor` rather than integrated along the rays (see
+            LevisApproxGradient._prep_gradient). The rays are still traversed to
+            calculate the derivatives except for those of pixels which can't contribute to
+            the gradient, e.g. because their inverse error-covariance is zero.
+
         Returns
         -------
         loss: float64
@@ -131,6 +230,10 @@ class LevisApproxGradient:
         integrated_rays : xr.Dataset
             The forward model output used to evaluate the cost function against
             the measurements.
+        jacobian : np.ndarray or scipy.sparse.csr_matrix or None
+            The dense Jacobian of shape (nstokes, numder, num_jacobian_pts, npixels)
+            if `indices_for_jacobian` is not None, the sparse Jacobian if `sparse_jacobian`
+            (see make_sparse_jacobian) or None otherwise.
         """
         #This function could also be a method of solver.RTE just like
         #calculate_microphysical_partial_derivatives and calculate_direct_beam_derivative.
@@ -175,8 +278,12 @@ class LevisApproxGradient:
         rays_per_pixel = sensor['rays_per_pixel'].data
         uncertainties = sensor['uncertainties'].data
         num_uncertainty = sensor['num_uncertainty'].size
+        if precomputed_stokes:
+            stokes_in = sensor['forward_data'].data
+        else:
+            stokes_in = np.zeros((rte_solver._nstokes, total_pix), dtype=np.float32, order='F')
 
-        if indices_for_jacobian is None:
+        if sparse_jacobian or indices_for_jacobian is None:
             jacobian = np.empty(
                 (rte_solver._nstokes, rte_solver._num_derivatives, 1, 1),
                 order='F',
@@ -197,120 +304,119 @@ class LevisApproxGradient:
                 dtype=np.float32
             )
             jacobian_flag = True
-        if self._longradiance is None:
-            self._longradiance = np.zeros((rte_solver._nstokes, rte_solver._npts), dtype=np.float32,
-                                          order='F')
-        gradient, loss, images, jacobian = pyshdom.core.levisapprox_gradient(
-            camx=camx,
-            camy=camy,
-            camz=camz,
-            cammu=cammu,
-            camphi=camphi,
-            npix=total_pix,
-            costfunc=cost_function,
-            ncost=cost_size,
-            ngrad=gradient_size,
-            nuncertainty=num_uncertainty,
-            uncertainties=uncertainties,
-            rays_per_pixel=rays_per_pixel,
-            ray_weights=ray_weights,
-            stokes_weights=stokes_weights,
-            exact_single_scatter=exact_single_scatter,
-            measurements=measurement_data,
-            jacobian=jacobian,
-            jacobianptr=jacobian_ptr,
-            num_jacobian_pts=num_jacobian_pts,
-            makejacobian=jacobian_flag,
-            longradiance=self._longradiance,
-            uselongrad=self._uselongrad,
-            tautol=self._tautol,
-            diphaseind=rte_solver._diphaseind,
-            nstphase=rte_solver._nstphase,
-            dpath=rte_solver._direct_derivative_path,
-            dptr=rte_solver._direct_derivative_ptr,
-            npx=rte_solver._pa.npx,
-            npy=rte_solver._pa.npy,
-            npz=rte_solver._pa.npz,
-            delx=rte_solver._pa.delx,
-            dely=rte_solver._pa.dely,
-            xstart=rte_solver._pa.xstart,
-            ystart=rte_solver._pa.ystart,
-            zlevels=rte_solver._pa.zlevels,
-            extdirp=rte_solver._pa.extdirp,
-            uniformzlev=rte_solver._uniformzlev,
-            partder=rte_solver._unknown_scatterer_indices,
-            numder=rte_solver._num_derivatives,
-            dext=rte_solver._dext,
-            dalb=rte_solver._dalb,
-            diphase=rte_solver._diphase,
-            dleg=rte_solver._dleg,
-            dphasetab=rte_solver._dphasetab,
-            dnumphase=rte_solver._dnumphase,
-            nscatangle=rte_solver._nscatangle,
-            phasetab=rte_solver._phasetab,
-            ylmsun=rte_solver._ylmsun,
-            nstokes=rte_solver._nstokes,
-            nstleg=rte_solver._nstleg,
-            nx=rte_solver._nx,
-            ny=rte_solver._ny,
-            nz=rte_solver._nz,
-            bcflag=rte_solver._bcflag,
-            ipflag=rte_solver._ipflag,
-            npts=rte_solver._npts,
-            nbpts=rte_solver._nbpts,
-            ncells=rte_solver._ncells,
-            nbcells=rte_solver._nbcells,
-            ml=rte_solver._ml,
-            mm=rte_solver._mm,
-            ncs=rte_solver._ncs,
-            nlm=rte_solver._nlm,
-            numphase=rte_solver._pa.numphase,
-            nmu=rte_solver._nmu,
-            nphi0max=rte_solver._nphi0max,
-            nphi0=rte_solver._nphi0,
-            maxnbc=rte_solver._maxnbc,
-            ntoppts=rte_solver._ntoppts,
-            nbotpts=rte_solver._nbotpts,
-            nsfcpar=rte_solver._nsfcpar,
-            gridptr=rte_solver._gridptr,
-            neighptr=rte_solver._neighptr,
-            treeptr=rte_solver._treeptr,
-            shptr=rte_solver._shptr,
-            bcptr=rte_solver._bcptr,
-            cellflags=rte_solver._cellflags,
-            iphase=rte_solver._iphase[:rte_solver._npts],
-            deltam=rte_solver._deltam,
-            solarflux=rte_solver._solarflux,
-            solarmu=rte_solver._solarmu,
-            solaraz=rte_solver._solaraz,
-            gndtemp=rte_solver._gndtemp,
-            gndalbedo=rte_solver._gndalbedo,
-            skyrad=rte_solver._skyrad,
-            waveno=rte_solver._waveno,
-            wavelen=rte_solver.wavelength,
-            mu=rte_solver._mu,
-            phi=rte_solver._phi,
-            wtdo=rte_solver._wtdo,
-            xgrid=rte_solver._xgrid,
-            ygrid=rte_solver._ygrid,
-            zgrid=rte_solver._zgrid,
-            gridpos=rte_solver._gridpos,
-            sfcgridparms=rte_solver._sfcgridparms,
-            bcrad=copy.deepcopy(rte_solver._bcrad),
-            extinct=rte_solver._extinct[:rte_solver._npts],
-            albedo=rte_solver._albedo[:rte_solver._npts],
-            legen=rte_solver._legen,
-            dirflux=rte_solver._dirflux[:rte_solver._npts],
-            fluxes=rte_solver._fluxes,
-            source=rte_solver._source,
-            srctype=rte_solver._srctype,
-            sfctype=rte_solver._sfctype,
-            units=rte_solver._units,
-            rshptr=rte_solver._rshptr,
-            radiance=rte_solver._radiance,
-            total_ext=rte_solver._total_ext[:rte_solver._npts],
-            planck=rte_solver._planck[:rte_solver._npts]
-        )
+        #the number of nonzero (pixel, base grid point) entries of the sparse Jacobian is
+        #not known in advance. It is estimated from the previous evaluation at this
+        #wavelength with some headroom or, initially, from every pixel seeing every grid
+        #point along a path through the domain and back to the sun.
+        maxnnz = 1
+        if sparse_jacobian:
+            density = self._sparse_density.get(rte_solver.wavelength)
+            if density is None:
+                density = min(rte_solver._nbpts,
+                              8*(rte_solver._pa.npx + rte_solver._pa.npy + rte_solver._pa.npz))
+            else:
+                density = 1.25*density
+            maxnnz = max(int(np.ceil(total_pix*density)), 1)
+        #solvers (which may be evaluated concurrently) can have different numbers of grid points.
+        longradiance = self._longradiance
+        if longradiance is None or longradiance.shape != (rte_solver._nstokes, rte_solver._npts):
+            longradiance = np.zeros((rte_solver._nstokes, rte_solver._npts), dtype=np.float32,
+                                    order='F')
+        sparse_values = np.empty((rte_solver._nstokes, rte_solver._num_derivatives, maxnnz),
+                                 order='F', dtype=np.float32)
+        sparse_ptr = np.empty(maxnnz, dtype=np.int32)
+        gradient, loss, images, jacobian, sparse_values, sparse_ptr, pixel_ptr, nnz, _, _ = \
+            _levisapprox_gradient(
+                rte_solver,
+                camx=camx,
+                camy=camy,
+                camz=camz,
+                cammu=cammu,
+                camphi=camphi,
+                npix=total_pix,
+                costfunc=cost_function,
+                ncost=cost_size,
+                ngrad=gradient_size,
+                nuncertainty=num_uncertainty,
+                uncertainties=uncertainties,
+                rays_per_pixel=rays_per_pixel,
+                ray_weights=ray_weights,
+                stokes_weights=stokes_weights,
+                exact_single_scatter=exact_single_scatter,
+                measurements=measurement_data,
+                jacobian=jacobian,
+                jacobianptr=jacobian_ptr,
+                num_jacobian_pts=num_jacobian_pts,
+                makejacobian=jacobian_flag,
+                longradiance=longradiance,
+                uselongrad=self._uselongrad,
+                tautol=self._tautol,
+                makesparse=sparse_jacobian,
+                maxnnz=maxnnz,
+                sparsejac=sparse_values,
+                sparseptr=sparse_ptr,
+                makejvp=False,
+                jvpvector=np.zeros((rte_solver._nbpts, rte_solver._num_derivatives)),
+                makevjp=False,
+                vjpweights=np.zeros((rte_solver._nstokes, total_pix)),
+                usestokesin=precomputed_stokes,
+                stokesin=stokes_in
+            )
+        if sparse_jacobian:
+            if nnz > maxnnz:
+                #only the entries of the pixels which fit in `maxnnz` are stored so only
+                #the remaining pixels are traversed again with the exact space they need.
+                #The cost function, gradient and images are complete after the first pass.
+                first = np.searchsorted(pixel_ptr[1:] - 1, maxnnz, side='right')
+                stored = pixel_ptr[first] - 1
+                first_ray = np.sum(rays_per_pixel[:first])
+                remaining = nnz - stored
+                _, _, _, _, remaining_values, remaining_ptr, remaining_pixel_ptr, _, _, _ = \
+                    _levisapprox_gradient(
+                        rte_solver,
+                        camx=camx[first_ray:],
+                        camy=camy[first_ray:],
+                        camz=camz[first_ray:],
+                        cammu=cammu[first_ray:],
+                        camphi=camphi[first_ray:],
+                        npix=total_pix - first,
+                        costfunc=cost_function,
+                        ncost=cost_size,
+                        ngrad=gradient_size,
+                        nuncertainty=num_uncertainty,
+                        uncertainties=uncertainties[..., first:],
+                        rays_per_pixel=rays_per_pixel[first:],
+                        ray_weights=ray_weights[first_ray:],
+                        stokes_weights=stokes_weights[:, first:],
+                        exact_single_scatter=exact_single_scatter,
+                        measurements=measurement_data[:, first:],
+                        jacobian=jacobian,
+                        jacobianptr=jacobian_ptr,
+                        num_jacobian_pts=num_jacobian_pts,
+                        makejacobian=False,
+                        longradiance=longradiance,
+                        uselongrad=self._uselongrad,
+                        tautol=self._tautol,
+                        makesparse=True,
+                        maxnnz=remaining,
+                        sparsejac=np.empty((rte_solver._nstokes, rte_solver._num_derivatives,
+                                            remaining), order='F', dtype=np.float32),
+                        sparseptr=np.empty(remaining, dtype=np.int32),
+                        makejvp=False,
+                        jvpvector=np.zeros((rte_solver._nbpts, rte_solver._num_derivatives)),
+                        makevjp=False,
+                        vjpweights=np.zeros((rte_solver._nstokes, total_pix - first)),
+                        usestokesin=precomputed_stokes,
+                        stokesin=stokes_in[:, first:]
+                    )
+                sparse_values = np.concatenate((sparse_values[..., :stored], remaining_values),
+                                               axis=-1)
+                sparse_ptr = np.concatenate((sparse_ptr[:stored], remaining_ptr))
+                pixel_ptr = np.concatenate((pixel_ptr[:first], remaining_pixel_ptr + stored))
+            if total_pix > 0:
+                self._sparse_density[rte_solver.wavelength] = nnz/total_pix
+            jacobian = make_sparse_jacobian(sparse_values[..., :nnz], sparse_ptr[:nnz],
+                                            pixel_ptr, rte_solver._nbpts)
 
         integrated_rays = sensor.copy(deep=True)
         data = {}
@@ -325,17 +431,89 @@ class LevisApproxGradient:
         for key, val in data.items():
             integrated_rays[key] = val
 
-        if not jacobian_flag:
+        if not (jacobian_flag or sparse_jacobian):
             jacobian = None
         return gradient, loss, integrated_rays, jacobian
 
+    def levis_approximation_products(self, rte_solver, sensor, vector=None, weights=None,
+                                     exact_single_scatter=True):
+        """
+        Calculates the products of the Frechet derivatives (under the Levis approximation)
+        of the pixels of `sensor` with vectors, without forming the Jacobian.
 
+        Parameters
+        ----------
+        rte_solver : pyshdom.solver.RTE
+            Should be solved and have its derivatives prepared
+            (see LevisApproxGradient._prep_gradient).
+        sensor : xr.Dataset
+            The same sensor as in LevisApproxGradient.levis_approximation_grad.
+        vector : np.ndarray, shape=(nbpts, numder)
+            If not None, the Jacobian-vector product with `vector` is calculated.
+        weights : np.ndarray, shape=(nstokes, npixels)
+            If not None, the vector-Jacobian product with `weights` is calculated.
+        exact_single_scatter : bool
+            Whether to calculate the single scattering contribution to the derivatives
+            exactly.
 
-    def __call__(self):
+        Returns
+        -------
+        jvp : np.ndarray, shape=(nstokes, npixels)
+            The Jacobian-vector product (zeros if `vector` is None).
+        vjp : np.ndarray, shape=(nbpts, numder)
+            The vector-Jacobian product (zeros if `weights` is None).
+        """
+        total_pix = sensor.sizes['npixels']
+        longradiance = self._longradiance
+        if longradiance is None or longradiance.shape != (rte_solver._nstokes, rte_solver._npts):
+            longradiance = np.zeros((rte_solver._nstokes, rte_solver._npts), dtype=np.float32,
+                                    order='F')
+        output = _levisapprox_gradient(
+            rte_solver,
+            camx=sensor['ray_x'].data,
+            camy=sensor['ray_y'].data,
+            camz=sensor['ray_z'].data,
+            cammu=sensor['ray_mu'].data,
+            camphi=sensor['ray_phi'].data,
+            npix=total_pix,
+            costfunc=self.gradient_kwargs['cost_function'],
+            ncost=1,
+            ngrad=1,
+            nuncertainty=sensor['num_uncertainty'].size,
+            uncertainties=sensor['uncertainties'].data,
+            rays_per_pixel=sensor['rays_per_pixel'].data,
+            ray_weights=sensor['ray_weight'].data,
+            stokes_weights=sensor['stokes_weights'].data,
+            exact_single_scatter=exact_single_scatter,
+            measurements=sensor['measurement_data'].data,
+            jacobian=np.empty((rte_solver._nstokes, rte_solver._num_derivatives, 1, 1),
+                              order='F', dtype=np.float32),
+            jacobianptr=np.zeros(1),
+            num_jacobian_pts=1,
+            makejacobian=False,
+            longradiance=longradiance,
+            uselongrad=self._uselongrad,
+            tautol=self._tautol,
+            makesparse=False,
+            maxnnz=1,
+            sparsejac=np.empty((rte_solver._nstokes, rte_solver._num_derivatives, 1),
+                               order='F', dtype=np.float32),
+            sparseptr=np.empty(1, dtype=np.int32),
+            makejvp=vector is not None,
+            jvpvector=np.zeros((rte_solver._nbpts, rte_solver._num_derivatives))
+            if vector is None else vector,
+            makevjp=weights is not None,
+            vjpweights=np.zeros((rte_solver._nstokes, total_pix)) if weights is None else weights,
+            usestokesin=False,
+            stokesin=np.zeros((rte_solver._nstokes, total_pix), dtype=np.float32, order='F')
+        )
+        return output[-2], output[-1]
+
+    def __call__(self, precomputed_stokes=False):
         """
         A method to be overwritten in inheritance.
         """
-        outputs = self._prep_gradient()
+        outputs = self._prep_gradient(precomputed_stokes=precomputed_stokes)
         return outputs, None, None
 
 class LevisApproxGradientUncorrelated(LevisApproxGradient):
@@ -345,26 +523,252 @@ class LevisApproxGradientUncorrelated(LevisApproxGradient):
 
     This is the default method to use.
     """
-    def __call__(self):
+    def __call__(self, precomputed_stokes=False):
 
-        loss, gradient, other_outputs = self._prep_gradient()
+        loss, gradient, other_outputs = self._prep_gradient(precomputed_stokes=precomputed_stokes)
         #uncorrelated among the output of all (possibly parallel) workers.
         #if wanting to impose error correlations between wavelengths etc
         #then make a new class with a modified __call__ method.
         loss = np.sum(loss) / self.forward_sensors.nmeasurements
         gradient = np.sum(gradient, axis=-1) / self.forward_sensors.nmeasurements
         #turn gradient into a gridded dataset for use in project_gradient_to_state
-        gradient_dataset = make_gradient_dataset(gradient, self.unknown_scatterers, self.solvers)
+        gradient_dataset = make_gradient_dataset(gradient, self.unknown_scatterers, self._local_solvers)
         if other_outputs:
             jacobian_dataset = make_jacobian_dataset(
                 other_outputs[0], self.unknown_scatterers,
-                self.gradient_kwargs['indices_for_jacobian'], self.solvers, self._rte_sensors
+                self.gradient_kwargs.get('indices_for_jacobian'), self._local_solvers,
+                self._rte_sensors
                 )
         else:
             jacobian_dataset = None
 
         return loss, gradient_dataset, jacobian_dataset
 
+    def linearize(self):
+        """
+        Linearizes the weighted residuals about the state of the latest evaluation
+        of `self` for Gauss-Newton type optimization.
+
+        The cost function is 0.5*||residual||**2 for the returned residual and
+        its gradient is operator.T @ residual. Products with the operator are
+        calculated with LevisApproxGradient.levis_approximation_products, so each product
+        costs a pass through the rays but no RTE solutions.
+
+        Returns
+        -------
+        operator : scipy.sparse.linalg.LinearOperator, shape=(nrows, nbpts*numder)
+            The weighted Jacobian. The rows are ordered like the sparse Jacobian
+            (see make_sparse_jacobian) with the solvers in the order of `self.solvers`
+            and the columns like the raveled (nbpts, numder) gradient.
+        residual : np.ndarray, shape=(nrows,)
+            The weighted difference between the synthetic and actual measurements.
+
+        Raises
+        ------
+        NotImplementedError
+            If the cost function is not 'L2', MPI is used or the pixels are sampled
+            (`batch_kwargs`).
+        ValueError
+            If `self` has not been evaluated.
+        """
+        if self.gradient_kwargs['cost_function'] != 'L2':
+            raise NotImplementedError(
+                "Only the 'L2' cost function can be linearized not '{}'".format(
+                    self.gradient_kwargs['cost_function']))
+        if self.parallel_solve_kwargs.get('mpi_comm') is not None:
+            raise NotImplementedError("Linearization is not supported with MPI.")
+        if self.batch_kwargs is not None:
+            raise NotImplementedError(
+                "Linearization is not supported when the pixels are sampled.")
+        if self._rte_sensors is None:
+            raise ValueError("The gradient must be evaluated before it is linearized.")
+
+        n_jobs = self.parallel_solve_kwargs.get('n_jobs', 1)
+        exact_single_scatter = self.gradient_kwargs.get('exact_single_scatter', True)
+        nmeasurements = self.forward_sensors.nmeasurements
+        keys = list(self._local_solvers)
+        row_weights = []
+        residuals = []
+        for key in keys:
+            rte_sensor = self._rte_sensors[key]
+            nstokes = rte_sensor.sizes['nstokes']
+            #UPDATE_COSTFUNCTION weights the squared error of each Stokes component
+            #by the sum of its row of the inverse error-covariance.
+            weights = rte_sensor.uncertainties.data[:nstokes, :nstokes].sum(axis=1)
+            weights = np.sqrt(np.maximum(weights, 0.0)/nmeasurements)
+            model = self._forward_stokes(self._sensor_mapping[key], nstokes)
+            row_weights.append(weights)
+            residuals.append(
+                (weights*(model - rte_sensor.measurement_data.data)).T.ravel())
+        row_splits = np.cumsum([residual.size for residual in residuals])[:-1]
+        solver = self._local_solvers[keys[0]]
+        grid_shape = (solver._nbpts, solver._num_derivatives)
+
+        def products(vector=None, weights_list=None):
+            out = Parallel(n_jobs=n_jobs, backend='threading')(
+                delayed(self.levis_approximation_products)(
+                    self._local_solvers[key], self._rte_sensors[key], vector=vector,
+                    weights=None if weights_list is None else weights_list[i],
+                    exact_single_scatter=exact_single_scatter)
+                for i, key in enumerate(keys))
+            return out
+
+        def matvec(vector):
+            vector = np.asarray(vector, dtype=np.float64).reshape(grid_shape)
+            out = products(vector=vector)
+            return np.concatenate([(weights*jvp).T.ravel()
+                                   for weights, (jvp, _) in zip(row_weights, out)])
+
+        def rmatvec(residual):
+            residual = np.asarray(residual, dtype=np.float64).ravel()
+            weights_list = [weights*block.reshape(weights.shape[::-1]).T
+                            for weights, block in zip(row_weights,
+                                                      np.split(residual, row_splits))]
+            out = products(weights_list=weights_list)
+            return np.sum([vjp for _, vjp in out], axis=0).ravel()
+
+        residual = np.concatenate(residuals)
+        operator = scipy.sparse.linalg.LinearOperator(
+            shape=(residual.size, np.prod(grid_shape)), matvec=matvec, rmatvec=rmatvec,
+            dtype=np.float64)
+        return operator, residual
+
+def _levisapprox_gradient(rte_solver, **kwargs):
+    """
+    Calls pyshdom.core.levisapprox_gradient with the solution and derivative arrays of
+    `rte_solver` and the rays, measurements and output options in `kwargs`.
+    See LevisApproxGradient.levis_approximation_grad.
+    """
+    return pyshdom.core.levisapprox_gradient(
+        diphaseind=rte_solver._diphaseind,
+        nstphase=rte_solver._nstphase,
+        dpath=rte_solver._direct_derivative_path,
+        dptr=rte_solver._direct_derivative_ptr,
+        npx=rte_solver._pa.npx,
+        npy=rte_solver._pa.npy,
+        npz=rte_solver._pa.npz,
+        delx=rte_solver._pa.delx,
+        dely=rte_solver._pa.dely,
+        xstart=rte_solver._pa.xstart,
+        ystart=rte_solver._pa.ystart,
+        zlevels=rte_solver._pa.zlevels,
+        extdirp=rte_solver._pa.extdirp,
+        uniformzlev=rte_solver._uniformzlev,
+        partder=rte_solver._unknown_scatterer_indices,
+        numder=rte_solver._num_derivatives,
+        dext=rte_solver._dext,
+        dalb=rte_solver._dalb,
+        diphase=rte_solver._diphase,
+        dleg=rte_solver._dleg,
+        dphasetab=rte_solver._dphasetab,
+        dnumphase=rte_solver._dnumphase,
+        nscatangle=rte_solver._nscatangle,
+        phasetab=rte_solver._phasetab,
+        ylmsun=rte_solver._ylmsun,
+        nstokes=rte_solver._nstokes,
+        nstleg=rte_solver._nstleg,
+        nx=rte_solver._nx,
+        ny=rte_solver._ny,
+        nz=rte_solver._nz,
+        bcflag=rte_solver._bcflag,
+        ipflag=rte_solver._ipflag,
+        npts=rte_solver._npts,
+        nbpts=rte_solver._nbpts,
+        ncells=rte_solver._ncells,
+        nbcells=rte_solver._nbcells,
+        ml=rte_solver._ml,
+        mm=rte_solver._mm,
+        ncs=rte_solver._ncs,
+        nlm=rte_solver._nlm,
+        numphase=rte_solver._pa.numphase,
+        nmu=rte_solver._nmu,
+        nphi0max=rte_solver._nphi0max,
+        nphi0=rte_solver._nphi0,
+        maxnbc=rte_solver._maxnbc,
+        ntoppts=rte_solver._ntoppts,
+        nbotpts=rte_solver._nbotpts,
+        nsfcpar=rte_solver._nsfcpar,
+        gridptr=rte_solver._gridptr,
+        neighptr=rte_solver._neighptr,
+        treeptr=rte_solver._treeptr,
+        shptr=rte_solver._shptr,
+        bcptr=rte_solver._bcptr,
+        cellflags=rte_solver._cellflags,
+        iphase=rte_solver._iphase[:rte_solver._npts],
+        deltam=rte_solver._deltam,
+        solarflux=rte_solver._solarflux,
+        solarmu=rte_solver._solarmu,
+        solaraz=rte_solver._solaraz,
+        gndtemp=rte_solver._gndtemp,
+        gndalbedo=rte_solver._gndalbedo,
+        skyrad=rte_solver._skyrad,
+        waveno=rte_solver._waveno,
+        wavelen=rte_solver.wavelength,
+        mu=rte_solver._mu,
+        phi=rte_solver._phi,
+        wtdo=rte_solver._wtdo,
+        xgrid=rte_solver._xgrid,
+        ygrid=rte_solver._ygrid,
+        zgrid=rte_solver._zgrid,
+        gridpos=rte_solver._gridpos,
+        sfcgridparms=rte_solver._sfcgridparms,
+        bcrad=copy.deepcopy(rte_solver._bcrad),
+        extinct=rte_solver._extinct[:rte_solver._npts],
+        albedo=rte_solver._albedo[:rte_solver._npts],
+        legen=rte_solver._legen,
+        dirflux=rte_solver._dirflux[:rte_solver._npts],
+        fluxes=rte_solver._fluxes,
+        source=rte_solver._uncompressed('_source'),
+        srctype=rte_solver._srctype,
+        sfctype=rte_solver._sfctype,
+        units=rte_solver._units,
+        rshptr=rte_solver._rshptr,
+        radiance=rte_solver._uncompressed('_radiance'),
+        total_ext=rte_solver._total_ext[:rte_solver._npts],
+        planck=rte_solver._planck[:rte_solver._npts],
+        **kwargs
+    )
+
+def make_sparse_jacobian(values, grid_ptr, pixel_ptr, nbpts):
+    """
+    Assembles the sparse Jacobian output by pyshdom.core.levisapprox_gradient
+    into a scipy.sparse matrix.
+
+    Row `ipixel*nstokes + istokes` holds the derivatives of Stokes component `istokes`
+    of pixel `ipixel` and column `igrid*numder + ideriv` the derivatives with respect
+    to unknown `ideriv` at base grid point `igrid`, which matches the raveled
+    (nbpts, numder) gradient.
+
+    Parameters
+    ----------
+    values : np.ndarray, shape=(nstokes, numder, nnz)
+        The derivatives of each (pixel, base grid point) entry.
+    grid_ptr : np.ndarray, shape=(nnz,)
+        The (1-based) base grid point of each entry.
+    pixel_ptr : np.ndarray, shape=(npixels+1,)
+        The (1-based) first entry of each pixel in compressed sparse row format.
+    nbpts : int
+        The number of base grid points.
+
+    Returns
+    -------
+    jacobian : scipy.sparse.csr_matrix, shape=(npixels*nstokes, nbpts*numder)
+        The Jacobian.
+    """
+    nstokes, numder, nnz = values.shape
+    npixels = pixel_ptr.size - 1
+    pixels = np.repeat(np.arange(npixels), np.diff(pixel_ptr))
+    rows = np.broadcast_to(pixels*nstokes + np.arange(nstokes)[:, None, None],
+                           values.shape)
+    columns = np.broadcast_to((grid_ptr.astype(np.int64) - 1)*numder + np.arange(numder)[:, None],
+                              values.shape)
+    jacobian = scipy.sparse.csr_matrix(
+        (values.ravel(), (rows.ravel(), columns.ravel())),
+        shape=(npixels*nstokes, nbpts*numder)
+        )
+    jacobian.eliminate_zeros()
+    return jacobian
+
 def make_gradient_dataset(gradient, unknown_scatterers, solvers):
     """
     A utility function that forms an xr.Dataset for the gradient
@@ -429,12 +833,14 @@ def make_jacobian_dataset(jacobian_list, unknown_scatterers, indices_for_jacobia
     Parameters
     ----------
     jacobian_list : List
-        List of Jacobian arrays (possibly from parallel workers).
+        List of Jacobian arrays or sparse Jacobians (see make_sparse_jacobian)
+        (possibly from parallel workers).
     unknown_scatterers : pyshdom.containers.UnknownScatterers
         Contains the information for defining the names and variables
         that derivatives have been calculated for.
     indices_for_jacobian : Tuple
         The indices for which grid points to save the Jacobian for.
+        Unused for sparse Jacobians.
     solvers : pyshdom.containers.SolversDict
         Contains the solver.RTE objects that were used to calculate the gradient.
         This is only used to verify consistency between `unknown_scatterers`
@@ -446,7 +852,11 @@ def make_jacobian_dataset(jacobian_list, unknown_scatterers, indices_for_jacobia
     Returns
     -------
     jacobian_dataset : xr.Dataset
-        The dataset containing the Frechet derivatives.
+        The dataset containing the Frechet derivatives. Sparse Jacobians are stored
+        in coordinate format: the nonzero values 'jacobian_{key}' and their
+        'row_{key}' and 'column_{key}' (see make_sparse_jacobian), which can be
+        assembled with
+        scipy.sparse.coo_matrix((values, (rows, columns)), shape=values.attrs['shape']).
 
     Raises
     ------
@@ -454,6 +864,42 @@ def make_jacobian_dataset(jacobian_list, unknown_scatterers, indices_for_jacobia
         If `solvers` and `unknown_scatterers` have inconsistent representations
         of which scattering species gradients have been calculated for.
     """
+    derivative_names = []
+    unknown_scatterer_names2 = []
+    for name, values in unknown_scatterers.items():
+        for variable_name in values['variable_name_list']:
+            derivative_names.append(variable_name)
+            unknown_scatterer_names2.append(name)
+    unknown_scatterer_indices = list(solvers.values())[0]._unknown_scatterer_indices - 1
+    unknown_scatterer_names = np.array(list(list(solvers.values())[0].medium.keys()))[unknown_scatterer_indices]
+    assert np.all(unknown_scatterer_names == np.atleast_1d(unknown_scatterer_names2)), 'Two different ways of listing unknown scatterer names do not match.'
+    derivative_index = pd.MultiIndex.from_arrays([unknown_scatterer_names, derivative_names], names=("scatterer_name", "variable_name"))
+    grid = list(solvers.values())[0]._grid
+
+    if scipy.sparse.issparse(jacobian_list[0]):
+        merged_jacobian = scipy.sparse.vstack(jacobian_list, format='csr')
+        data_vars = {}
+        start = 0
+        for wavelength, rte_sensor in rte_sensors.items():
+            end = start + rte_sensor.sizes['npixels']*rte_sensor.sizes['nstokes']
+            jacobian = merged_jacobian[start:end].tocoo()
+            nnz_dim = 'nnz_{:1.3f}'.format(wavelength)
+            data_vars['jacobian_{:1.3f}'.format(wavelength)] = xr.DataArray(
+                jacobian.data, dims=[nnz_dim], attrs={'shape': jacobian.shape})
+            data_vars['row_{:1.3f}'.format(wavelength)] = ([nnz_dim], jacobian.row)
+            data_vars['column_{:1.3f}'.format(wavelength)] = ([nnz_dim], jacobian.col)
+            start = end
+        jacobian_dataset = xr.Dataset(
+            data_vars=data_vars,
+            coords={
+                'x': grid.x,
+                'y': grid.y,
+                'z': grid.z,
+                'derivative_index': derivative_index
+            }
+        )
+        return jacobian_dataset
+
     merged_jacobian = np.concatenate(jacobian_list, axis=-1)
     split_indices = []
     for rte_sensor in rte_sensors.values():
@@ -462,27 +908,15 @@ def make_jacobian_dataset(jacobian_list, unknown_scatterers, indices_for_jacobia
     split_indices = np.cumsum(split_indices) #TODO verify that no +1 needs to be added etc.
     split_jacobian = np.split(merged_jacobian, split_indices, axis=-1)[:-1] #TODO verify the [:-1]
 
-    grid = list(solvers.values())[0]._grid
     grid_index = pd.MultiIndex.from_arrays([grid.x.data[indices_for_jacobian[0]],
                                             grid.y.data[indices_for_jacobian[1]],
                                             grid.z.data[indices_for_jacobian[2]]],
                                            names=("x", "y", "z"))
 
-    derivative_names = []
-    unknown_scatterer_names2 = []
-    for name, values in unknown_scatterers.items():
-        for variable_name in values['variable_name_list']:
-            derivative_names.append(variable_name)
-            unknown_scatterer_names2.append(name)
-    unknown_scatterer_indices = list(solvers.values())[0]._unknown_scatterer_indices - 1
-    unknown_scatterer_names = np.array(list(list(solvers.values())[0].medium.keys()))[unknown_scatterer_indices]
-    assert np.all(unknown_scatterer_names == np.atleast_1d(unknown_scatterer_names2)), 'Two different ways of listing unknown scatterer names do not match.'
-    derivative_index = pd.MultiIndex.from_arrays([unknown_scatterer_names, derivative_names], names=("scatterer_name", "variable_name"))
-
     jacobian_dataset = xr.Dataset(
                                 data_vars ={
                                 'jacobian_{:1.3f}'.format(wavelength): (['nstokes', 'derivative_index', 'grid_index', 'npixels_{:1.3f}'.format(wavelength)], jacobian)
-                                    for wavelength, jacobian in zip(solvers.keys(), split_jacobian)
+                                    for wavelength, jacobian in zip(rte_sensors.keys(), split_jacobian)
                                 },
                     coords={
                         'grid_index': grid_index,
@@ -11,7 +11,8 @@ import numpy as np
 import xarray as xr
 import pyshdom.checks
 
-def table_to_grid(microphysics, poly_table, exact_table=False, inverse_mode=False):
+def table_to_grid(microphysics, poly_table, exact_table=False, inverse_mode=False,
+                  subset_table=True):
     """
     Calculates optical properties from microphysical properties using a Look-Up-Table.
 
@@ -37,6 +38,11 @@ def table_to_grid(microphysics, poly_table, exact_table=False, inverse_mode=Fals
         to microphysical properties are being interpolated.
         The only difference is that extinction_efficiency passed instead of
         extinction.
+    subset_table : bool
+        If True then only the phase functions that are used on the grid are
+        output and the 'table_index' points into this subset. If False then
+        all phase functions in `poly_table` are output, which is independent
+        of the microphysics (see solver.RTE.calculate_microphysical_partial_derivatives).
 
     Returns
     -------
@@ -93,7 +99,11 @@ def table_to_grid(microphysics, poly_table, exact_table=False, inverse_mode=Fals
     table_index = poly_table.coords['table_index'].interp(
         coords=interp_coords, method='nearest'
         ).round().astype(int)
-    unique_table_indices, inverse = np.unique(table_index.data, return_inverse=True)
+    if subset_table:
+        unique_table_indices, inverse = np.unique(table_index.data, return_inverse=True)
+    else:
+        unique_table_indices = slice(None)
+        inverse = table_index.data
     subset_table_index = xr.DataArray(name=table_index.name,
                                       data=inverse.reshape(table_index.shape) + 1,
                                       dims=table_index.dims,
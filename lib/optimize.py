@@ -3,11 +3,15 @@ Defines the high level abstract objects for handling solving
 the inverse problem including.
 """
 
+import sys
 import time
+import traceback
 import scipy.optimize
+import scipy.sparse.linalg
 import numpy as np
 
 import pyshdom.gradient
+import pyshdom.checks
 
 class ObjectiveFunction:
     """
@@ -24,19 +28,56 @@ class ObjectiveFunction:
     min_bounds :
 
     max_bounds :
+
+    trusted_checks : bool
+        If True then `loss_fn` is evaluated within pyshdom.checks.trusted so
+        that checks of the values of inputs (e.g. in pyshdom.medium.table_to_grid
+        and solver.RTE) are skipped for datasets with the same structure as those
+        already validated, e.g. when the initial state was set up.
+    linear_fn : callable
+        If not None, a function which takes the state (at which `loss_fn` was last
+        evaluated) and returns a scipy.sparse.linalg.LinearOperator and a residual vector
+        such that the data misfit is 0.5*||residual||**2 and its gradient is
+        operator.T @ residual. Required by Optimizer.gauss_newton.
     """
-    def __init__(self, measurements, loss_fn, min_bounds=None, max_bounds=None):
+    def __init__(self, measurements, loss_fn, min_bounds=None, max_bounds=None,
+                 trusted_checks=True, linear_fn=None):
         self.measurements = measurements
         self.loss_fn = loss_fn
+        self.linear_fn = linear_fn
         self._bounds = list(zip(np.atleast_1d(min_bounds), np.atleast_1d(max_bounds)))
         self._loss = None
+        self.trusted_checks = trusted_checks
 
     def __call__(self, state):
 
-        loss, gradient = self.loss_fn(state, self.measurements)
+        with pyshdom.checks.trusted(self.trusted_checks):
+            loss, gradient = self.loss_fn(state, self.measurements)
         self._loss = loss
         return loss, gradient
 
+    def linearize(self, state):
+        """
+        Linearizes the data misfit about `state`, which should be the state
+        that `self` was last evaluated at.
+
+        Returns
+        -------
+        operator : scipy.sparse.linalg.LinearOperator
+            The (weighted) Jacobian of the residual with respect to the state.
+        residual : np.ndarray
+            The (weighted) residual.
+
+        Raises
+        ------
+        ValueError
+            If no `linear_fn` was supplied.
+        """
+        if self.linear_fn is None:
+            raise ValueError("A `linear_fn` is required to linearize the objective function.")
+        with pyshdom.checks.trusted(self.trusted_checks):
+            return self.linear_fn(state)
+
     # @classmethod
     # def Flexible(cls, measurements, gradient_fn, set_state_fn, project_gradient_to_state_fn,
     #                 min_bounds=None, max_bounds=None):
@@ -57,7 +98,8 @@ class ObjectiveFunction:
                                   'verbose':True, 'maxiter':100, 'init_solution':True},
                                   gradient_kwargs={'cost_function': 'L2', 'exact_single_scatter':True},
                                   uncertainty_kwargs={'add_noise': False},
-                                  min_bounds=None, max_bounds=None):
+                                  min_bounds=None, max_bounds=None, mpi_root=None,
+                                  project_state_to_grid=None, batch_kwargs=None):
         """
         Use the Levis approximation to the linearization of an least squares cost function.
         Only error covariances between Stokes components for the same pixel are supported.
@@ -98,6 +140,25 @@ class ObjectiveFunction:
 
         max_bounds : TODO
 
+        mpi_root : int
+            When using MPI (`mpi_comm` in `parallel_solve_kwargs`) with a persistent
+            pool of workers (see Optimizer) this should be the rank driving the optimization
+            (0) so that the synthetic measurements are only gathered to that rank.
+            If None, they are gathered to all ranks.
+        project_state_to_grid : callable
+            If not None, a function which takes the state and a perturbation of the state
+            and returns the perturbation of the gridded unknowns, shaped like the gridded
+            gradient (x, y, z, derivative_index). It is the transpose of
+            `project_gradient_to_state` and is used to linearize the objective function
+            (see pyshdom.gradient.LevisApproxGradientUncorrelated.linearize) for
+            Optimizer.gauss_newton.
+        batch_kwargs : dict
+            If not None, the data misfit and its gradient are estimated from a random
+            subset of the pixels at each evaluation for use with Optimizer.stochastic_gradient.
+            The keys are 'fraction' (of the pixels or sensors to sample), 'sampling'
+            ('pixels' or 'sensors') and 'seed' (for reproducible sampling).
+            See pyshdom.containers.SensorsDict.sample_sensors.
+
         Returns
         -------
         An instance of ObjectiveFunction.
@@ -110,7 +171,7 @@ class ObjectiveFunction:
         """
         gradient_fun = pyshdom.gradient.LevisApproxGradientUncorrelated(
             measurements, solvers, forward_sensors, unknown_scatterers, parallel_solve_kwargs,
-            gradient_kwargs, uncertainty_kwargs)
+            gradient_kwargs, uncertainty_kwargs, mpi_root=mpi_root, batch_kwargs=batch_kwargs)
 
         def loss_function(state, measurements):
 
@@ -129,7 +190,30 @@ class ObjectiveFunction:
             state_gradient = project_gradient_to_state(state, gradient)
             return loss, state_gradient
 
-        return cls(measurements, loss_function, min_bounds=min_bounds, max_bounds=max_bounds)
+        linear_function = None
+        if project_state_to_grid is not None:
+            def linear_function(state):
+                grid_operator, residual = gradient_fun.linearize()
+                solver = list(gradient_fun._local_solvers.values())[0]
+                grid_shape = (solver._nbpts, solver._num_derivatives)
+
+                def matvec(vector):
+                    return grid_operator.matvec(
+                        np.ravel(project_state_to_grid(state, np.ravel(vector))))
+
+                def rmatvec(residual):
+                    gradient = pyshdom.gradient.make_gradient_dataset(
+                        grid_operator.rmatvec(residual).reshape(grid_shape),
+                        unknown_scatterers, gradient_fun._local_solvers)
+                    return np.ravel(project_gradient_to_state(state, gradient))
+
+                operator = scipy.sparse.linalg.LinearOperator(
+                    shape=(residual.size, np.size(state)), matvec=matvec, rmatvec=rmatvec,
+                    dtype=np.float64)
+                return operator, residual
+
+        return cls(measurements, loss_function, min_bounds=min_bounds, max_bounds=max_bounds,
+                   linear_fn=linear_function)
 
     @property
     def loss(self):
@@ -175,6 +259,19 @@ class PriorFunction:
 class Optimizer:
     """
     Optmizer wrapps the scipy optimization methods.
+
+    If `mpi_comm` is supplied then the optimization runs with a persistent pool
+    of MPI workers. The root rank (0) runs the scipy optimization while the other
+    ranks wait in Optimizer.minimize for the state vector to be broadcast at each
+    evaluation of the objective function. Each rank keeps its solver.RTE objects
+    resident between evaluations (the `objective_fn` is evaluated on all ranks so
+    should be defined with the same `mpi_comm`, e.g. ObjectiveFunction.LevisApproxUncorrelatedL2
+    with `mpi_root`=0) so only the state vector is broadcast and only the loss and
+    gradient are reduced. The priors and callbacks are only evaluated on the root rank.
+    If the root rank raises an error between evaluations the workers are released,
+    while an error during an evaluation (on any rank) aborts all ranks as the others may be
+    waiting in a collective operation of the evaluation that will never complete.
+
     Notes
     -----
     For documentation:
@@ -185,7 +282,8 @@ class Optimizer:
                  prior_fn=None,
                  callback_fn=None,
                  method='L-BFGS-B',
-                 options={'maxiter': 100, 'maxls': 10, 'disp': True, 'gtol': 1e-16, 'ftol': 1e-8}
+                 options={'maxiter': 100, 'maxls': 10, 'disp': True, 'gtol': 1e-16, 'ftol': 1e-8},
+                 mpi_comm=None
                  ):
 
         self._method = method
@@ -196,6 +294,7 @@ class Optimizer:
         self._callback = None if callback_fn is None else self.callback
         self._iteration = None
         self._state = None
+        self._mpi_comm = mpi_comm
 
     def callback(self, state): #TODO check whether the callback function below should call state.
         """
@@ -210,8 +309,15 @@ class Optimizer:
         The callback function invokes the callbacks defined by the writer (if any).
         Additionally it keeps track of the iteration number.
         """
+        if self._mpi_comm is not None:
+            #wake the workers waiting in _worker_loop.
+            state = self._mpi_comm.bcast(state, root=0)
         self._state = state
-        loss, gradient = self._objective_fn(state)
+        try:
+            loss, gradient = self._objective_fn(state)
+        except Exception:
+            self._abort()
+            raise
         if self._prior_fn is not None:
             p_loss = []
             p_gradient = []
@@ -227,7 +333,13 @@ class Optimizer:
     def minimize(self, initial_state, iteration_step=0, **kwargs):
         """
         Local minimization with respect to the parameters defined.
+
+        When using a persistent pool of MPI workers, the workers return None
+        once the root rank has finished the optimization.
         """
+        if self._mpi_comm is not None and self._mpi_comm.Get_rank() != 0:
+            self._worker_loop()
+            return None
         self._iteration = iteration_step
         args = {
             'fun': self.objective,
@@ -246,9 +358,259 @@ class Optimizer:
                 args['bounds'] = self._objective_fn.bounds
             else:
                 print('No bounds used.')
-        result = scipy.optimize.minimize(**args)
+        try:
+            result = scipy.optimize.minimize(**args)
+        finally:
+            if self._mpi_comm is not None:
+                #release the workers.
+                self._mpi_comm.bcast(None, root=0)
         return result
 
+    def gauss_newton(self, initial_state, maxiter=10, damping=0.0, damping_factor=10.0,
+                     linear_solver='lsqr', linear_maxiter=20, max_rejections=5, gtol=1e-16,
+                     ftol=1e-10, xtol=1e-12, iteration_step=0):
+        """
+        Local minimization with the Gauss-Newton (`damping` = 0) or Levenberg-Marquardt
+        method using the linearization of the objective function
+        (see ObjectiveFunction.linearize).
+
+        Each step solves the damped normal equations with products with the Jacobian
+        rather than forming it, so each iteration only needs one evaluation of the
+        objective function unless the step is rejected.
+
+        Parameters
+        ----------
+        initial_state : np.ndarray
+            The state to start the optimization from.
+        maxiter : int
+            The maximum number of (accepted) iterations.
+        damping : float
+            The initial Levenberg-Marquardt damping. It is divided by `damping_factor`
+            after each accepted step and multiplied by it after each rejected step.
+        damping_factor : float
+            See `damping`.
+        linear_solver : str
+            'lsqr' to solve the damped least squares problem with scipy.sparse.linalg.lsqr
+            or 'cg' to solve the normal equations with scipy.sparse.linalg.cg. 'cg' is
+            always used if there are priors as only their gradient is included.
+        linear_maxiter : int
+            The maximum number of iterations of the linear solver (each needs a
+            Jacobian-vector and a vector-Jacobian product).
+        max_rejections : int
+            The maximum number of times that a step which doesn't decrease the loss
+            is rejected (and `damping` increased) before the optimization stops.
+        gtol : float
+            The optimization stops when the maximum absolute value of the gradient is
+            below this.
+        ftol : float
+            The optimization stops when the absolute change of the loss from a step is
+            below `ftol` times the loss.
+        xtol : float
+            The optimization stops when the norm of a step is below
+            `xtol` * (`xtol` + the norm of the state).
+        iteration_step : int
+            The number of the first iteration.
+
+        Returns
+        -------
+        result : scipy.optimize.OptimizeResult
+            The optimization result.
+
+        Raises
+        ------
+        NotImplementedError
+            If MPI is used.
+        ValueError
+            If `linear_solver` is not valid.
+
+        Notes
+        -----
+        Close to the minimum the loss of a step can be equal to (or, due to round-off,
+        slightly larger than) the current loss. Such steps satisfy `ftol` or `xtol` and
+        end the optimization successfully rather than being rejected.
+        """
+        if self._mpi_comm is not None:
+            raise NotImplementedError("Optimizer.gauss_newton is not supported with MPI.")
+        if linear_solver not in ('lsqr', 'cg'):
+            raise ValueError("`linear_solver` should be 'lsqr' or 'cg' not '{}'".format(linear_solver))
+        self._iteration = iteration_step
+        state = np.array(initial_state, dtype=np.float64)
+        lower, upper = -np.inf, np.inf
+        if len(self._objective_fn.bounds) == state.size:
+            lower = np.array([-np.inf if bound[0] is None else bound[0]
+                              for bound in self._objective_fn.bounds])
+            upper = np.array([np.inf if bound[1] is None else bound[1]
+                              for bound in self._objective_fn.bounds])
+
+        loss, gradient = self.objective(state)
+        nfev = 1
+        nit = 0
+        success = False
+        message = 'Maximum number of iterations reached.'
+        for nit in range(1, maxiter+1):
+            if np.max(np.abs(gradient)) <= gtol:
+                success = True
+                message = 'The gradient is below `gtol`.'
+                break
+            operator, residual = self._objective_fn.linearize(state)
+            converged = False
+            for _ in range(max_rejections + 1):
+                if linear_solver == 'lsqr' and self._prior_fn is None:
+                    step = scipy.sparse.linalg.lsqr(operator, -residual, damp=np.sqrt(damping),
+                                                    iter_lim=linear_maxiter)[0]
+                else:
+                    normal_operator = scipy.sparse.linalg.LinearOperator(
+                        shape=(state.size, state.size), dtype=np.float64,
+                        matvec=lambda vector: operator.rmatvec(operator.matvec(vector)) + \
+                            damping*vector)
+                    step = scipy.sparse.linalg.cg(normal_operator, -np.ravel(gradient),
+                                                  maxiter=linear_maxiter)[0]
+                trial_state = np.clip(state + step, lower, upper)
+                trial_loss, trial_gradient = self.objective(trial_state)
+                nfev += 1
+                if np.abs(loss - trial_loss) <= ftol*loss:
+                    converged = True
+                    message = 'The relative change of the loss is below `ftol`.'
+                elif np.linalg.norm(trial_state - state) <= xtol*(xtol + np.linalg.norm(state)):
+                    converged = True
+                    message = 'The relative step size is below `xtol`.'
+                if trial_loss < loss or converged:
+                    break
+                damping = damping*damping_factor if damping > 0.0 else 1.0e-3
+            else:
+                #leave the objective function evaluated at the best state.
+                loss, gradient = self.objective(state)
+                nfev += 1
+                message = 'The loss could not be decreased.'
+                break
+            if trial_loss <= loss:
+                state, loss, gradient = trial_state, trial_loss, trial_gradient
+                damping /= damping_factor
+                if self._callback is not None:
+                    self._callback(state)
+                else:
+                    self._iteration += 1
+            else:
+                #leave the objective function evaluated at the best state.
+                loss, gradient = self.objective(state)
+                nfev += 1
+            if converged:
+                success = True
+                break
+
+        return scipy.optimize.OptimizeResult(x=state, fun=loss, jac=gradient, nit=nit,
+                                             nfev=nfev, success=success, message=message)
+
+    def stochastic_gradient(self, initial_state, maxiter=100, learning_rate=1.0e-2,
+                            method='adam', beta1=0.9, beta2=0.999, epsilon=1.0e-8,
+                            iteration_step=0):
+        """
+        Local minimization with a stochastic gradient method (Adam or gradient
+        descent with momentum) for objective functions which are estimated from a random
+        subset of the measurements at each evaluation
+        (e.g. ObjectiveFunction.LevisApproxUncorrelatedL2 with `batch_kwargs`).
+
+        There is no line search so each iteration needs exactly one evaluation of
+        the objective function. The sampling is reproducible if the objective function
+        is seeded.
+
+        Parameters
+        ----------
+        initial_state : np.ndarray
+            The state to start the optimization from.
+        maxiter : int
+            The number of iterations.
+        learning_rate : float
+            The step size.
+        method : str
+            'adam' for the Adam method (Kingma and Ba 2015, https://arxiv.org/abs/1412.6980)
+            or 'sgd' for gradient descent with momentum.
+        beta1 : float
+            The decay rate of the moving average of the gradient (the momentum).
+        beta2 : float
+            The decay rate of the moving average of the squared gradient ('adam' only).
+        epsilon : float
+            Regularizes the division by the root mean squared gradient ('adam' only).
+        iteration_step : int
+            The number of the first iteration.
+
+        Returns
+        -------
+        result : scipy.optimize.OptimizeResult
+            The optimization result. `fun` and `jac` are the (stochastic) loss and
+            gradient from the last evaluation, i.e. at the state before the last step.
+
+        Raises
+        ------
+        NotImplementedError
+            If MPI is used.
+        ValueError
+            If `method` is not valid.
+        """
+        if self._mpi_comm is not None:
+            raise NotImplementedError("Optimizer.stochastic_gradient is not supported with MPI.")
+        if method not in ('adam', 'sgd'):
+            raise ValueError("`method` should be 'adam' or 'sgd' not '{}'".format(method))
+        self._iteration = iteration_step
+        state = np.array(initial_state, dtype=np.float64)
+        lower, upper = -np.inf, np.inf
+        if len(self._objective_fn.bounds) == state.size:
+            lower = np.array([-np.inf if bound[0] is None else bound[0]
+                              for bound in self._objective_fn.bounds])
+            upper = np.array([np.inf if bound[1] is None else bound[1]
+                              for bound in self._objective_fn.bounds])
+
+        first_moment = np.zeros(state.shape)
+        second_moment = np.zeros(state.shape)
+        loss, gradient = None, None
+        for nit in range(1, maxiter+1):
+            loss, gradient = self.objective(state)
+            gradient = np.reshape(gradient, state.shape)
+            first_moment = beta1*first_moment + (1.0 - beta1)*gradient
+            if method == 'adam':
+                second_moment = beta2*second_moment + (1.0 - beta2)*gradient**2
+                step = (first_moment/(1.0 - beta1**nit)) / \
+                    (np.sqrt(second_moment/(1.0 - beta2**nit)) + epsilon)
+            else:
+                step = first_moment
+            state = np.clip(state - learning_rate*step, lower, upper)
+            if self._callback is not None:
+                self._callback(state)
+            else:
+                self._iteration += 1
+
+        return scipy.optimize.OptimizeResult(x=state, fun=loss, jac=gradient, nit=maxiter,
+                                             nfev=maxiter, success=True,
+                                             message='Maximum number of iterations reached.')
+
+    def _worker_loop(self):
+        """
+        Evaluates the objective function on a persistent MPI worker for each state
+        broadcast by the root rank until the root rank broadcasts None.
+        """
+        while True:
+            state = self._mpi_comm.bcast(None, root=0)
+            if state is None:
+                break
+            self._state = state
+            try:
+                self._objective_fn(state)
+            except Exception:
+                self._abort()
+                raise
+
+    def _abort(self):
+        """
+        Aborts all MPI ranks after an error in the evaluation of the objective function.
+
+        The other ranks may be blocked in a collective operation of the evaluation
+        that this rank will not reach so they can't be released by broadcasting None.
+        """
+        if self._mpi_comm is not None and self._mpi_comm.Get_size() > 1:
+            traceback.print_exc()
+            sys.stderr.flush()
+            self._mpi_comm.Abort(1)
+
     #TODO add save method
 
     @property
@@ -1,17 +1,20 @@
 """
 This  module contains functions that are used to parallelize
 internal components of the processing. This includes parallelizing
-the gradient calculation and also the subdivision of a sensor
-into `n_jobs` for parallelization.
+the gradient calculation, the subdivision of a sensor
+into `n_jobs` for parallelization, the worker used to solve
+solver.RTE objects in separate processes and the scheduling of
+RTE solutions and rendering.
 """
 import inspect
 import warnings
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from joblib import Parallel, delayed
 import numpy as np
 
 def parallel_gradient(solvers, rte_sensors, sensor_mappings, forward_sensors, gradient_fun,
-                      mpi_comm=None, n_jobs=1, **kwargs):
+                      mpi_comm=None, n_jobs=1, mpi_root=None, balance_rays=False, **kwargs):
     """
     Parallelizes the evaluation of a gradient across several solvers and sensors.
 
@@ -31,16 +34,32 @@ def parallel_gradient(solvers, rte_sensors, sensor_mappings, forward_sensors, gr
         name and sensor index.
     forward_sensors : pyshdom.containers.SensorsDict
         Container for the synthetic measurements that will be stored by instrument
-        key and sensor index.
+        key and sensor index. If None, the synthetic measurements are not stored,
+        e.g. when `rte_sensors` are a random sample of the pixels
+        (see pyshdom.containers.SensorsDict.sample_sensors).
     gradient_fun : callable
         When evaluated, this function will return the loss, gradient and
         synthetic measurements.
-    mpi_comm : None
-        TODO
-        MPI-based parallelization for the gradient is not yet implemented.
+    mpi_comm : mpi4py.MPI.Intracomm
+        An MPI communicator for the MPI parallelization of the gradient. Each rank
+        evaluates `gradient_fun` only for the solvers it owns
+        (see pyshdom.containers.SolversDict.owned_by_rank), the losses and gradients are
+        summed across ranks with `Allreduce` and the synthetic measurements are gathered
+        so that `forward_sensors` is updated on every rank.
     n_jobs : int
         The number of parallel workers for which multi-threading will be used
-        to parallelize the evaluation of `gradient_fun`.
+        to parallelize the evaluation of `gradient_fun`. When `mpi_comm` is used,
+        this is the number of workers on each rank.
+    mpi_root : int
+        If not None, the synthetic measurements and other outputs are only gathered
+        to this rank and `forward_sensors` is only updated on this rank. This is used
+        when a single rank drives the optimization while the others are persistent
+        workers (see pyshdom.optimize.Optimizer).
+    balance_rays : bool
+        If True then the multi-threaded evaluation is divided into jobs of similar
+        estimated cost rather than similar numbers of rays. The costs are estimated
+        from the optical paths of the previous evaluation (see
+        pyshdom.containers.SolversDict.record_ray_costs).
     kwargs : dict
         Arguments to `gradient_fun`.
 
@@ -50,6 +69,8 @@ def parallel_gradient(solvers, rte_sensors, sensor_mappings, forward_sensors, gr
         The loss evaluated by `gradient_fun`
     gradient : np.ndarray, float
         The gradient of a specified cost function (determined by `gradient_fun`).
+        The last dimension is the number of parallel workers (or 1 if `mpi_comm` is used
+        as the gradient is already summed across ranks).
     jacobian : np.ndarray, optional
         Only returned if `gradient_fun`=`pyshdom.gradient.jacobian`
     """
@@ -72,46 +93,343 @@ def parallel_gradient(solvers, rte_sensors, sensor_mappings, forward_sensors, gr
                             "'{}'".format(name, gradient_fun.__name__))
 
     if mpi_comm is not None:
-        raise NotImplementedError
-
+        #each rank evaluates the gradient for the solvers it owns, which are the same
+        #solvers that it solved in SolversDict.parallel_solve.
+        local_solvers = solvers.owned_by_rank(mpi_comm)
+        local_sensors = OrderedDict([(key, rte_sensors[key]) for key in local_solvers])
+        npixels = sum([sensor.sizes['npixels'] for sensor in local_sensors.values()])
+        keys, out = _evaluate_gradient(local_solvers, local_sensors, gradient_fun,
+                                       n_jobs, npixels, grad_kwargs,
+                                       solvers.ray_costs(local_sensors) if balance_rays else None)
+        if balance_rays:
+            solvers.record_ray_costs(local_sensors, n_jobs=n_jobs)
+        loss, gradient, keys, out = _mpi_reduce_gradient(solvers, keys, out, mpi_comm,
+                                                         mpi_root=mpi_root)
     else:
-        if n_jobs == 1 or n_jobs >= forward_sensors.npixels:
-            out = [gradient_fun(solvers[key], rte_sensors[key], **grad_kwargs) for key in solvers]
-            keys = list(solvers.keys())
-        else:
-            #decide on the division of n_jobs among solvers based on total number of rays.
-            keys, ray_start_end, pixel_start_end = subdivide_raytrace_jobs(rte_sensors, n_jobs)
-            #for (key, sensor) in rte_sensors.items():
-                #print(key, sensor.npixels.size, sensor.nrays.size, sensor.pixel_index.data.min(), sensor.pixel_index.data.max())
-            #for key, (ray_start, ray_end), (pix_start, pix_end) in zip(keys, ray_start_end, pixel_start_end):
-                #print('ray', key, ray_start, ray_end)
-                #print('pixel', key, pix_start, pix_end)
-            out = Parallel(n_jobs=n_jobs, backend='threading')(
-                delayed(gradient_fun)(
-                    solvers[key],
-                    rte_sensors[key].sel(
-                        nrays=slice(ray_start, ray_end),
-                        npixels=slice(pix_start, pix_end)),
-                    **grad_kwargs)
-                for key, (ray_start, ray_end), (pix_start, pix_end) in
-                zip(keys, ray_start_end, pixel_start_end)
-                )
-
+        npixels = sum([sensor.sizes['npixels'] for sensor in rte_sensors.values()])
+        keys, out = _evaluate_gradient(solvers, rte_sensors, gradient_fun,
+                                       n_jobs, npixels, grad_kwargs,
+                                       solvers.ray_costs(rte_sensors) if balance_rays else None)
+        if balance_rays:
+            solvers.record_ray_costs(rte_sensors, n_jobs=n_jobs)
         gradient = np.stack([i[0] for i in out], axis=-1)
         loss = np.array([i[1] for i in out])
-        forward_model_output = [i[2] for i in out]
 
-        other_output = []
+    other_output = []
+    #out is empty on the ranks which are not `mpi_root`.
+    if out:
+        forward_model_output = [i[2] for i in out]
         for i in range(3, len(out[0])):
             if out[0][i] is not None:
                 other_output.append([entry[i] for entry in out])
 
         #modify forward sensors in place to contain updated forward model estimates.
-        forward_sensors.add_measurements_inverse(sensor_mappings, forward_model_output, keys)
+        if forward_sensors is not None:
+            forward_sensors.add_measurements_inverse(sensor_mappings, forward_model_output, keys)
 
     return loss, gradient, other_output
 
-def subdivide_raytrace_jobs(rte_sensors, n_jobs, job_factor=1):
+def _evaluate_gradient(solvers, rte_sensors, gradient_fun, n_jobs, npixels, grad_kwargs,
+                       ray_costs=None):
+    """
+    Evaluates `gradient_fun` for each solver in `solvers` using multi-threading.
+
+    See parallel_gradient for a description of the parameters. `npixels` is the
+    total number of pixels in `rte_sensors` and `ray_costs` is passed to
+    subdivide_raytrace_jobs.
+
+    Returns
+    -------
+    keys : list
+        The solver key for each element of `out`.
+    out : list
+        The output of `gradient_fun` for each (possibly subdivided) job.
+    """
+    if n_jobs == 1 or n_jobs >= npixels:
+        out = [gradient_fun(solvers[key], rte_sensors[key], **grad_kwargs) for key in solvers]
+        keys = list(solvers.keys())
+    else:
+        #decide on the division of n_jobs among solvers based on total number of rays.
+        keys, ray_start_end, pixel_start_end = subdivide_raytrace_jobs(rte_sensors, n_jobs,
+                                                                       ray_costs=ray_costs)
+        out = Parallel(n_jobs=n_jobs, backend='threading')(
+            delayed(gradient_fun)(
+                solvers[key],
+                rte_sensors[key].sel(
+                    nrays=slice(ray_start, ray_end),
+                    npixels=slice(pix_start, pix_end)),
+                **grad_kwargs)
+            for key, (ray_start, ray_end), (pix_start, pix_end) in
+            zip(keys, ray_start_end, pixel_start_end)
+            )
+    return keys, out
+
+def _mpi_reduce_gradient(solvers, keys, out, mpi_comm, mpi_root=None):
+    """
+    Combines the output of parallel_gradient from each MPI rank.
+
+    The losses and gradients are summed across ranks using `Allreduce`. The remaining
+    output (synthetic measurements and optional outputs such as the jacobian) is
+    gathered to all ranks (or only to `mpi_root`) and ordered by solver key as in
+    the serial case so that every rank holds the same `forward_sensors`.
+
+    Parameters
+    ----------
+    solvers : pyshdom.containers.SolversDict
+        All of the solvers, across all ranks.
+    keys : list
+        The solver key for each element of `out` evaluated on this rank.
+    out : list
+        The output of the gradient function for each job evaluated on this rank.
+    mpi_comm : mpi4py.MPI.Intracomm
+        The MPI communicator.
+    mpi_root : int
+        If not None, the rank to gather the remaining output to.
+
+    Returns
+    -------
+    loss : np.ndarray, shape=(1, ncost)
+        The loss summed across all ranks.
+    gradient : np.ndarray, shape=(nbpts, numder, ngrad, 1)
+        The gradient summed across all ranks.
+    keys : list
+        The solver key for each element of `out` across all ranks.
+    out : list
+        The output of the gradient function for each job across all ranks with the
+        (unreduced) loss and gradient replaced by None. Empty if this rank is
+        not `mpi_root`.
+
+    Raises
+    ------
+    ValueError
+        If no rank evaluated the gradient of any solver.
+    """
+    if out:
+        local_gradient = np.ascontiguousarray(
+            np.sum(np.stack([i[0] for i in out], axis=-1), axis=-1), dtype=np.float64)
+        local_loss = np.ascontiguousarray(
+            np.sum([i[1] for i in out], axis=0), dtype=np.float64)
+        shapes = (local_gradient.shape, local_loss.shape)
+    else:
+        #this rank owns no solvers but must still take part in the reduction.
+        shapes = None
+    all_shapes = [shape for shape in mpi_comm.allgather(shapes) if shape is not None]
+    #every rank gathers the same shapes so they all raise together.
+    if not all_shapes:
+        raise ValueError(
+            "No MPI rank evaluated the gradient of any solver so there is nothing to reduce.")
+    gradient_shape, loss_shape = all_shapes[0]
+    if not out:
+        local_gradient = np.zeros(gradient_shape, dtype=np.float64)
+        local_loss = np.zeros(loss_shape, dtype=np.float64)
+
+    gradient = np.empty_like(local_gradient)
+    loss = np.empty_like(local_loss)
+    mpi_comm.Allreduce(local_gradient, gradient)
+    mpi_comm.Allreduce(local_loss, loss)
+
+    #order the gathered output by solver so that it is identical to the serial case
+    #(the sort is stable so subdivided jobs of each solver remain in order).
+    local_output = [(key, (None, None) + tuple(entry[2:])) for key, entry in zip(keys, out)]
+    if mpi_root is None:
+        gathered = mpi_comm.allgather(local_output)
+    else:
+        gathered = mpi_comm.gather(local_output, root=mpi_root)
+        if mpi_comm.Get_rank() != mpi_root:
+            return loss[np.newaxis], gradient[..., np.newaxis], [], []
+    gathered = [item for sublist in gathered for item in sublist]
+    solver_order = {key: i for i, key in enumerate(solvers)}
+    gathered = sorted(gathered, key=lambda item: solver_order[item[0]])
+    keys = [item[0] for item in gathered]
+    out = [item[1] for item in gathered]
+    return loss[np.newaxis], gradient[..., np.newaxis], keys, out
+
+def solve_in_process(solver, maxiter, init_solution, verbose, setup_grid):
+    """
+    Solves a solver.RTE object and returns its compact solution state.
+
+    This is the worker used by process-based backends (e.g. 'loky') in
+    pyshdom.containers.SolversDict.parallel_solve. The solver is shipped to the
+    worker process so only the solution state (see solver.RTE._get_solution_state),
+    which excludes the scratch arrays and the unused parts of the big arrays, is
+    returned to the parent process.
+
+    Parameters
+    ----------
+    solver : pyshdom.solver.RTE
+        The solver to solve.
+    maxiter, init_solution, verbose, setup_grid
+        See pyshdom.solver.RTE.solve.
+
+    Returns
+    -------
+    state : dict
+        The solution state to be restored with solver.RTE._set_solution_state.
+    """
+    solver.solve(maxiter=maxiter, init_solution=init_solution, verbose=verbose,
+                 setup_grid=setup_grid)
+    return solver._get_solution_state()
+
+def estimate_solve_cost(solver, iterations=1):
+    """
+    Estimates the relative computational cost of solving a solver.RTE object.
+
+    The cost of each iteration scales with the number of grid points, the number of
+    spherical harmonic terms and the number of Stokes components. The number of grid
+    points is the number of base grid points times the adapt_grid_factor, or the
+    actual ratio from a previous solution if available. This is used to
+    schedule the longest solutions first.
+
+    Parameters
+    ----------
+    solver : pyshdom.solver.RTE
+        The solver to estimate the cost for.
+    iterations : int
+        The number of iterations expected (e.g. from a previous solution).
+
+    Returns
+    -------
+    cost : float
+        The estimated cost in arbitrary units.
+    """
+    if solver.final_adapt_grid_factor is not None:
+        adapt_grid_factor = solver.final_adapt_grid_factor
+    else:
+        adapt_grid_factor = solver._adapt_grid_factor
+    return float(solver._nbpts*adapt_grid_factor*solver._nlm*solver._nstokes*max(iterations, 1))
+
+def solve_and_render(solvers, rte_sensors, n_jobs, solve_keys, solve_kwargs, ray_costs=None):
+    """
+    Solves and renders solver.RTE objects, overlapping solving and rendering.
+
+    The solutions in `solve_keys` are started longest-first (see SolversDict.order_by_cost)
+    on a pool of `n_jobs` threads. As soon as a solution is complete, rendering of its sensors
+    (subdivided as in subdivide_raytrace_jobs) is queued so that threads which
+    finish early render rather than wait for the longest solutions to complete.
+    Sensors of solvers that are not in `solve_keys` are rendered straight away.
+
+    Parameters
+    ----------
+    solvers : pyshdom.containers.SolversDict
+        The solvers to solve and render.
+    rte_sensors : OrderedDict
+        The sensors grouped by solver key (see SensorsDict.sort_sensors).
+    n_jobs : int
+        The number of threads.
+    solve_keys : list
+        The keys of the solvers that need to be solved.
+    solve_kwargs : dict
+        Arguments to solver.RTE.solve.
+    ray_costs : OrderedDict
+        The estimated cost of each ray used to subdivide the rendering
+        (see subdivide_raytrace_jobs).
+
+    Returns
+    -------
+    keys : list
+        The solver key for each element of `out`.
+    out : list
+        The output of solver.RTE.integrate_to_sensor for each rendering job.
+    """
+    npixels = sum([sensor.sizes['npixels'] for sensor in rte_sensors.values()])
+    if n_jobs >= npixels:
+        keys = list(rte_sensors)
+        ray_start_end = [(0, rte_sensors[key].sizes['nrays']) for key in keys]
+        pixel_start_end = [(0, rte_sensors[key].sizes['npixels']) for key in keys]
+    else:
+        keys, ray_start_end, pixel_start_end = subdivide_raytrace_jobs(rte_sensors, n_jobs,
+                                                                       ray_costs=ray_costs)
+    render_jobs = OrderedDict([(key, []) for key in rte_sensors])
+    for i, key in enumerate(keys):
+        render_jobs[key].append(i)
+
+    out = [None]*len(keys)
+    def render(index):
+        key = keys[index]
+        (ray_start, ray_end), (pix_start, pix_end) = ray_start_end[index], pixel_start_end[index]
+        out[index] = solvers[key].integrate_to_sensor(
+            rte_sensors[key].sel(nrays=slice(ray_start, ray_end),
+                                 npixels=slice(pix_start, pix_end)))
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        solve_futures = OrderedDict()
+        for key in solvers.order_by_cost(solve_keys):
+            solve_futures[executor.submit(solvers[key].solve, **solve_kwargs)] = key
+        render_futures = [executor.submit(render, index) for key, indices in render_jobs.items()
+                          if key not in solve_keys for index in indices]
+        for future in as_completed(solve_futures):
+            future.result()
+            key = solve_futures[future]
+            solvers.record_iterations(key)
+            render_futures.extend([executor.submit(render, index) for index in render_jobs[key]])
+        for future in render_futures:
+            future.result()
+    return keys, out
+
+def estimate_ray_costs(solver, sensor):
+    """
+    Estimates the relative cost of integrating the radiance along each ray in `sensor`.
+
+    The radiance integration takes steps of at most 0.2 in optical depth
+    and stops once the transmission falls below 5e-5 so the cost of each ray is
+    modeled as a fixed overhead (one step per vertical level of the grid) plus a number
+    of steps proportional to its (truncated) optical path. These costs are used to
+    balance the rendering and gradient jobs (see subdivide_raytrace_jobs).
+
+    Parameters
+    ----------
+    solver : pyshdom.solver.RTE
+        A solver with an initialized grid, e.g. from the previous iteration of a retrieval.
+    sensor : xr.Dataset
+        A valid pyshdom sensor dataset (see sensor.py) containing the ray geometries.
+
+    Returns
+    -------
+    ray_costs : np.ndarray, shape=(nrays,)
+        The estimated relative cost of each ray.
+    """
+    optical_path = solver.optical_path(sensor.copy(deep=False)).optical_path.data
+    return solver._nz + np.minimum(optical_path, -np.log(5e-5))/0.2
+
+def parallel_estimate_ray_costs(solvers, rte_sensors, n_jobs=1, ray_costs=None):
+    """
+    Estimates the cost of each ray in `rte_sensors` (see estimate_ray_costs) using
+    multi-threading.
+
+    The rays are divided among the threads as for rendering (see subdivide_raytrace_jobs).
+
+    Parameters
+    ----------
+    solvers : pyshdom.containers.SolversDict
+        The solvers with initialized grids.
+    rte_sensors : OrderedDict
+        The sensors grouped by solver key (see SensorsDict.sort_sensors).
+    n_jobs : int
+        The number of threads.
+    ray_costs : OrderedDict
+        Previous estimates of the cost of each ray used to divide the rays
+        (see subdivide_raytrace_jobs).
+
+    Returns
+    -------
+    ray_costs : OrderedDict
+        The estimated cost of each ray for each key in `rte_sensors`.
+    """
+    npixels = sum([sensor.sizes['npixels'] for sensor in rte_sensors.values()])
+    if n_jobs == 1 or n_jobs >= npixels:
+        return OrderedDict([(key, estimate_ray_costs(solvers[key], rte_sensor))
+                            for key, rte_sensor in rte_sensors.items()])
+    keys, ray_start_end, _ = subdivide_raytrace_jobs(rte_sensors, n_jobs, ray_costs=ray_costs)
+    out = Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(estimate_ray_costs)(solvers[key],
+                                    rte_sensors[key].isel(nrays=slice(ray_start, ray_end)))
+        for key, (ray_start, ray_end) in zip(keys, ray_start_end))
+    #the jobs of each key are in order.
+    return OrderedDict([(key, np.concatenate([costs for job_key, costs in zip(keys, out)
+                                              if job_key == key]))
+                        for key in rte_sensors])
+
+def subdivide_raytrace_jobs(rte_sensors, n_jobs, job_factor=1, ray_costs=None):
     """
     Subdivides a sensor for parallelized processing.
 
@@ -130,23 +448,59 @@ def subdivide_raytrace_jobs(rte_sensors, n_jobs, job_factor=1):
         A factor which divides up the jobs into more pieces which would improve
         load balancing by making tasks similar sizes with a trade off against
         overhead of workers calling the function multiple times.
+    ray_costs : OrderedDict
+        The estimated cost of each ray (see estimate_ray_costs) with the same keys
+        as `rte_sensors`. If None, all rays are assumed to have the same cost and
+        the jobs have similar numbers of rays. Otherwise, the jobs are chosen to have
+        similar total costs.
+
+    Raises
+    ------
+    ValueError
+        If the `ray_costs` are not positive or their number does not match the
+        number of rays.
     """
+    if ray_costs is not None:
+        for key, merged_sensor in rte_sensors.items():
+            costs = np.asarray(ray_costs[key])
+            if costs.shape != (merged_sensor.sizes['nrays'],):
+                raise ValueError(
+                    "`ray_costs` for key '{}' should have shape ({},) not {}".format(
+                        key, merged_sensor.sizes['nrays'], costs.shape))
+            if not np.all(costs > 0.0):
+                raise ValueError("`ray_costs` for key '{}' should be positive.".format(key))
     #loose distribution of workers by sensor key based on number
-    #of rays at each sensor key.
+    #of rays (or their total cost) at each sensor key.
     render_jobs = OrderedDict()
-    ray_count = 0
+    total_cost = 0
     for key, merged_sensor in rte_sensors.items():
-        ray_count += merged_sensor.sizes['nrays']
-        render_jobs[key] = merged_sensor.sizes['nrays']
+        if ray_costs is None:
+            cost = merged_sensor.sizes['nrays']
+        else:
+            cost = np.sum(ray_costs[key])
+        total_cost += cost
+        render_jobs[key] = cost
     for key, render_job in render_jobs.items():
-        render_jobs[key] = max(np.ceil(render_job/ray_count * n_jobs * job_factor).astype(np.int), 1)
+        render_jobs[key] = max(np.ceil(render_job/total_cost * n_jobs * job_factor).astype(np.int), 1)
     #find the ray indices to split each sensor at.
     keys = []
     pixel_start_end = []
     ray_start_end = []
     for key, merged_sensor in rte_sensors.items():
-        split = np.array_split(np.arange(merged_sensor.sizes['nrays'] + 1), render_jobs[key])
-        start_end = [(i.min(), i.max()) for i in split]
+        if ray_costs is None:
+            split = np.array_split(np.arange(merged_sensor.sizes['nrays'] + 1), render_jobs[key])
+            start_end = [(i.min(), i.max()) for i in split]
+        else:
+            #split where the cumulative cost reaches equal fractions of the total.
+            cumulative_cost = np.cumsum(np.append(0.0, ray_costs[key]))
+            ends = np.searchsorted(
+                cumulative_cost,
+                cumulative_cost[-1]*np.arange(1, render_jobs[key] + 1)/render_jobs[key])
+            ends[-1] = merged_sensor.sizes['nrays']
+            #a single expensive ray can hold several of the fractions so repeated
+            #(or zero) ends are removed to avoid empty jobs.
+            ends = np.unique(np.clip(ends, 1, merged_sensor.sizes['nrays']))
+            start_end = list(zip(np.append(0, ends[:-1]), ends))
         #adjust start and end indices so that rays are grouped by their parent pixel.
         index_diffs = np.append(
             merged_sensor.pixel_index.diff(dim='nrays').data,
@@ -155,9 +509,14 @@ def subdivide_raytrace_jobs(rte_sensors, n_jobs, job_factor=1):
         ends = np.where(index_diffs == 1)[0] + 1
         updated_start_end = []
         new_start = 0
-        for i, (start, end) in enumerate(start_end):
-            updated_start_end.append((new_start, ends[np.abs(ends-end).argmin()]))
-            new_start = updated_start_end[i][1]
+        for start, end in start_end:
+            new_end = ends[np.abs(ends-end).argmin()]
+            #jobs that end at the same pixel as the previous job would be empty.
+            if new_end > new_start:
+                updated_start_end.append((new_start, new_end))
+                new_start = new_end
+        if new_start < merged_sensor.sizes['nrays']:
+            updated_start_end.append((new_start, merged_sensor.sizes['nrays']))
         ray_start_end.extend(updated_start_end)
 
         pixel_inds = np.cumsum(np.concatenate(
@@ -18,10 +18,14 @@ As the rays are the variables that are actually passed to the solver.RTE object
 rendering, a sensor MUST have ray variables. However, there is no generic method
 for generating sub-pixel ray geometry, as it depends on the assumed sensor geometry.
 Users should add their own generating functions for specialized sensors.
+
+For very large sensors, `ray_chunks` generates the rays of a sensor lazily in
+chunks of pixels so that they can be rendered without holding all rays in memory.
 """
 import itertools
 import inspect
 import sys
+from collections import OrderedDict
 import xarray as xr
 import numpy as np
 
@@ -292,36 +296,9 @@ def orthographic_projection(wavelength, bounding_box, x_resolution, y_resolution
     }
     if sub_pixel_ray_args['method'] is not None:
 
-        #generate the weights and perturbations to the pixel positions in the image plane.
-        sub_pixel_ray_method, subpixel_ray_kwargs_x, subpixel_ray_kwargs_y = \
-            _parse_sub_pixel_ray_args(sub_pixel_ray_args)
-        position_perturbations_x, weights_x = sub_pixel_ray_method(x.size, **subpixel_ray_kwargs_x)
-        position_perturbations_y, weights_y = sub_pixel_ray_method(y.size, **subpixel_ray_kwargs_y)
-
-        #merge the two dimensions
-        perturbations_x = np.repeat(position_perturbations_x[..., np.newaxis]*x_resolution/2.0,
-                                    position_perturbations_y.shape[-1], axis=-1)
-        perturbations_y = np.repeat(position_perturbations_y[..., np.newaxis, :]*y_resolution/2.0,
-                                    position_perturbations_x.shape[-1], axis=-2)
-        big_weightx = np.repeat(weights_x[..., np.newaxis], weights_y.shape[-1], axis=-1)
-        big_weighty = np.repeat(weights_y[..., np.newaxis, :], weights_x.shape[-1], axis=-2)
-
-        #apply perturbations to original image plane coordinates.
-        x_ray = (x.ravel()[:, np.newaxis, np.newaxis] + perturbations_x).ravel()
-        y_ray = (y.ravel()[:, np.newaxis, np.newaxis] + perturbations_y).ravel()
-        z_ray = np.repeat(np.repeat(z.ravel()[:, np.newaxis, np.newaxis],
-                                    perturbations_x.shape[-2], axis=-2),
-                          perturbations_y.shape[-1], axis=-1).ravel()
-        mu_ray = np.repeat(np.repeat(mu.ravel()[:, np.newaxis, np.newaxis],
-                                     perturbations_x.shape[-2], axis=-2),
-                           perturbations_y.shape[-1], axis=-1).ravel()
-        phi_ray = np.repeat(np.repeat(phi.ravel()[:, np.newaxis, np.newaxis],
-                                      perturbations_x.shape[-2], axis=-2),
-                            perturbations_y.shape[-1], axis=-1).ravel()
-        #make the pixel indices and ray weights.
-        pixel_index = np.repeat(np.repeat(range(len(sensor.cam_mu.data)),
-                                          weights_x.shape[-1]), weights_y.shape[-1])
-        ray_weight = (big_weightx*big_weighty).ravel()
+        x_ray, y_ray, z_ray, mu_ray, phi_ray, pixel_index, ray_weight = \
+            _orthographic_subpixel_rays(x.ravel(), y.ravel(), z.ravel(), mu.ravel(), phi.ravel(),
+                                        x_resolution, y_resolution, sub_pixel_ray_args)
         #update ray variables to sensor dataset.
         sensor['ray_mu'] = ('nrays', mu_ray)
         sensor['ray_phi'] = ('nrays', phi_ray)
@@ -433,13 +410,8 @@ def perspective_projection(wavelength, fov, x_resolution, y_resolution,
     yaxis = np.cross(zaxis, xaxis)
     rotation_matrix = np.stack((xaxis, yaxis, zaxis), axis=1)
 
-    M = max(nx, ny)
     npix = nx*ny
-    R = np.array([nx, ny])/M # R will be used to scale the sensor meshgrid.
-    dy = 2*R[1]/ny # pixel length in y direction in the normalized image plane.
-    dx = 2*R[0]/nx # pixel length in x direction in the normalized image plane.
-    x_s, y_s, z_s = np.meshgrid(np.linspace(-R[0], R[0]-dx, nx),
-                                np.linspace(-R[1], R[1]-dy, ny), 1.0)
+    x_s, y_s, z_s, dx, dy, R = _perspective_image_plane(nx, ny)
 
     # Here x_c, y_c, z_c coordinates on the image plane before transformation to the requaired observation angle
     focal = 1.0 / np.tan(np.deg2rad(fov) / 2.0) # focal (normalized) length when the sensor size is 2 e.g. r in [-1,1).
@@ -491,45 +463,9 @@ def perspective_projection(wavelength, fov, x_resolution, y_resolution,
 
     if sub_pixel_ray_args['method'] is not None:
 
-        #generate the weights and perturbations to the pixel positions in the image plane.
-        sub_pixel_ray_method, subpixel_ray_kwargs_x, subpixel_ray_kwargs_y =  \
-                            _parse_sub_pixel_ray_args(sub_pixel_ray_args)
-        position_perturbations_x, weights_x = sub_pixel_ray_method(x_s.size,
-                                                                   **subpixel_ray_kwargs_x)
-        position_perturbations_y, weights_y = sub_pixel_ray_method(y_s.size,
-                                                                   **subpixel_ray_kwargs_y)
-
-        #merge the two dimensions
-        perturbations_x = np.repeat(position_perturbations_x[..., np.newaxis]*dx/2.0,
-                                    position_perturbations_y.shape[-1], axis=-1)
-        perturbations_y = np.repeat(position_perturbations_y[..., np.newaxis, :]*dy/2.0,
-                                    position_perturbations_x.shape[-1], axis=-2)
-        big_weightx = np.repeat(weights_x[..., np.newaxis], weights_y.shape[-1], axis=-1)
-        big_weighty = np.repeat(weights_y[..., np.newaxis, :], weights_x.shape[-1], axis=-2)
-
-        #apply perturbations to original image plane coordinates.
-        x_ray = (x_s.ravel()[:, np.newaxis, np.newaxis] + perturbations_x).ravel()
-        y_ray = (y_s.ravel()[:, np.newaxis, np.newaxis] + perturbations_y).ravel()
-        z_ray = np.repeat(np.repeat(z_s.ravel()[:, np.newaxis, np.newaxis],
-                                    perturbations_x.shape[-2], axis=-2),
-                          perturbations_y.shape[-1], axis=-1).ravel()
-        ray_homogeneous = np.stack([x_ray, y_ray, z_ray])
-
-        x_c, y_c, z_c = norm(np.matmul(
-            rotation_matrix, np.matmul(inv_k, ray_homogeneous)))
-        # Here x_c, y_c, z_c coordinates on the image plane after transformation to the requaired observation
-
-        # x,y,z mu, phi in the global coordinates:
-        mu = -z_c.astype(np.float64)
-        phi = (np.arctan2(y_c, x_c) + np.pi).astype(np.float64)
-        x = np.full(x_c.size, position[0], dtype=np.float32)
-        y = np.full(x_c.size, position[1], dtype=np.float32)
-        z = np.full(x_c.size, position[2], dtype=np.float32)
-
-        #make the pixel indices and ray weights.
-        pixel_index = np.repeat(np.repeat(range(len(sensor.cam_mu.data)),
-                                          weights_x.shape[-1]), weights_y.shape[-1])
-        ray_weight = (big_weightx*big_weighty).ravel()
+        x, y, z, mu, phi, pixel_index, ray_weight = _perspective_subpixel_rays(
+            x_s.ravel(), y_s.ravel(), z_s.ravel(), dx, dy, rotation_matrix, inv_k, position,
+            sub_pixel_ray_args)
         #update ray variables to sensor dataset.
         sensor['ray_mu'] = ('nrays', mu)
         sensor['ray_phi'] = ('nrays', phi)
@@ -548,8 +484,229 @@ def perspective_projection(wavelength, fov, x_resolution, y_resolution,
         sensor = _add_null_subpixel_rays(sensor)
     return sensor
 
+def ray_chunks(sensor, chunk_size, sub_pixel_ray_args={'method': None}):
+    """
+    Lazily generates the rays of a sensor in chunks of whole pixels.
+
+    Only the pixel variables and attributes of `sensor` are used and the sub-pixel
+    rays are generated for each chunk of pixels in turn, so that the memory required
+    for the rays is bounded by `chunk_size` rather than the total number of rays.
+    This is used for streaming the rendering of very large sensors
+    (see pyshdom.solver.RTE.render_chunks).
+
+    Parameters
+    ----------
+    sensor : xr.Dataset
+        A sensor dataset. If `sub_pixel_ray_args` has a 'method' then `sensor` should
+        have been generated by `orthographic_projection` or `perspective_projection`
+        (preferably without sub-pixel rays, which would be ignored).
+    chunk_size : int
+        The maximum number of rays in each chunk. Each chunk has at least one pixel.
+    sub_pixel_ray_args : dict
+        The method for generating sub-pixel rays as in `orthographic_projection`.
+        If the 'method' is None, each pixel has a single ray.
+
+    Yields
+    ------
+    pixels : slice
+        The indices of the pixels of the chunk.
+    rays : OrderedDict
+        The 'ray_x', 'ray_y', 'ray_z', 'ray_mu', 'ray_phi' and 'ray_weight' arrays and
+        the 'pixel_index' of each ray relative to `pixels.start`.
+
+    Raises
+    ------
+    ValueError
+        If sub-pixel rays are requested for a sensor that isn't an orthographic
+        or perspective projection.
+    """
+    pyshdom.checks.check_hasdim(sensor, cam_mu='npixels', cam_phi='npixels',
+                                cam_x='npixels', cam_y='npixels', cam_z='npixels')
+    npixels = sensor.sizes['npixels']
+    cam = [sensor[name].data for name in ('cam_x', 'cam_y', 'cam_z', 'cam_mu', 'cam_phi')]
+
+    if sub_pixel_ray_args['method'] is None:
+        generate = lambda start, stop: [variable[start:stop] for variable in cam] + \
+            [np.arange(stop - start), np.ones(stop - start)]
+    elif sensor.attrs.get('projection') == 'Orthographic':
+        generate = lambda start, stop: _orthographic_subpixel_rays(
+            *[variable[start:stop] for variable in cam], sensor.attrs['x_resolution'],
+            sensor.attrs['y_resolution'], sub_pixel_ray_args)
+    elif sensor.attrs.get('projection') == 'Perspective':
+        x_s, y_s, z_s, dx, dy, _ = _perspective_image_plane(sensor.attrs['x_resolution'],
+                                                            sensor.attrs['y_resolution'])
+        x_s, y_s, z_s = x_s.ravel(), y_s.ravel(), z_s.ravel()
+        inv_k = np.linalg.inv(sensor.attrs['sensor_to_camera_transform_matrix'])
+        generate = lambda start, stop: _perspective_subpixel_rays(
+            x_s[start:stop], y_s[start:stop], z_s[start:stop], dx, dy,
+            sensor.attrs['rotation_matrix'], inv_k, sensor.attrs['position'],
+            sub_pixel_ray_args)
+    else:
+        raise ValueError(
+            "Sub-pixel rays can only be generated for 'Orthographic' or 'Perspective' "
+            "projections not '{}'".format(sensor.attrs.get('projection')))
+
+    rays_per_pixel = generate(0, 1)[0].size
+    pixels_per_chunk = max(1, chunk_size // rays_per_pixel)
+    names = ('ray_x', 'ray_y', 'ray_z', 'ray_mu', 'ray_phi', 'pixel_index', 'ray_weight')
+    for start in range(0, npixels, pixels_per_chunk):
+        stop = min(start + pixels_per_chunk, npixels)
+        yield slice(start, stop), OrderedDict(zip(names, generate(start, stop)))
+
+def _orthographic_subpixel_rays(x, y, z, mu, phi, x_resolution, y_resolution,
+                                sub_pixel_ray_args):
+    """
+    Generates the sub-pixel rays of pixels of an orthographic projection
+    (see `orthographic_projection`).
+
+    Parameters
+    ----------
+    x, y, z, mu, phi : np.ndarray
+        The 1D positions and angles of the pixels.
+    x_resolution, y_resolution : float
+        Pixel resolution [km] in the x and y axes.
+    sub_pixel_ray_args : dict
+        The method for generating sub-pixel rays (see `orthographic_projection`).
+
+    Returns
+    -------
+    x_ray, y_ray, z_ray, mu_ray, phi_ray : np.ndarray
+        The positions and angles of the rays.
+    pixel_index : np.ndarray
+        The index of the pixel (in `x` etc.) of each ray.
+    ray_weight : np.ndarray
+        The weight of each ray.
+    """
+    #generate the weights and perturbations to the pixel positions in the image plane.
+    sub_pixel_ray_method, subpixel_ray_kwargs_x, subpixel_ray_kwargs_y = \
+        _parse_sub_pixel_ray_args(sub_pixel_ray_args)
+    position_perturbations_x, weights_x = sub_pixel_ray_method(x.size, **subpixel_ray_kwargs_x)
+    position_perturbations_y, weights_y = sub_pixel_ray_method(y.size, **subpixel_ray_kwargs_y)
+
+    #merge the two dimensions
+    perturbations_x = np.repeat(position_perturbations_x[..., np.newaxis]*x_resolution/2.0,
+                                position_perturbations_y.shape[-1], axis=-1)
+    perturbations_y = np.repeat(position_perturbations_y[..., np.newaxis, :]*y_resolution/2.0,
+                                position_perturbations_x.shape[-1], axis=-2)
+    big_weightx = np.repeat(weights_x[..., np.newaxis], weights_y.shape[-1], axis=-1)
+    big_weighty = np.repeat(weights_y[..., np.newaxis, :], weights_x.shape[-1], axis=-2)
+
+    #apply perturbations to original image plane coordinates.
+    x_ray = (x[:, np.newaxis, np.newaxis] + perturbations_x).ravel()
+    y_ray = (y[:, np.newaxis, np.newaxis] + perturbations_y).ravel()
+    z_ray = np.repeat(np.repeat(z[:, np.newaxis, np.newaxis],
+                                perturbations_x.shape[-2], axis=-2),
+                      perturbations_y.shape[-1], axis=-1).ravel()
+    mu_ray = np.repeat(np.repeat(mu[:, np.newaxis, np.newaxis],
+                                 perturbations_x.shape[-2], axis=-2),
+                       perturbations_y.shape[-1], axis=-1).ravel()
+    phi_ray = np.repeat(np.repeat(phi[:, np.newaxis, np.newaxis],
+                                  perturbations_x.shape[-2], axis=-2),
+                        perturbations_y.shape[-1], axis=-1).ravel()
+    #make the pixel indices and ray weights.
+    pixel_index = np.repeat(np.repeat(range(x.size),
+                                      weights_x.shape[-1]), weights_y.shape[-1])
+    ray_weight = (big_weightx*big_weighty).ravel()
+    return x_ray, y_ray, z_ray, mu_ray, phi_ray, pixel_index, ray_weight
+
+def _perspective_image_plane(nx, ny):
+    """
+    The pixel coordinates in the normalized image plane of a perspective projection
+    (see `perspective_projection`).
+
+    Parameters
+    ----------
+    nx, ny : int
+        Number of pixels in the camera x and y axes.
+
+    Returns
+    -------
+    x_s, y_s, z_s : np.ndarray, shape=(ny, nx, 1)
+        The coordinates of the pixels.
+    dx, dy : float
+        The pixel lengths in the normalized image plane.
+    R : np.ndarray
+        The half-size of the image plane in the x and y axes.
+    """
+    M = max(nx, ny)
+    R = np.array([nx, ny])/M # R will be used to scale the sensor meshgrid.
+    dy = 2*R[1]/ny # pixel length in y direction in the normalized image plane.
+    dx = 2*R[0]/nx # pixel length in x direction in the normalized image plane.
+    x_s, y_s, z_s = np.meshgrid(np.linspace(-R[0], R[0]-dx, nx),
+                                np.linspace(-R[1], R[1]-dy, ny), 1.0)
+    return x_s, y_s, z_s, dx, dy, R
 
+def _perspective_subpixel_rays(x_s, y_s, z_s, dx, dy, rotation_matrix, inv_k, position,
+                               sub_pixel_ray_args):
+    """
+    Generates the sub-pixel rays of pixels of a perspective projection
+    (see `perspective_projection`).
 
+    Parameters
+    ----------
+    x_s, y_s, z_s : np.ndarray
+        The 1D coordinates of the pixels in the normalized image plane.
+    dx, dy : float
+        The pixel lengths in the normalized image plane.
+    rotation_matrix, inv_k : np.ndarray
+        The rotation to the observation direction and the inverse of the
+        sensor to camera transform matrix.
+    position : np.ndarray
+        The position of the camera [km].
+    sub_pixel_ray_args : dict
+        The method for generating sub-pixel rays (see `perspective_projection`).
+
+    Returns
+    -------
+    x, y, z, mu, phi : np.ndarray
+        The positions and angles of the rays.
+    pixel_index : np.ndarray
+        The index of the pixel (in `x_s` etc.) of each ray.
+    ray_weight : np.ndarray
+        The weight of each ray.
+    """
+    norm = lambda x: x / np.linalg.norm(x, axis=0)
+
+    #generate the weights and perturbations to the pixel positions in the image plane.
+    sub_pixel_ray_method, subpixel_ray_kwargs_x, subpixel_ray_kwargs_y =  \
+                        _parse_sub_pixel_ray_args(sub_pixel_ray_args)
+    position_perturbations_x, weights_x = sub_pixel_ray_method(x_s.size,
+                                                               **subpixel_ray_kwargs_x)
+    position_perturbations_y, weights_y = sub_pixel_ray_method(y_s.size,
+                                                               **subpixel_ray_kwargs_y)
+
+    #merge the two dimensions
+    perturbations_x = np.repeat(position_perturbations_x[..., np.newaxis]*dx/2.0,
+                                position_perturbations_y.shape[-1], axis=-1)
+    perturbations_y = np.repeat(position_perturbations_y[..., np.newaxis, :]*dy/2.0,
+                                position_perturbations_x.shape[-1], axis=-2)
+    big_weightx = np.repeat(weights_x[..., np.newaxis], weights_y.shape[-1], axis=-1)
+    big_weighty = np.repeat(weights_y[..., np.newaxis, :], weights_x.shape[-1], axis=-2)
+
+    #apply perturbations to original image plane coordinates.
+    x_ray = (x_s[:, np.newaxis, np.newaxis] + perturbations_x).ravel()
+    y_ray = (y_s[:, np.newaxis, np.newaxis] + perturbations_y).ravel()
+    z_ray = np.repeat(np.repeat(z_s[:, np.newaxis, np.newaxis],
+                                perturbations_x.shape[-2], axis=-2),
+                      perturbations_y.shape[-1], axis=-1).ravel()
+    ray_homogeneous = np.stack([x_ray, y_ray, z_ray])
+
+    x_c, y_c, z_c = norm(np.matmul(
+        rotation_matrix, np.matmul(inv_k, ray_homogeneous)))
+    # Here x_c, y_c, z_c coordinates on the image plane after transformation to the requaired observation
+
+    # x,y,z mu, phi in the global coordinates:
+    mu = -z_c.astype(np.float64)
+    phi = (np.arctan2(y_c, x_c) + np.pi).astype(np.float64)
+    x = np.full(x_c.size, position[0], dtype=np.float32)
+    y = np.full(x_c.size, position[1], dtype=np.float32)
+    z = np.full(x_c.size, position[2], dtype=np.float32)
+
+    #make the pixel indices and ray weights.
+    pixel_index = np.repeat(np.repeat(range(x_s.size),
+                                      weights_x.shape[-1]), weights_y.shape[-1])
+    ray_weight = (big_weightx*big_weighty).ravel()
+    return x, y, z, mu, phi, pixel_index, ray_weight
 
 def _parse_sub_pixel_ray_args(sub_pixel_ray_args):
     """
@@ -11,6 +11,9 @@ import sys
 import warnings
 import copy
 import typing
+import hashlib
+import threading
+import weakref
 from collections import OrderedDict
 import psutil
 
@@ -20,6 +23,20 @@ import numpy as np
 import pyshdom.core
 import pyshdom.util
 import pyshdom.checks
+import pyshdom.sensor
+
+#the phase function tables (see RTE._precompute_phase) keyed by a hash of the
+#legendre table and the parameters so that they are shared by solvers with identical
+#legendre tables e.g. several viewing geometries at one wavelength. Each solver holds
+#its own table so only weak references are kept here and a table is forgotten once
+#no solver uses it.
+_PHASE_TABLES = weakref.WeakValueDictionary()
+_PHASE_TABLES_LOCK = threading.Lock()
+
+def clear_phase_table_cache():
+    """Forgets all cached phase function tables (see RTE._precompute_phase)."""
+    with _PHASE_TABLES_LOCK:
+        _PHASE_TABLES.clear()
 
 
 class ShdomPropertyArrays(object):
@@ -185,6 +202,17 @@ class RTE:
         self._restore_data = None
         self._setup_grid_flag = True
 
+        #the allocated shapes of the arrays trimmed by self.compact.
+        self._allocated_shapes = None
+        #the source and radiance arrays compressed by self.compress.
+        self._compressed = None
+        #the phase function table and the key of the legendre table it was computed from.
+        self._phasetab = None
+        self._phasetab_key = None
+        #the phase function derivative tables if they are not stored by the caller
+        #(see RTE._derivative_phase_tables).
+        self._derivative_tables = OrderedDict()
+
         #set the cached spherical_harmonics and net flux divergence to None
         self._netfluxdiv = None
         self._shterms = None
@@ -216,6 +244,56 @@ class RTE:
     def final_cell_point_ratio(self):
         return self._cell_point_out
 
+    def estimate_memory(self, adapt_grid_factor=None, num_sh_term_factor=None,
+                        cell_to_point_ratio=None):
+        """
+        Estimates the peak memory (MB) used by this RTE object during RTE.solve.
+
+        This uses the SHDOM memory model (see RTE.final_maxmb) evaluated for the
+        maximum sizes of the grid and spherical harmonic arrays so it can be used
+        to check memory requirements before the large arrays are allocated
+        (in RTE.solve). The sizes are set by the memory parameters which default
+        to those currently used (after any reduction to fit `max_total_mb`).
+
+        Parameters
+        ----------
+        adapt_grid_factor : float
+            The ratio of total grid points to base grid points.
+        num_sh_term_factor : float
+            The ratio of the average number of spherical harmonic terms to NLM.
+        cell_to_point_ratio : float
+            The ratio of the number of grid cells to grid points.
+
+        Returns
+        -------
+        memory : float
+            The projected peak memory in MB.
+
+        See Also
+        --------
+        pyshdom.containers.SolversDict.dry_run
+        pyshdom.configuration.MemoryTuner
+        """
+        adapt_grid_factor = self._adapt_grid_factor if adapt_grid_factor is None \
+            else adapt_grid_factor
+        num_sh_term_factor = self._num_sh_term_factor if num_sh_term_factor is None \
+            else num_sh_term_factor
+        cell_to_point_ratio = self._cell_to_point_ratio if cell_to_point_ratio is None \
+            else cell_to_point_ratio
+        maxig = int(adapt_grid_factor * self._nbpts)
+        return self._memory_model(maxig, int(cell_to_point_ratio * maxig),
+                                  int(num_sh_term_factor * self._nlm * maxig))
+
+    def _memory_model(self, npts, ncells, nsh):
+        """
+        The SHDOM memory model (MB) for a given number of grid points, cells and
+        spherical harmonic terms.
+        """
+        return 4*(self._nmu*(2+2*self._nphi + 2*self._nlm+2*33*32) \
+                  + 4.5*self._maxpg + self._maxpgl + self._pa.numphase*(self._nleg + 1) \
+                  + 16.5*ncells + npts*(28+self._nphi0max*self._nstokes) \
+                  + self._nstokes*nsh*self._big_arrays)/(1024**2)
+
     @property
     def solution_accuracy(self):
         return self._solacc
@@ -229,7 +307,8 @@ class RTE:
         self.numerical_params['solacc'] = val
         #important to update both consistently.
 
-    def solve(self, maxiter, init_solution=True, setup_grid=True, verbose=True):
+    def solve(self, maxiter, init_solution=True, setup_grid=True, verbose=True,
+              auto_grow=False, growth_factor=2.0, compact=False):
         """
         Main solver routine. This routine is comprised of two parts:
           1. Initialization, optional
@@ -249,9 +328,26 @@ class RTE:
             by RTE.load_solution or use a 1D two-stream model.
         verbose: boolean
             True will output solution iteration information into stdout.
+        auto_grow: boolean
+            If True then the grid point, cell and spherical harmonic arrays
+            (MAXIG, MAXIC, MAXIV) are enlarged by `growth_factor` whenever the adaptive
+            grid runs out of memory and the iterations are continued, rather than
+            stopping the cell splitting. The arrays are not grown beyond `max_total_mb`.
+        growth_factor: float
+            The factor by which the arrays are enlarged if `auto_grow` is True.
+        compact: boolean
+            If True then the arrays are trimmed to their used extent after
+            solving (see RTE.compact).
         """
         if not isinstance(verbose, np.bool):
             raise TypeError("`verbose` should be a boolean.")
+        if not isinstance(auto_grow, np.bool):
+            raise TypeError("`auto_grow` should be a boolean.")
+        if growth_factor <= 1.0:
+            raise ValueError("`growth_factor` should be greater than 1.")
+        if not isinstance(compact, np.bool):
+            raise TypeError("`compact` should be a boolean.")
+        self._expand()
         if not isinstance(init_solution, np.bool):
             raise TypeError("`init_solution` should be a boolean.")
         if not isinstance(setup_grid, np.bool):
@@ -285,8 +381,51 @@ class RTE:
 
         # Part 2: Solution itertaions
         # This is the time consuming part, equivalent to SOLVE_RTE in SHDOM.
-        # All of these arrays are initialized in _init_solution or _setup_grid.
-        # And are modified in-place to reflect the solved RTE.
+        # If the adaptive grid runs out of memory then the arrays are enlarged
+        # and the iterations continue from the interpolated solution.
+        outofmem = self._solution_iterations(maxiter, verbose, stop_out_of_memory=auto_grow)
+        while auto_grow and outofmem:
+            auto_grow = self._grow_memory(growth_factor)
+            if verbose and auto_grow:
+                print("Memory grown to MAXIG={}, MAXIC={}, MAXIV={} "
+                      "({:.1f} MB).".format(self._maxig, self._maxic, self._maxiv,
+                                            self._memory_model(self._maxig, self._maxic,
+                                                               self._maxiv)))
+            outofmem = self._solution_iterations(maxiter, verbose, stop_out_of_memory=auto_grow)
+        nsh = self._shptr[self._npts]
+        self._maxmb_out = self._memory_model(self._npts, self._ncells, nsh)
+        self._adapt_grid_factor_out = self._npts/self._nbpts
+        self._shterm_fac_out = nsh/(self._nlm*self._npts)
+        self._cell_point_out = self._ncells/self._npts
+        if compact:
+            self.compact()
+        # if verbose:
+        #     print("Actual MAX_TOTAL_MB: {:.2f}".format(self._maxmb_out))
+        #     print("Actual adapt_grid_factor: {:.4f}".format(self._adapt_grid_factor_out))
+        #     print("Actual cell_point_ratio: {:.4f}".format(self._cell_point_out))
+
+    def _solution_iterations(self, maxiter, verbose, stop_out_of_memory=False):
+        """
+        Performs the SHDOM solution iterations (core.solution_iterations).
+
+        All of the arrays are initialized in _init_solution or _setup_grid
+        and are modified in-place to reflect the solved RTE.
+
+        Parameters
+        ----------
+        maxiter : int
+            The maximum (total) number of iterations.
+        verbose : bool
+            True will output solution iteration information into stdout.
+        stop_out_of_memory : bool
+            If True, the iterations stop as soon as the adaptive grid cell splitting
+            runs out of room in the grid point, cell or spherical harmonic arrays.
+
+        Returns
+        -------
+        outofmem : bool
+            True if the iterations were stopped because cell splitting ran out of memory.
+        """
         self._sfcgridparms, self._solcrit, self._iters, self._temp, self._planck, \
         self._extinct, self._albedo, self._legen, self._iphase, self._ntoppts, \
         self._nbotpts, self._bcptr, self._bcrad, self._npts, self._gridpos, \
@@ -295,7 +434,7 @@ class RTE:
         self._radiance, self._fluxes, self._dirflux, self._uniformzlev, \
         self._pa.extdirp, self._oldnpts, self._total_ext, self._deljdot, \
         self._deljold, self._deljnew, self._jnorm, self._work, self._work1, \
-        self._work2 = pyshdom.core.solution_iterations(
+        self._work2, outofmem = pyshdom.core.solution_iterations(
             verbose=verbose,
             iterfixsh=self._iterfixsh,
             iter=self._iters,
@@ -440,20 +579,10 @@ class RTE:
             maxido=self._maxido,
             oldnpts=self._oldnpts,
             ylmsun=self._ylmsun,
-            runname=self._name
+            runname=self._name,
+            stopoutofmem=stop_out_of_memory
         )
-        nsh = self._shptr[self._npts+1]
-        self._maxmb_out = 4*(self._nmu*(2+2*self._nphi + 2*self._nlm+2*33*32) \
-                        + 4.5*self._maxpg + self._maxpgl + self._pa.numphase*(self._nleg + 1) \
-                        + 16.5*self._ncells + self._npts*(28+self._nphi0max*self._nstokes) \
-                        + self._nstokes*nsh*self._big_arrays)/(1024**2)
-        self._adapt_grid_factor_out = self._npts/self._nbpts
-        self._shterm_fac_out = nsh/(self._nlm*self._npts)
-        self._cell_point_out = self._ncells/self._npts
-        # if verbose:
-        #     print("Actual MAX_TOTAL_MB: {:.2f}".format(self._maxmb_out))
-        #     print("Actual adapt_grid_factor: {:.4f}".format(self._adapt_grid_factor_out))
-        #     print("Actual cell_point_ratio: {:.4f}".format(self._cell_point_out))
+        return outofmem
 
     def integrate_to_sensor(self, sensor):
         """Calculates the StokesVector at specified geometry using an RTE solution.
@@ -493,17 +622,242 @@ class RTE:
                                                           self._nstokes)
                             )
 
-        camx = sensor['ray_x'].data
-        camy = sensor['ray_y'].data
-        camz = sensor['ray_z'].data
-        cammu = sensor['ray_mu'].data
-        camphi = sensor['ray_phi'].data
-        total_pix = sensor.sizes['nrays']
+        output = self.render_rays(sensor['ray_x'].data, sensor['ray_y'].data,
+                                  sensor['ray_z'].data, sensor['ray_mu'].data,
+                                  sensor['ray_phi'].data).T
+
+        sensor['I'] = xr.DataArray(
+            data=output[0],
+            dims='nrays',
+            attrs={
+                'long_name': 'Radiance'
+            }
+        )
+        if self._nstokes > 1:
+            sensor['Q'] = xr.DataArray(
+                data=output[1],
+                dims='nrays',
+                attrs={
+                    'long_name': 'Stokes Parameter for Linear Polarization (Q)'
+                }
+            )
+            sensor['U'] = xr.DataArray(
+                data=output[2],
+                dims='nrays',
+                attrs={
+                    'long_name': 'Stokes Parameter for Linear Polarization (U)'
+                }
+            )
+        if self._nstokes == 4:
+            sensor['V'] = xr.DataArray(
+                data=output[3],
+                dims='nrays',
+                attrs={
+                    'long_name': 'Stokes Parameter for Circular Polarization (V)'
+                }
+            )
+        return sensor
+
+    def render_batch(self, rays):
+        """
+        Calculates the Stokes Vector of the rays of many sensors in a single pass.
+
+        This is equivalent to RTE.integrate_to_sensor for each sensor but the
+        phase function table is computed and the boundary radiances are copied only once
+        and no xr.DataArray is created, which reduces the overhead when rendering
+        many sensors (e.g. camera poses) against the same solution.
+
+        Parameters
+        ----------
+        rays : List
+            Each element is either a pyshdom sensor xr.Dataset (see sensor.py) with
+            the ray geometries or a tuple of the (x, y, z, mu, phi) arrays of the rays.
+
+        Returns
+        -------
+        stokes : np.ndarray, shape=(total number of rays, nstokes)
+            The C-contiguous Stokes Vectors of the rays of all elements of `rays`.
+        offsets : np.ndarray, shape=(len(rays) + 1,)
+            The rays of `rays[i]` are `stokes[offsets[i]:offsets[i+1]]`.
+
+        Raises
+        ------
+        TypeError
+            If an element of `rays` is not an xr.Dataset or a tuple of 5 arrays.
+        """
+        geometry = []
+        for ray_set in rays:
+            if isinstance(ray_set, xr.Dataset):
+                pyshdom.checks.check_hasdim(ray_set, ray_mu='nrays', ray_phi='nrays',
+                                            ray_x='nrays', ray_y='nrays', ray_z='nrays')
+                ray_set = tuple(ray_set[name].data for name in
+                                ('ray_x', 'ray_y', 'ray_z', 'ray_mu', 'ray_phi'))
+            elif not isinstance(ray_set, (tuple, list)) or len(ray_set) != 5:
+                raise TypeError("Each element of `rays` should be an xr.Dataset or a tuple "
+                                "of (x, y, z, mu, phi) arrays not '{}'".format(type(ray_set)))
+            geometry.append([np.ravel(array) for array in ray_set])
+        offsets = np.cumsum([0] + [ray_set[0].size for ray_set in geometry])
+
+        stokes = self.render_rays(*[np.concatenate(arrays) for arrays in zip(*geometry)])
+        return stokes, offsets
+
+    def render_rays(self, x, y, z, mu, phi, out=None):
+        """
+        Calculates the Stokes Vector of rays from arrays of their geometry.
+
+        This is the low-level rendering method used by RTE.integrate_to_sensor and
+        RTE.render_batch. It doesn't create any xarray objects and the Stokes Vectors
+        are written directly into `out` if it is provided.
+
+        Parameters
+        ----------
+        x, y, z : np.ndarray
+            The positions of the rays [km].
+        mu, phi : np.ndarray
+            The cosine of the zenith angle and the azimuth angle [rad] of the
+            direction of the rays (see sensor.py).
+        out : np.ndarray, shape=(nrays, nstokes), dtype=np.float32
+            A C-contiguous output buffer.
+
+        Returns
+        -------
+        out : np.ndarray, shape=(nrays, nstokes), dtype=np.float32
+            The Stokes Vector of each ray.
+
+        Raises
+        ------
+        ValueError
+            If the ray arrays have different sizes or `out` is not a C-contiguous
+            float32 array of shape (nrays, nstokes).
+        """
+        x, y, z, mu, phi = [np.ravel(array) for array in (x, y, z, mu, phi)]
+        nrays = x.size
+        if any([array.size != nrays for array in (y, z, mu, phi)]):
+            raise ValueError("The ray arrays `x`, `y`, `z`, `mu` and `phi` should all have "
+                             "the same size.")
+        if out is None:
+            out = np.empty((nrays, self._nstokes), dtype=np.float32)
+        elif not isinstance(out, np.ndarray) or out.dtype != np.float32 or \
+            out.shape != (nrays, self._nstokes) or not out.flags.c_contiguous:
+            raise ValueError("`out` should be a C-contiguous float32 array of shape {}.".format(
+                (nrays, self._nstokes)))
 
         self.check_solved()
         self._precompute_phase()
+        #the transpose of `out` is the Fortran ordered (nstokes, nrays) array that
+        #is filled in place.
+        self._render_rays(x, y, z, mu, phi, out.T)
+        return out
+
+    def render_chunks(self, sensor, chunk_size=1000000, sub_pixel_ray_args={'method': None}):
+        """
+        Renders a sensor in chunks of pixels, generating the sub-pixel rays of each
+        chunk lazily (see pyshdom.sensor.ray_chunks) and averaging them to pixels.
+
+        The peak memory is bounded by `chunk_size` rather than the number of rays
+        in the sensor, e.g. for push-broom like sensors with very many rays.
+
+        Parameters
+        ----------
+        sensor : xr.Dataset
+            A sensor generated by pyshdom.sensor.orthographic_projection or
+            pyshdom.sensor.perspective_projection (preferably without sub-pixel rays)
+            or any sensor if `sub_pixel_ray_args` has no 'method'.
+        chunk_size : int
+            The maximum number of rays rendered at once.
+        sub_pixel_ray_args : dict
+            The method for generating sub-pixel rays as in the projections
+            (e.g. {'method': pyshdom.sensor.gaussian, 'degree': (2, 3)}).
+
+        Yields
+        ------
+        pixels : slice
+            The indices of the pixels of the chunk.
+        stokes : np.ndarray, shape=(number of pixels in the chunk, nstokes)
+            The pixel averaged Stokes Vectors.
+
+        See Also
+        --------
+        RTE.stream_render
+        """
+        out = None
+        for pixels, rays in pyshdom.sensor.ray_chunks(sensor, chunk_size, sub_pixel_ray_args):
+            nrays = rays['ray_x'].size
+            if out is None or out.shape[0] < nrays:
+                out = np.empty((nrays, self._nstokes), dtype=np.float32)
+            stokes = self.render_rays(rays['ray_x'], rays['ray_y'], rays['ray_z'],
+                                      rays['ray_mu'], rays['ray_phi'], out=out[:nrays])
+            weighted_stokes = stokes*rays['ray_weight'][:, np.newaxis].astype(np.float32)
+            observables = pyshdom.core.average_subpixel_rays(
+                pixel_index=rays['pixel_index'],
+                nstokes=self._nstokes,
+                weighted_stokes=weighted_stokes.T,
+                nrays=nrays,
+                npixels=pixels.stop - pixels.start)
+            yield pixels, observables.T
+
+    def stream_render(self, sensor, output, chunk_size=1000000,
+                      sub_pixel_ray_args={'method': None}):
+        """
+        Renders a sensor in chunks (see RTE.render_chunks) and writes the pixel
+        averaged Stokes Vectors to disk or passes them to a callback.
+
+        Parameters
+        ----------
+        sensor : xr.Dataset
+            The sensor (see RTE.render_chunks).
+        output : str or callable
+            If a str, the path of a .npy file of shape (npixels, nstokes) that the
+            Stokes Vectors are written to. If callable, it is called as
+            output(pixels, stokes) for each chunk.
+        chunk_size : int
+            The maximum number of rays rendered at once.
+        sub_pixel_ray_args : dict
+            The method for generating sub-pixel rays (see RTE.render_chunks).
+
+        Returns
+        -------
+        stokes : np.memmap
+            If `output` is a path, the memory-mapped file, otherwise None.
+
+        Raises
+        ------
+        TypeError
+            If `output` is not a str or callable.
+        """
+        if isinstance(output, str):
+            stokes = np.lib.format.open_memmap(output, mode='w+', dtype=np.float32,
+                                               shape=(sensor.sizes['npixels'], self._nstokes))
+            for pixels, chunk in self.render_chunks(sensor, chunk_size, sub_pixel_ray_args):
+                stokes[pixels] = chunk
+            stokes.flush()
+            return stokes
+        if not callable(output):
+            raise TypeError("`output` should be a path or callable not '{}'".format(type(output)))
+        for pixels, chunk in self.render_chunks(sensor, chunk_size, sub_pixel_ray_args):
+            output(pixels, chunk)
+        return None
+
+    def _render_rays(self, camx, camy, camz, cammu, camphi, stokes):
+        """
+        Integrates the source function along rays (see RTE.render_rays).
+
+        The phase function table must already have been computed with
+        RTE._precompute_phase.
+
+        Parameters
+        ----------
+        camx, camy, camz, cammu, camphi : np.ndarray
+            The positions and directions of the rays.
+        stokes : np.ndarray, shape=(nstokes, nrays)
+            The Fortran ordered float32 array that the Stokes Vectors are written to.
 
-        output = pyshdom.core.render(
+        Returns
+        -------
+        stokes : np.ndarray, shape=(nstokes, nrays)
+            The Stokes Vector of each ray.
+        """
+        return pyshdom.core.render(
             nstphase=self._nstphase,
             ylmsun=self._ylmsun,
             phasetab=self._phasetab,
@@ -516,7 +870,7 @@ class RTE:
             camz=camz,
             cammu=cammu,
             camphi=camphi,
-            npix=total_pix,
+            npix=camx.size,
             nx=self._nx,
             ny=self._ny,
             nz=self._nz,
@@ -565,45 +919,14 @@ class RTE:
             legen=self._legen,
             dirflux=self._dirflux,
             fluxes=self._fluxes,
-            source=self._source,
+            source=self._uncompressed('_source'),
             srctype=self._srctype,
             sfctype=self._sfctype,
             units=self._units,
             total_ext=self._total_ext[:self._npts],
+            stokes=stokes,
             npart=self._npart)
 
-        sensor['I'] = xr.DataArray(
-            data=output[0],
-            dims='nrays',
-            attrs={
-                'long_name': 'Radiance'
-            }
-        )
-        if self._nstokes > 1:
-            sensor['Q'] = xr.DataArray(
-                data=output[1],
-                dims='nrays',
-                attrs={
-                    'long_name': 'Stokes Parameter for Linear Polarization (Q)'
-                }
-            )
-            sensor['U'] = xr.DataArray(
-                data=output[2],
-                dims='nrays',
-                attrs={
-                    'long_name': 'Stokes Parameter for Linear Polarization (U)'
-                }
-            )
-        if self._nstokes == 4:
-            sensor['V'] = xr.DataArray(
-                data=output[3],
-                dims='nrays',
-                attrs={
-                    'long_name': 'Stokes Parameter for Circular Polarization (V)'
-                }
-            )
-        return sensor
-
     def optical_path(self, sensor, deltam_scaled_path=False):
         """Calculates the optical paths along specified rays by integrating
         the extinction field.
@@ -830,7 +1153,7 @@ class RTE:
                                               rshptr=self._rshptr[:self._npts+1],
                                               ml=self._ml,
                                               mm=self._mm,
-                                              radiance=self._radiance,
+                                              radiance=self._uncompressed('_radiance'),
                                              )
             self._shterms = shterms
         sh_out_dataset = xr.Dataset(
@@ -937,7 +1260,7 @@ class RTE:
                 albedo=self._albedo[:self._npts],
                 planck=self._planck[:self._npts],
                 dirflux=self._dirflux[:self._npts],
-                radiance=self._radiance,
+                radiance=self._uncompressed('_radiance'),
                 npart=self._npart
                 )
             self._netfluxdiv = netfluxdiv
@@ -1017,7 +1340,8 @@ class RTE:
         self._direct_derivative_ptr = direct_derivative_ptr
         self._direct_derivative_path = direct_derivative_path
 
-    def calculate_microphysical_partial_derivatives(self, table_to_grid_method, table_data):
+    def calculate_microphysical_partial_derivatives(self, table_to_grid_method, table_data,
+                                                    derivative_tables=None):
         """
         Calculate the derivatives of optical properties with respect to the unknowns
         (microphysical or optical).
@@ -1030,15 +1354,27 @@ class RTE:
         ----------
         table_to_grid_method : callable
             An interpolation for mapping the derivatives from `table_data` onto the spatial
-            grid. See medium.py &
+            grid. See medium.py & pyshdom.containers.UnknownScatterers.
+            It must accept the `subset_table` argument of pyshdom.medium.table_to_grid.
         table_data : xr.Dataset
             Contains the partial derivatives as a function of microphysical properties
             this is the derivative analogue of a look up table of optical properties
             as a function of bulk microphysical parameters.
+        derivative_tables : dict
+            Stores the phase function derivative tables (see RTE._derivative_phase_tables).
+            It should be owned by the caller (e.g. pyshdom.containers.UnknownScatterers)
+            so that the tables are reused by the solvers which replace this one during
+            a retrieval. If None, the tables are only stored on this solver.
+
+        Notes
+        -----
+        The phase function derivative tables only depend on `table_data` and are
+        cached in `derivative_tables` so repeated calls during a retrieval only map
+        the extinction, single scattering albedo and phase function indices of the
+        derivatives onto the grid.
         """
 
         self._precompute_phase()
-        #solver_derivative_table = #all_derivative_tables[key]
         num_derivatives = sum([len(scatterer_derivative_table.values()) for
                                name, scatterer_derivative_table in table_data.items()
                               ])
@@ -1049,39 +1385,27 @@ class RTE:
         dalb = np.zeros(shape=[self._nbpts, num_derivatives], dtype=np.float32)
         diphase = np.zeros(shape=[self._nbpts, num_derivatives], dtype=np.int32)
 
-        #one loop through to find max_legendre and unkonwn_scatterer_indices
-        max_legendre = []
-        i = 0
-        for name, scatterer_derivative_table in table_data.items():
-            scatterer = self.medium[name]
-            inverse_mode = name == 'density'
-            for variable_derivative_table in scatterer_derivative_table.values():
-                derivative_on_grid = table_to_grid_method(scatterer, variable_derivative_table, inverse_mode=inverse_mode)
-                max_legendre.append(derivative_on_grid.sizes['legendre_index'])
-                unknown_scatterer_indices.append(i+1)
-            i += 1
-        max_legendre = max(max_legendre)
-        self._unknown_scatterer_indices = np.array(unknown_scatterer_indices).astype(np.int32)
-
-        #second loop to assign everything else.
-        padded_legcoefs = []
+        #the derivatives are mapped onto the grid with the full derivative tables
+        #(subset_table=False) so that the phase function derivatives only depend on
+        #the tables and not on the microphysics (see _derivative_phase_tables).
+        legcoefs = []
         count = 0
-        for name, scatterer_derivative_table in table_data.items():
+        offset = 0
+        for i, (name, scatterer_derivative_table) in enumerate(table_data.items()):
             scatterer = self.medium[name]
             inverse_mode = name in ('density', 'extinction')
             for variable_derivative_table in scatterer_derivative_table.values():
-                derivative_on_grid = table_to_grid_method(scatterer, variable_derivative_table, inverse_mode=inverse_mode)
-
+                derivative_on_grid = table_to_grid_method(scatterer, variable_derivative_table,
+                                                          inverse_mode=inverse_mode,
+                                                          subset_table=False)
                 dext[:, count] = derivative_on_grid.extinction.data.ravel()
                 dalb[:, count] = derivative_on_grid.ssalb.data.ravel()
-                diphase[:, count] = derivative_on_grid.table_index.data.ravel() + diphase.max()
-
-                padded_legcoefs.append(derivative_on_grid.legcoef.pad(
-                    {'legendre_index': (0, max_legendre - derivative_on_grid.legcoef.sizes['legendre_index'])},
-                    constant_values=0.0
-                ))
-
+                diphase[:, count] = derivative_on_grid.table_index.data.ravel() + offset
+                legcoefs.append(derivative_on_grid.legcoef)
+                offset += derivative_on_grid.legcoef.sizes['table_index']
+                unknown_scatterer_indices.append(i+1)
                 count += 1
+        self._unknown_scatterer_indices = np.array(unknown_scatterer_indices).astype(np.int32)
 
         #COPIED FROM solver.RTE
         #In regions which are not covered by any optical scatterer they have an iphasep of 0.
@@ -1091,40 +1415,11 @@ class RTE:
         #An arbitrary valid choice can be made as the contribution from these grid points is zero.
         diphase[np.where(diphase == 0)] = 1
 
-        # Concatenate all legendre tables into one table
-        legendre_table = xr.concat(padded_legcoefs, dim='table_index')
-        if self._nleg > legendre_table.sizes['legendre_index']:
-            legendre_table = legendre_table.pad(
-                {'legendre_index':
-                 (0, 1 + self._nleg - legendre_table.sizes['legendre_index'])
-                }, constant_values=0.0
-            )
-        dnumphase = legendre_table.sizes['table_index']
-        dleg = legendre_table.data
-
-        # zero the first term of the first component of the phase function
-        # gradient. Pre-scale the legendre moments by 1/(2*l+1) which
-        # is done in the forward problem in TRILIN_INTERP_PROP
+        if derivative_tables is None:
+            derivative_tables = self._derivative_tables
+        dleg, dphasetab = self._derivative_phase_tables(legcoefs, derivative_tables)
+        dnumphase = dleg.shape[-1]
         scaling_factor = np.atleast_3d(np.array([2.0*i+1.0 for i in range(0, self._nleg+1)]))
-        dleg[0, 0, :] = 0.0
-        dleg = dleg[:self._nstleg] / scaling_factor
-
-        #dphasetab holds tabulated values of the phase function derivative
-        # ie the inverse legendre transform of dleg evaluated at
-        # the same angles that the phase function is calculated.
-        dphasetab = pyshdom.core.precompute_phase_check_grad(
-            negcheck=False,
-            nstphase=self._nstphase,
-            nstleg=self._nstleg,
-            nscatangle=self._nscatangle,
-            nstokes=self._nstokes,
-            dnumphase=dnumphase,
-            ml=self._ml,
-            nlm=self._nlm,
-            nleg=self._nleg,
-            dleg=dleg,
-            deltam=self._deltam
-        )
 
         if self._deltam:
             deriv_ind = self._unknown_scatterer_indices - 1
@@ -1139,14 +1434,12 @@ class RTE:
             self._dalb = dalb*(1.0 - f)/((1.0 - f*albs)**2) + \
                 df*(albs - 1.0)*albs/((1.0 - f*albs)**2)
 
-            #find legen table that matches the dleg table.
-            table_ind = []
+            #find legen table that matches the dleg table. Entries of the dleg table
+            #that are not used on the grid are arbitrarily matched to the first
+            #legen table as their contribution is zero.
+            table_inds = np.zeros(dnumphase, dtype=np.int32)
             for i, ind in enumerate(deriv_ind):
-                for j in range(1, dleg.shape[-1]+1): #+1 to match iphase/diphase
-                    test = self._pa.iphasep[np.where(diphase[:, i] == j), ind]
-                    if test.shape[1] > 0:
-                        table_ind.append(np.unique(test))
-            table_inds = np.array(table_ind)[:, 0] - 1 #-1 back to python 0-indexing.
+                table_inds[diphase[:, i]-1] = self._pa.iphasep[:, ind]-1 #-1 back to python 0-indexing.
             table_legs = legs[:, :, table_inds]
             table_f = table_legs[0, self._ml]
             table_df = dleg[0, self._ml]
@@ -1188,6 +1481,95 @@ class RTE:
         )
 
 
+    def update_medium(self, medium):
+        """
+        Updates the optical properties of existing scatterers in place.
+
+        This is a cheaper alternative to initializing a new RTE object when the
+        optical properties change but the grid and scattering tables do not, e.g. during
+        a retrieval. Only the extinction, single scattering albedo and phase function
+        indices of the scatterers may change. The SHDOM property arrays are patched
+        and the optical properties on the current (possibly adaptive) grid are updated.
+        If a solution exists then the grid and radiance/source spherical harmonics
+        are kept and the direct beam is recalculated so that the solution can be
+        continued from its current state using RTE.solve(init_solution=False).
+
+        Parameters
+        ----------
+        medium : dict
+            Keys are names of scatterers in self.medium and values are xr.Dataset or
+            dict containing any of the 'extinction', 'ssalb' and 'table_index' variables
+            on the same grid as the original scatterer.
+
+        Raises
+        ------
+        KeyError
+            If a scatterer is not in self.medium or no supported variables are
+            supplied for it.
+        ValueError
+            If the shape of a variable is inconsistent with the grid.
+        pyshdom.exceptions.NegativeValueError
+            If the extinction is negative.
+        pyshdom.exceptions.OutOfRangeError
+            If the single scattering albedo or the phase function indices are out of range.
+        """
+        updated_medium = OrderedDict()
+        for name, variables in medium.items():
+            if name not in self.medium:
+                raise KeyError("scatterer '{}' is not in the medium of this RTE.".format(name))
+            scatterer = self.medium[name]
+            updated = OrderedDict([(var_name, np.asarray(variables[var_name])) for var_name in
+                                   ('extinction', 'ssalb', 'table_index') if var_name in variables])
+            if not updated:
+                raise KeyError(
+                    "No 'extinction', 'ssalb' or 'table_index' variables supplied for scatterer "
+                    "'{}'.".format(name))
+            for var_name, data in updated.items():
+                if data.shape != scatterer[var_name].shape:
+                    raise ValueError(
+                        "'{}' for scatterer '{}' has shape {} which is inconsistent with the grid {}"
+                        "".format(var_name, name, data.shape, scatterer[var_name].shape))
+            if 'extinction' in updated and np.any(updated['extinction'] < 0.0):
+                raise pyshdom.exceptions.NegativeValueError(
+                    "Negative values found in 'extinction' for scatterer '{}'.".format(name))
+            if 'ssalb' in updated and (np.any(updated['ssalb'] < 0.0) or
+                                       np.any(updated['ssalb'] > 1.0)):
+                raise pyshdom.exceptions.OutOfRangeError(
+                    "Values of 'ssalb' for scatterer '{}' are outside the range [0.0, 1.0]."
+                    "".format(name))
+            if 'table_index' in updated and (np.any(updated['table_index'] < 1) or
+                                             np.any(updated['table_index'] > scatterer.sizes['table_index'])):
+                raise pyshdom.exceptions.OutOfRangeError(
+                    "Values of 'table_index' for scatterer '{}' are outside the range [1, {}]."
+                    "".format(name, scatterer.sizes['table_index']))
+            scatterer = scatterer.copy()
+            for var_name, data in updated.items():
+                scatterer[var_name] = (scatterer[var_name].dims, data.astype(scatterer[var_name].dtype))
+            updated_medium[name] = scatterer
+        self.medium = OrderedDict(self.medium)
+        self.medium.update(updated_medium)
+
+        self._expand()
+        self._fill_property_arrays()
+        self._transfer_pa_to_grid()
+
+        if all([getattr(self, name, None) is not None for name in
+                ('_source', '_radiance', '_dirflux')]):
+            if self._srctype != 'T':
+                self._make_direct()
+            if self._accelflag:
+                self._oshptr[:self._npts+1] = self._shptr[:self._npts+1]
+                self._delsource[:, :self._oshptr[self._npts]] = 0.0
+            # Restart solution criteria as the current solution no longer
+            # corresponds to the medium.
+            self._solcrit = 1.0
+            self._iters = 0
+
+        #set the cached spherical_harmonics and net flux divergence to None
+        #as they no longer correspond to the medium.
+        self._netfluxdiv = None
+        self._shterms = None
+
     def load_solution(self, input_dataset, load_radiance=True):
         """
         Loads the grid and radiance/source spherical harmonics of another
@@ -1238,6 +1620,7 @@ class RTE:
 
         #read grid into memory here and overwrite normal grid from
         #initialization, no need to worry about this as this is small.
+        self._expand()
         if self._gridpos.shape[1] < input_dataset.npts.data:
             raise pyshdom.exceptions.SHDOMError(
                 "Cannot load solution as loaded grid has more points ({}) "
@@ -1354,11 +1737,253 @@ class RTE:
             output_dataset['shptr'] = (['npts+1'], self._shptr[:self._npts+1])
             output_dataset['rshptr'] = (['npts+2'], self._rshptr[:self._npts+2])
             output_dataset['source'] = (['nstokes_dim', 'sourcesize'],
-                                        self._source[:, :self._shptr[self._npts]])
+                                        self._uncompressed('_source')[:, :self._shptr[self._npts]])
             output_dataset['radiance'] = (['nstokes_dim', 'radsize'],
-                                          self._radiance[:, :self._rshptr[self._npts]])
+                                          self._uncompressed('_radiance')[:, :self._rshptr[self._npts]])
         return output_dataset
 
+    def compact(self):
+        """
+        Trims the grid and solution arrays to their used extent to free memory.
+
+        After RTE.solve, the grid point, cell and spherical harmonic arrays are still
+        sized by the memory parameters (MAXIG, MAXIC, MAXIV) even though only the
+        first npts/ncells/shptr[npts] entries are used. This trims them
+        (see RTE._solution_extents) and releases the work arrays and delsource which
+        are only needed during the solution iterations. The compacted solver can still
+        render and evaluate gradients. The arrays are re-expanded automatically
+        if the solution is continued (RTE.solve), updated (RTE.update_medium) or
+        replaced (RTE.load_solution).
+
+        Raises
+        ------
+        pyshdom.exceptions.SHDOMError
+            If there is no solution to compact.
+
+        See Also
+        --------
+        RTE.solve
+        pyshdom.containers.SolversDict.parallel_solve
+        """
+        if getattr(self, '_source', None) is None and self._compressed is None:
+            raise pyshdom.exceptions.SHDOMError(
+                "There is no solution to compact. Please run RTE.solve() first."
+            )
+        if self._allocated_shapes is None:
+            self._allocated_shapes = {}
+        for name, (axis, size) in self._solution_extents().items():
+            value = getattr(self, name)
+            if value is not None and value.shape[axis] > size:
+                self._allocated_shapes.setdefault(name, (value.shape, value.dtype))
+                setattr(self, name, np.asfortranarray(value.take(np.arange(size), axis=axis)))
+        for name in ('_work', '_work1', '_work2', '_delsource'):
+            value = getattr(self, name)
+            if value is not None:
+                self._allocated_shapes[name] = (value.shape, value.dtype)
+                setattr(self, name, None)
+
+    def compress(self, block_size=64, sensor=None):
+        """
+        Stores the spherical harmonic source and radiance of a solved solver in float16
+        to reduce memory.
+
+        The arrays are first trimmed (see RTE.compact) and then stored in blocks of
+        `block_size` coefficients, each with its own float32 scale factor
+        (see pyshdom.util.float16_compress). This halves the memory of the largest
+        arrays. They are decompressed on demand when rendering, evaluating gradients
+        or calculating fluxes/spherical harmonics, and permanently if the solution
+        is continued, updated or replaced.
+
+        Parameters
+        ----------
+        block_size : int
+            The number of coefficients that share a scale factor.
+        sensor : xr.Dataset
+            An optional sensor (see sensor.py) which is rendered before and after
+            compression to measure the accuracy impact on the radiances.
+
+        Returns
+        -------
+        errors : OrderedDict
+            The maximum absolute error of the compressed '_source' and '_radiance'
+            relative to the maximum absolute value of each array. If `sensor` is
+            provided, then also the maximum absolute error of each Stokes component
+            of the rendered radiances relative to their maximum absolute value.
+
+        See Also
+        --------
+        RTE.decompress
+        """
+        if sensor is not None:
+            reference = self.integrate_to_sensor(sensor.copy(deep=True))
+        self.compact()
+        if self._compressed is None:
+            self._compressed = OrderedDict()
+        errors = OrderedDict()
+        for name in ('_source', '_radiance'):
+            value = getattr(self, name)
+            if value is None:
+                continue
+            self._compressed[name] = pyshdom.util.float16_compress(value, block_size)
+            errors[name] = float(np.max(np.abs(self._uncompressed(name) - value)) / \
+                max(np.max(np.abs(value)), np.finfo(np.float32).tiny))
+            setattr(self, name, None)
+        if sensor is not None:
+            compressed = self.integrate_to_sensor(sensor.copy(deep=True))
+            for stokes in ('I', 'Q', 'U', 'V'):
+                if stokes in reference:
+                    errors[stokes] = float(np.max(np.abs(compressed[stokes] - reference[stokes])) / \
+                        max(np.max(np.abs(reference[stokes])), np.finfo(np.float32).tiny))
+        return errors
+
+    def decompress(self):
+        """
+        Restores the float32 source and radiance arrays of a solver compressed
+        with RTE.compress. This does nothing if the solver is not compressed.
+        """
+        if self._compressed is None:
+            return
+        for name in self._compressed:
+            setattr(self, name, self._uncompressed(name))
+        self._compressed = None
+
+    def _uncompressed(self, name):
+        """
+        Returns the float32 `name` ('_source' or '_radiance') array, decompressing
+        it (into a new array) if the solver is compressed.
+        """
+        if self._compressed is not None and name in self._compressed:
+            return pyshdom.util.float16_decompress(self._compressed[name])
+        return getattr(self, name)
+
+    def _solution_extents(self):
+        """
+        The axis and used extent of each of the arrays whose allocated size is set
+        by the memory parameters (MAXIG, MAXIC, MAXIV).
+
+        Returns
+        -------
+        extents : OrderedDict
+            Keys are attribute names, values are (axis, used_size).
+        """
+        npts, ncells = self._npts, self._ncells
+        extents = OrderedDict()
+        for name in ('_gridpos', '_fluxes'):
+            extents[name] = (1, npts)
+        for name in ('_dirflux', '_temp', '_total_ext', '_extinct', '_albedo',
+                     '_iphase', '_planck'):
+            extents[name] = (0, npts)
+        for name in ('_gridptr', '_neighptr', '_treeptr'):
+            extents[name] = (1, ncells)
+        extents['_cellflags'] = (0, ncells)
+        extents['_shptr'] = (0, npts + 1)
+        extents['_oshptr'] = (0, npts + 1)
+        extents['_rshptr'] = (0, npts + 2)
+        extents['_source'] = (1, self._shptr[npts])
+        extents['_radiance'] = (1, self._rshptr[npts])
+        return extents
+
+    def _get_solution_state(self):
+        """
+        Collects the internal state of a solved RTE in a compact, picklable form.
+
+        This is everything that RTE.solve modifies, with the 'big' arrays trimmed to
+        their used extent (as in RTE.save_solution) and the scratch arrays
+        (work arrays and delsource) omitted. The inputs (medium, source, surface etc.)
+        are not included as they are unchanged by a solution. The state can be restored
+        into an RTE object initialized with the same inputs using
+        RTE._set_solution_state, after which the solver can render without being resolved.
+
+        Returns
+        -------
+        state : dict
+            The solution state.
+
+        See Also
+        --------
+        pyshdom.containers.SolversDict.parallel_solve
+        """
+        exclude = ('medium', 'numerical_params', 'source', 'surface', 'atmosphere',
+                   '_grid', '_pa', '_restore_data', '_phasetab', '_phasetab_key',
+                   '_derivative_tables', '_allocated_shapes', '_compressed')
+        scratch = ('_work', '_work1', '_work2', '_delsource')
+        extents = self._solution_extents()
+        #the allocated shapes of arrays trimmed by RTE.compact.
+        allocated = self._allocated_shapes or {}
+
+        state = {}
+        shapes = {}
+        for name, value in vars(self).items():
+            if name in exclude:
+                continue
+            if self._compressed is not None and name in self._compressed:
+                value = self._uncompressed(name)
+            if name in scratch:
+                if name in allocated:
+                    shapes[name] = allocated[name]
+                elif value is not None:
+                    shapes[name] = (value.shape, value.dtype)
+            elif name in extents and value is not None:
+                axis, size = extents[name]
+                shapes[name] = allocated.get(name, (value.shape, value.dtype))
+                state[name] = np.asfortranarray(value.take(np.arange(size), axis=axis))
+            else:
+                state[name] = value
+        state['_pa.extdirp'] = self._pa.extdirp
+        state['_allocated_shapes'] = shapes
+        return state
+
+    def _set_solution_state(self, state, expand=True):
+        """
+        Restores the internal state of a solved RTE from RTE._get_solution_state.
+
+        The trimmed arrays are padded back to their allocated sizes and the scratch
+        arrays are reallocated so that the solution can be continued with
+        RTE.solve(init_solution=False).
+
+        Parameters
+        ----------
+        state : dict
+            The output of RTE._get_solution_state from an RTE object initialized
+            with the same inputs as self.
+        expand : bool
+            If False, the solver is left compacted (see RTE.compact) with the arrays
+            in `state` used directly rather than copied e.g. memory-mapped arrays
+            from pyshdom.containers.SolutionStore.
+        """
+        state = dict(state)
+        self._compressed = None
+        self._allocated_shapes = state.pop('_allocated_shapes')
+        self._pa.extdirp = state.pop('_pa.extdirp')
+        for name, value in state.items():
+            setattr(self, name, value)
+        for name in self._allocated_shapes:
+            if name not in state:
+                setattr(self, name, None)
+        if expand:
+            self._expand()
+
+    def _expand(self):
+        """
+        Pads the arrays trimmed by RTE.compact (or RTE._get_solution_state) back to
+        their allocated sizes and reallocates the work arrays so that the solution
+        can be continued. Compressed arrays (see RTE.compress) are also decompressed.
+        """
+        self.decompress()
+        if self._allocated_shapes is None:
+            return
+        for name, (shape, dtype) in self._allocated_shapes.items():
+            value = getattr(self, name, None)
+            full = np.zeros(shape, dtype=dtype, order='F')
+            if value is not None:
+                full[tuple(slice(0, size) for size in value.shape)] = value
+            setattr(self, name, full)
+        self._allocated_shapes = None
+        # The sweeping order of the discrete ordinate integration is stored in
+        # work1 and is only recomputed when the number of grid points changes.
+        # As work1 has been reallocated, force its recalculation.
+        self._oldnpts = 0
+
 
     def _setup_medium(self, medium):
         """
@@ -1918,6 +2543,74 @@ class RTE:
 
         self._maxnbc = int(self._maxig * 3 / self._nz)
 
+    def _grow_memory(self, growth_factor):
+        """
+        Enlarges the grid point, cell and spherical harmonic arrays (MAXIG, MAXIC, MAXIV)
+        by `growth_factor` so that the adaptive grid cell splitting can continue.
+
+        The current grid and solution are copied into the larger arrays. The arrays are
+        only grown as far as `max_total_mb` and the int32 array size limit allow.
+
+        Parameters
+        ----------
+        growth_factor : float
+            The factor by which to enlarge the arrays.
+
+        Returns
+        -------
+        grown : bool
+            False if the arrays could not be enlarged.
+        """
+        base = self._memory_model(0, 0, 0)
+        current = self._memory_model(self._maxig, self._maxic, self._maxiv)
+        growth_factor = min(growth_factor, (self._max_total_mb - base)/(current - base),
+                            self._max_int32_size/(self._maxiv + self._maxig),
+                            self._max_int32_size/(4.0*8.0*self._maxic))
+        maxig = int(growth_factor * self._maxig)
+        if maxig <= self._maxig:
+            warnings.warn(
+                "The adaptive grid cannot be grown further within max_total_mb ({}). "
+                "Cell splitting will stop.".format(self._max_total_mb))
+            return False
+
+        maxic = int(growth_factor * self._maxic)
+        maxiv = int(growth_factor * self._maxiv)
+        maxido = maxig * self._nphi0max
+        maxnbc = int(maxig * 3 / self._nz)
+        maxbcrad = int(np.ceil(self._maxbcrad * maxnbc / self._maxnbc))
+
+        sizes = [('_gridpos', 1, maxig), ('_fluxes', 1, maxig), ('_dirflux', 0, maxig),
+                 ('_temp', 0, maxig), ('_total_ext', 0, maxig), ('_extinct', 0, maxig),
+                 ('_albedo', 0, maxig), ('_iphase', 0, maxig), ('_planck', 0, maxig),
+                 ('_shptr', 0, maxig + 1), ('_oshptr', 0, maxig + 1), ('_rshptr', 0, maxig + 2),
+                 ('_work1', 0, 8 * maxig), ('_work2', 0, max(maxig * self._nstokes, maxic)),
+                 ('_gridptr', 1, maxic), ('_neighptr', 1, maxic), ('_treeptr', 1, maxic),
+                 ('_cellflags', 0, maxic), ('_source', 1, maxiv), ('_radiance', 1, maxiv + maxig),
+                 ('_work', 0, maxido * self._nstokes), ('_bcptr', 0, maxnbc),
+                 ('_bcrad', 1, maxbcrad), ('_sfcgridparms', 0, self._maxsfcpars * maxnbc)]
+        if self._accelflag:
+            sizes.append(('_delsource', 1, maxiv))
+
+        for name, axis, size in sizes:
+            old = getattr(self, name)
+            shape = list(old.shape)
+            shape[axis] = size
+            new = np.zeros(shape, dtype=old.dtype, order='F')
+            new[tuple(slice(0, length) for length in old.shape)] = old
+            setattr(self, name, new)
+
+        self._maxig, self._maxic, self._maxiv, self._maxido = maxig, maxic, maxiv, maxido
+        self._maxnbc, self._maxbcrad = maxnbc, maxbcrad
+        self._adapt_grid_factor = self._maxig / self._nbpts
+        self._cell_to_point_ratio = self._maxic / self._maxig
+        self._num_sh_term_factor = self._maxiv / (self._nlm * self._maxig)
+        if self._accelflag:
+            self._ndelsource = self._maxiv
+        # The sweeping order and boundary points depend on the array sizes so
+        # force their recalculation.
+        self._oldnpts = 0
+        return True
+
     def _prepare_optical_properties(self):
         """
         A utility function that prepares the optical properties for the initialization
@@ -1932,18 +2625,7 @@ class RTE:
         self._pa.extinctp = np.zeros(shape=[self._nbpts, len(self.medium)], dtype=np.float32)
         self._pa.albedop = np.zeros(shape=[self._nbpts, len(self.medium)], dtype=np.float32)
         self._pa.iphasep = np.zeros(shape=[self._nbpts, len(self.medium)], dtype=np.int32)
-        for i, scatterer in enumerate(self.medium.values()):
-            self._pa.extinctp[:, i] = scatterer.extinction.data.ravel()
-            self._pa.albedop[:, i] = scatterer.ssalb.data.ravel()
-            self._pa.iphasep[:, i] = scatterer.table_index.data.ravel() + self._pa.iphasep.max()
-
-        #In regions which are not covered by any optical scatterer they have an iphasep of 0.
-        #In original SHDOM these would be pointed to the rayleigh phase function
-        #(which is always included in the legendre table even if there is no rayleigh
-        # extinction.)
-        #Here, instead we set them to whatever the first phase function is.
-        #An arbitrary valid choice can be made as the contribution from these grid points is zero.
-        self._pa.iphasep[np.where(self._pa.iphasep == 0)] = 1
+        self._fill_property_arrays()
 
         # Concatenate all scatterer tables into one large table
         max_legendre = max([scatterer.sizes['legendre_index'] for
@@ -1958,9 +2640,6 @@ class RTE:
 
         self._pa.numphase = legendre_table.sizes['table_index']
 
-        if np.any(self._pa.iphasep < 1) or np.any(self._pa.iphasep > self._pa.numphase):
-            raise pyshdom.exceptions.OutOfRangeError("Phase function indices are out of bounds.")
-
         # Determine the number of legendre coefficient for a given angular resolution
         self._nleg = self._ml + 1 if self._deltam else self._ml
 
@@ -1998,8 +2677,67 @@ class RTE:
         self._npart = len(self.medium)
         self._nstphase = min(self._nstleg, 2)
 
-        # Transfer property arrays into internal grid structures
-        # also does the delta-M scaling if necessary.
+        self._transfer_pa_to_grid()
+
+        #calculate cell averaged extinctions so that warnings can be raised
+        #about optical thickness of cells. High optical thickness across a cell
+        #leads to lower accuracy for SHDOM.
+        reshaped_ext = self._total_ext[:self._nbpts].reshape(self._nx, self._ny, self._nz)
+        cell_averaged_extinct = (reshaped_ext[1:, 1:, 1:] + reshaped_ext[1:, 1:, :-1] +   \
+                                 reshaped_ext[1:, :-1, 1:] + reshaped_ext[1:, :-1, :-1] + \
+                                 reshaped_ext[:-1, 1:, 1:] + reshaped_ext[:-1, 1:, :-1] + \
+                                 reshaped_ext[:-1, :-1, 1:] + reshaped_ext[:-1, :-1, :-1])/8.0
+        cell_volume = (np.diff(self._pa.zlevels)*self._pa.delx.data*self._pa.dely.data)**(1/3)
+        cell_tau_approx = cell_volume[np.newaxis, np.newaxis, :]*cell_averaged_extinct
+        number_thick_cells = np.sum(cell_tau_approx >= 2.0)
+
+        if number_thick_cells > 0:
+            warnings.warn("Number of property grid cells with optical depth greater than 2: '{}'. "
+                          "Max cell optical depth: '{}'".format(
+                              number_thick_cells, np.max(cell_tau_approx)
+                              )
+                         )
+
+        if (not self._deltam) & (self._srctype != 'T') & (self._maxasym > 0.5):
+            warnings.warn("Delta-M should be use for solar radiative transfer problems with highly "
+                          "peaked phase functions.")
+
+    def _fill_property_arrays(self):
+        """
+        Fills the SHDOM property arrays (extinctp, albedop, iphasep) in place
+        from the scatterers in self.medium.
+
+        The (1-based) table_index of each scatterer is offset by the sizes of the
+        tables of the preceding scatterers so that iphasep points into the
+        concatenated legendre table (see RTE._prepare_optical_properties).
+
+        Raises
+        ------
+        pyshdom.exceptions.OutOfRangeError
+            If any of the phase function indices are outside the concatenated table.
+        """
+        offset = 0
+        for i, scatterer in enumerate(self.medium.values()):
+            self._pa.extinctp[:, i] = scatterer.extinction.data.ravel()
+            self._pa.albedop[:, i] = scatterer.ssalb.data.ravel()
+            table_index = scatterer.table_index.data.ravel()
+            #In regions which are not covered by any optical scatterer they have a table_index of 0.
+            #In original SHDOM these would be pointed to the rayleigh phase function
+            #(which is always included in the legendre table even if there is no rayleigh
+            # extinction.)
+            #Here, instead we set them to whatever the first phase function is.
+            #An arbitrary valid choice can be made as the contribution from these grid points is zero.
+            self._pa.iphasep[:, i] = np.where(table_index == 0, 1, table_index + offset)
+            offset += scatterer.sizes['table_index']
+
+        if np.any(self._pa.iphasep < 1) or np.any(self._pa.iphasep > offset):
+            raise pyshdom.exceptions.OutOfRangeError("Phase function indices are out of bounds.")
+
+    def _transfer_pa_to_grid(self):
+        """
+        Transfer property arrays into internal grid structures (including
+        any adaptive grid points) and also does the delta-M scaling if necessary.
+        """
         # ._extinct etc are the arrays used to solve the RTE. They still
         # have shape=(npts, nparticles) as the relative contribution of each
         # particle to the total extinction is needed for the mixing of the phase
@@ -2038,29 +2776,6 @@ class RTE:
             srctype=self._srctype,
             npts=self._npts)
 
-        #calculate cell averaged extinctions so that warnings can be raised
-        #about optical thickness of cells. High optical thickness across a cell
-        #leads to lower accuracy for SHDOM.
-        reshaped_ext = self._total_ext[:self._nbpts].reshape(self._nx, self._ny, self._nz)
-        cell_averaged_extinct = (reshaped_ext[1:, 1:, 1:] + reshaped_ext[1:, 1:, :-1] +   \
-                                 reshaped_ext[1:, :-1, 1:] + reshaped_ext[1:, :-1, :-1] + \
-                                 reshaped_ext[:-1, 1:, 1:] + reshaped_ext[:-1, 1:, :-1] + \
-                                 reshaped_ext[:-1, :-1, 1:] + reshaped_ext[:-1, :-1, :-1])/8.0
-        cell_volume = (np.diff(self._pa.zlevels)*self._pa.delx.data*self._pa.dely.data)**(1/3)
-        cell_tau_approx = cell_volume[np.newaxis, np.newaxis, :]*cell_averaged_extinct
-        number_thick_cells = np.sum(cell_tau_approx >= 2.0)
-
-        if number_thick_cells > 0:
-            warnings.warn("Number of property grid cells with optical depth greater than 2: '{}'. "
-                          "Max cell optical depth: '{}'".format(
-                              number_thick_cells, np.max(cell_tau_approx)
-                              )
-                         )
-
-        if (not self._deltam) & (self._srctype != 'T') & (self._maxasym > 0.5):
-            warnings.warn("Delta-M should be use for solar radiative transfer problems with highly "
-                          "peaked phase functions.")
-
     def _release_big_arrays(self):
         """
         Destroy the big arrays if they exist to free memory.
@@ -2070,6 +2785,7 @@ class RTE:
         """
         self._source = None
         self._radiance = None
+        self._compressed = None
         self._delsource = None
         self._work = None
         self._work1 = None
@@ -2123,7 +2839,9 @@ class RTE:
         self._dirflux = np.zeros((self._maxig), dtype=np.float32, order='F')
         self._work1 = np.zeros((8*self._maxig), dtype=np.int32, order='F')
         self._work = np.zeros((self._maxido*self._nstokes), dtype=np.float32, order='F')
-        self._work2 = np.zeros((self._maxig*self._nstokes), dtype=np.float32, order='F')
+        #work2 also holds the cell splitting indices (one per leaf cell) in SPLIT_GRID.
+        self._work2 = np.zeros((max(self._maxig*self._nstokes, self._maxic)),
+                               dtype=np.float32, order='F')
         self._bcrad = np.zeros((self._nstokes, self._maxbcrad), dtype=np.float32, order='F')
         self._fluxes = np.zeros((2, self._maxig), dtype=np.float32, order='F')
 
@@ -2260,20 +2978,111 @@ class RTE:
         """
         Precompute angular scattering for the entire legendre table.
         Perform a negativity check. (negcheck=True).
+
+        The table is only recomputed if the legendre table has changed. Tables
+        are shared read-only between live solvers with identical legendre tables
+        and parameters (see _PHASE_TABLES).
         """
-        self._phasetab = pyshdom.core.precompute_phase_check(
-            negcheck=True,
-            nscatangle=self._nscatangle,
-            numphase=self._pa.numphase,
+        legen = np.asfortranarray(self._legen)
+        key = (hashlib.sha1(legen.ravel(order="A")).hexdigest(), legen.shape, self._nscatangle,
+               self._pa.numphase, self._nstphase, self._nstokes, self._nstleg, self._nleg,
+               self._ml, self._nlm, bool(self._deltam))
+        if self._phasetab is not None and self._phasetab_key == key:
+            return
+        with _PHASE_TABLES_LOCK:
+            phasetab = _PHASE_TABLES.get(key)
+        if phasetab is None:
+            phasetab = pyshdom.core.precompute_phase_check(
+                negcheck=True,
+                nscatangle=self._nscatangle,
+                numphase=self._pa.numphase,
+                nstphase=self._nstphase,
+                nstokes=self._nstokes,
+                nstleg=self._nstleg,
+                nleg=self._nleg,
+                ml=self._ml,
+                nlm=self._nlm,
+                legen=legen,
+                deltam=self._deltam
+            )
+            phasetab.flags.writeable = False
+            with _PHASE_TABLES_LOCK:
+                phasetab = _PHASE_TABLES.setdefault(key, phasetab)
+        self._phasetab = phasetab
+        self._phasetab_key = key
+
+    def _derivative_phase_tables(self, legcoefs, store):
+        """
+        Prepares the legendre table of the phase function derivatives (dleg) and
+        its tabulated values at the scattering angles (dphasetab).
+
+        The tables only depend on the derivative tables (see
+        RTE.calculate_microphysical_partial_derivatives) and are kept in `store`
+        so that they are only computed once during a retrieval. They are kept apart
+        from the phase function tables (see RTE._precompute_phase) so that they are
+        not evicted by those of other wavelengths.
+
+        Parameters
+        ----------
+        legcoefs : List
+            The legendre tables (xr.DataArray) of each derivative.
+        store : dict
+            Holds the tables of the latest `legcoefs`. It is updated in place.
+
+        Returns
+        -------
+        dleg : np.ndarray
+            The concatenated legendre tables pre-scaled by 1/(2*l+1).
+        dphasetab : np.ndarray
+            The inverse legendre transform of `dleg` evaluated at the same angles that
+            the phase function is calculated. Both are read-only.
+        """
+        hasher = hashlib.sha1()
+        for legcoef in legcoefs:
+            data = np.ascontiguousarray(legcoef.data)
+            hasher.update(str(data.shape).encode())
+            hasher.update(data)
+        key = (hasher.hexdigest(), self._nscatangle, self._nstphase,
+               self._nstokes, self._nstleg, self._nleg, self._ml, self._nlm, bool(self._deltam))
+        tables = store.get(key)
+        if tables is not None:
+            return tables
+
+        # Concatenate all legendre tables into one table
+        nlegendre = max([self._nleg + 1] + [legcoef.sizes['legendre_index'] for legcoef in legcoefs])
+        dleg = np.concatenate([np.pad(legcoef.data, ((0, 0), (0, nlegendre - legcoef.sizes['legendre_index']),
+                                                     (0, 0)))
+                               for legcoef in legcoefs], axis=-1)
+
+        # zero the first term of the first component of the phase function
+        # gradient. Pre-scale the legendre moments by 1/(2*l+1) which
+        # is done in the forward problem in TRILIN_INTERP_PROP
+        scaling_factor = np.atleast_3d(np.array([2.0*i+1.0 for i in range(0, self._nleg+1)]))
+        dleg[0, 0, :] = 0.0
+        dleg = dleg[:self._nstleg, :self._nleg+1] / scaling_factor
+
+        #dphasetab holds tabulated values of the phase function derivative
+        # ie the inverse legendre transform of dleg evaluated at
+        # the same angles that the phase function is calculated.
+        dphasetab = pyshdom.core.precompute_phase_check_grad(
+            negcheck=False,
             nstphase=self._nstphase,
-            nstokes=self._nstokes,
             nstleg=self._nstleg,
-            nleg=self._nleg,
+            nscatangle=self._nscatangle,
+            nstokes=self._nstokes,
+            dnumphase=dleg.shape[-1],
             ml=self._ml,
             nlm=self._nlm,
-            legen=self._legen,
+            nleg=self._nleg,
+            dleg=dleg,
             deltam=self._deltam
         )
+        dleg.flags.writeable = False
+        dphasetab.flags.writeable = False
+        #only the tables of the latest `legcoefs` are kept.
+        store.clear()
+        store[key] = (dleg, dphasetab)
+        return dleg, dphasetab
 
     def _make_direct(self):
         """
@@ -225,7 +225,7 @@ def plot_cell_grid(solver, y, visualize=None):
             nstokes=solver._nstokes,
             total_ext=solver._total_ext,
             shptr=solver._shptr,
-            source=solver._source,
+            source=solver._uncompressed('_source'),
             ncells=solver._ncells
        )
 
@@ -296,6 +296,68 @@ def planck_function(temperature, wavelength, c=2.99792458e8, h=6.62606876e-34, k
     radiance = 2*h*c**2/ wavelength**5 *1.0/(np.exp((h*c)/(wavelength*k*temperature)) - 1.0)*1e-6
     return radiance
 
+def float16_compress(array, block_size=64):
+    """
+    Compresses an array to float16 with a float32 scale factor for each block of
+    `block_size` consecutive elements (in Fortran order).
+
+    Each block is scaled by its maximum absolute value before conversion so
+    the relative precision of float16 (~5e-4) applies to the largest element in each block
+    and values outside the float16 range do not overflow.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The (floating point) array to compress.
+    block_size : int
+        The number of elements that share a scale factor.
+
+    Returns
+    -------
+    compressed : dict
+        The float16 'data' with shape (nblocks, block_size), the float32 block 'scales',
+        and the 'shape' and 'dtype' of `array`.
+
+    See Also
+    --------
+    float16_decompress
+    """
+    if block_size < 1:
+        raise ValueError("`block_size` should be a positive integer not '{}'".format(block_size))
+    flat = np.ravel(array, order='F').astype(np.float32)
+    nblocks = -(-flat.size // block_size)
+    blocks = np.zeros(nblocks*block_size, dtype=np.float32)
+    blocks[:flat.size] = flat
+    blocks = blocks.reshape(nblocks, block_size)
+    scales = np.abs(blocks).max(axis=1)
+    scales[scales == 0.0] = 1.0
+    compressed = {
+        'data': (blocks/scales[:, np.newaxis]).astype(np.float16),
+        'scales': scales,
+        'shape': array.shape,
+        'dtype': array.dtype
+    }
+    return compressed
+
+def float16_decompress(compressed):
+    """
+    Decompresses an array compressed with float16_compress.
+
+    Parameters
+    ----------
+    compressed : dict
+        The output of float16_compress.
+
+    Returns
+    -------
+    array : np.ndarray
+        The decompressed (Fortran ordered) array.
+    """
+    flat = (compressed['data'].astype(np.float32)*compressed['scales'][:, np.newaxis]).ravel()
+    size = int(np.prod(compressed['shape']))
+    return np.asfortranarray(
+        flat[:size].reshape(compressed['shape'], order='F').astype(compressed['dtype']))
+
 def cell_average_comparison(reference, other, variable_name):
     """
     calculates average values of 'variable name' in the cells
@@ -0,0 +1,122 @@
+"""
+Benchmark input validation
+--------------------------
+Measures the share of time spent in the pyshdom.checks functions when the
+optical properties and solver.RTE object are repeatedly rebuilt from the
+microphysics, as is done by the `set_state_fn` at each iteration of a retrieval,
+with and without pyshdom.checks.trusted.
+
+For information about the command line flags see:
+  python scripts/benchmark_checks.py --help
+
+Example usage (from the repository root):
+  python scripts/benchmark_checks.py --repeats 20
+"""
+import time
+import argparse
+import numpy as np
+import pyshdom
+
+
+def argument_parsing():
+    """
+    Handle all the argument parsing needed for this script.
+
+    Returns
+    -------
+    args: arguments from argparse.ArgumentParser()
+        The arguments required for this script
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cloud_path',
+                        default='data/synthetic_cloud_fields/jpl_les/rico32x37x26.txt',
+                        help='(default value: %(default)s) Path to the synthetic cloud field.')
+    parser.add_argument('--mie_dir',
+                        default='mie_tables',
+                        help='(default value: %(default)s) Directory of the monodisperse mie tables.'
+                             ' Tables that do not exist will be computed and saved here.')
+    parser.add_argument('--config_path',
+                        default='default_config.json',
+                        help='(default value: %(default)s) Path to the numerical parameters.')
+    parser.add_argument('--wavelength',
+                        default=0.86,
+                        type=float,
+                        help='(default value: %(default)s) Wavelength [micron].')
+    parser.add_argument('--repeats',
+                        default=10,
+                        type=int,
+                        help='(default value: %(default)s) Number of state updates to time.')
+    return parser.parse_args()
+
+
+def update_state(cloud_scatterer_on_rte_grid, poly_table, config, wavelength):
+    """
+    Rebuilds the optical properties and solver from the microphysics.
+
+    Parameters
+    ----------
+    cloud_scatterer_on_rte_grid : xr.Dataset
+        The microphysics on the SHDOM grid.
+    poly_table : xr.Dataset
+        The polydisperse mie table.
+    config : OrderedDict
+        The numerical parameters of the solver.
+    wavelength : float
+        The wavelength [micron].
+
+    Returns
+    -------
+    solver : pyshdom.solver.RTE
+        The unsolved solver.
+    """
+    cloud_optical_scatterer = pyshdom.medium.table_to_grid(cloud_scatterer_on_rte_grid, poly_table)
+    return pyshdom.solver.RTE(
+        numerical_params=config,
+        medium={'cloud': cloud_optical_scatterer},
+        source=pyshdom.source.solar(wavelength, -1*np.cos(np.deg2rad(40.0)), 0.0, solarflux=1.0),
+        surface=pyshdom.surface.lambertian(albedo=0.04),
+        num_stokes=1
+        )
+
+
+if __name__ == "__main__":
+    args = argument_parsing()
+    cloud_scatterer = pyshdom.util.load_from_csv(args.cloud_path, density='lwc', origin=(0.0, 0.0))
+    merged_z_coordinate = pyshdom.grid.combine_z_coordinates([cloud_scatterer])
+    rte_grid = pyshdom.grid.make_grid(cloud_scatterer.x[1]-cloud_scatterer.x[0], cloud_scatterer.x.size,
+                                      cloud_scatterer.y[1]-cloud_scatterer.y[0], cloud_scatterer.y.size,
+                                      merged_z_coordinate)
+    cloud_scatterer_on_rte_grid = pyshdom.grid.resample_onto_grid(rte_grid, cloud_scatterer)
+    cloud_scatterer_on_rte_grid['veff'] = (cloud_scatterer_on_rte_grid.reff.dims,
+                                           np.full_like(cloud_scatterer_on_rte_grid.reff.data,
+                                                        fill_value=0.1))
+    mie_mono_table = pyshdom.mie.get_mono_table('Water', (args.wavelength, args.wavelength),
+                                                relative_dir=args.mie_dir)
+    cloud_size_distribution = pyshdom.size_distribution.get_size_distribution_grid(
+        mie_mono_table.radius.data,
+        size_distribution_function=pyshdom.size_distribution.gamma, particle_density=1.0,
+        reff={'coord_min': 4.0, 'coord_max': 25.0, 'npoints': 25,
+              'spacing': 'logarithmic', 'units': 'micron'},
+        veff={'coord_min': 0.09, 'coord_max': 0.11, 'npoints': 2,
+              'spacing': 'linear', 'units': 'unitless'},
+        )
+    poly_table = pyshdom.mie.get_poly_table(cloud_size_distribution, mie_mono_table)
+    config = pyshdom.configuration.get_config(args.config_path)
+
+    #validate the schemas once, as happens when the initial state is set up.
+    update_state(cloud_scatterer_on_rte_grid, poly_table, config, args.wavelength)
+
+    for trusted in (False, True):
+        pyshdom.checks.timings(reset=True)
+        start = time.time()
+        with pyshdom.checks.trusted(trusted):
+            for _ in range(args.repeats):
+                update_state(cloud_scatterer_on_rte_grid, poly_table, config, args.wavelength)
+        total = time.time() - start
+        timings = pyshdom.checks.timings(reset=True)
+        checks_time = sum([timing['time'] for timing in timings.values()])
+        print('trusted={}: {:.3f} s per update, {:.3f} s in checks ({:.1f}%)'.format(
+            trusted, total/args.repeats, checks_time/args.repeats, 100*checks_time/total))
+        for name, timing in timings.items():
+            print('{:>20s}: {:6d} calls {:6d} skipped {:8.4f} s'.format(
+                name, timing['calls'], timing['skipped'], timing['time']))
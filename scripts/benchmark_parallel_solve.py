@@ -0,0 +1,125 @@
+"""
+Benchmark parallel RTE solutions
+--------------------------------
+Compares the wall time of pyshdom.containers.SolversDict.parallel_solve
+for the thread-based ('threading') and process-based ('loky', 'multiprocessing')
+joblib backends on one of the bundled synthetic cloud fields.
+One solver is made per wavelength so the number of wavelengths should be at least
+`n_jobs` for the parallelization to be useful.
+
+For information about the command line flags see:
+  python scripts/benchmark_parallel_solve.py --help
+
+Example usage (from the repository root):
+  python scripts/benchmark_parallel_solve.py --n_jobs 4 \
+      --wavelength 0.67 0.86 1.65 2.2 --backend threading loky
+"""
+import time
+import argparse
+import numpy as np
+import pyshdom
+
+
+def argument_parsing():
+    """
+    Handle all the argument parsing needed for this script.
+
+    Returns
+    -------
+    args: arguments from argparse.ArgumentParser()
+        The arguments required for this script
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cloud_path',
+                        default='data/synthetic_cloud_fields/jpl_les/rico32x37x26.txt',
+                        help='(default value: %(default)s) Path to the synthetic cloud field.')
+    parser.add_argument('--mie_dir',
+                        default='mie_tables',
+                        help='(default value: %(default)s) Directory of the monodisperse mie tables.'
+                             ' Tables that do not exist will be computed and saved here.')
+    parser.add_argument('--config_path',
+                        default='default_config.json',
+                        help='(default value: %(default)s) Path to the numerical parameters.')
+    parser.add_argument('--wavelength',
+                        nargs='+',
+                        default=[0.67, 0.86, 1.65, 2.2],
+                        type=float,
+                        help='(default value: %(default)s) Wavelengths [micron], one solver per wavelength.')
+    parser.add_argument('--n_jobs',
+                        default=4,
+                        type=int,
+                        help='(default value: %(default)s) Number of parallel workers.')
+    parser.add_argument('--backend',
+                        nargs='+',
+                        default=['threading', 'loky'],
+                        help='(default value: %(default)s) joblib backends to compare.')
+    parser.add_argument('--repeats',
+                        default=1,
+                        type=int,
+                        help='(default value: %(default)s) Number of timed solutions per backend.')
+    return parser.parse_args()
+
+
+def make_solvers(args):
+    """
+    Make one solver per wavelength for the synthetic cloud field.
+
+    Parameters
+    ----------
+    args: arguments from argparse.ArgumentParser()
+        Arguments required for this function
+
+    Returns
+    -------
+    solvers : pyshdom.containers.SolversDict
+        The unsolved solvers.
+    """
+    cloud_scatterer = pyshdom.util.load_from_csv(args.cloud_path, density='lwc', origin=(0.0, 0.0))
+    merged_z_coordinate = pyshdom.grid.combine_z_coordinates([cloud_scatterer])
+    rte_grid = pyshdom.grid.make_grid(cloud_scatterer.x[1]-cloud_scatterer.x[0], cloud_scatterer.x.size,
+                                      cloud_scatterer.y[1]-cloud_scatterer.y[0], cloud_scatterer.y.size,
+                                      merged_z_coordinate)
+    cloud_scatterer_on_rte_grid = pyshdom.grid.resample_onto_grid(rte_grid, cloud_scatterer)
+    cloud_scatterer_on_rte_grid['veff'] = (cloud_scatterer_on_rte_grid.reff.dims,
+                                           np.full_like(cloud_scatterer_on_rte_grid.reff.data,
+                                                        fill_value=0.1))
+    solvers = pyshdom.containers.SolversDict()
+    for wavelength in args.wavelength:
+        mie_mono_table = pyshdom.mie.get_mono_table('Water', (wavelength, wavelength),
+                                                    relative_dir=args.mie_dir)
+        cloud_size_distribution = pyshdom.size_distribution.get_size_distribution_grid(
+            mie_mono_table.radius.data,
+            size_distribution_function=pyshdom.size_distribution.gamma, particle_density=1.0,
+            reff={'coord_min': 4.0, 'coord_max': 25.0, 'npoints': 25,
+                  'spacing': 'logarithmic', 'units': 'micron'},
+            veff={'coord_min': 0.09, 'coord_max': 0.11, 'npoints': 2,
+                  'spacing': 'linear', 'units': 'unitless'},
+            )
+        poly_table = pyshdom.mie.get_poly_table(cloud_size_distribution, mie_mono_table)
+        cloud_optical_scatterer = pyshdom.medium.table_to_grid(cloud_scatterer_on_rte_grid, poly_table)
+        config = pyshdom.configuration.get_config(args.config_path)
+        solvers.add_solver(wavelength, pyshdom.solver.RTE(
+            numerical_params=config,
+            medium={'cloud': cloud_optical_scatterer},
+            source=pyshdom.source.solar(wavelength, -1*np.cos(np.deg2rad(40.0)), 0.0, solarflux=1.0),
+            surface=pyshdom.surface.lambertian(albedo=0.04),
+            num_stokes=1
+            ))
+    return solvers
+
+
+if __name__ == "__main__":
+    args = argument_parsing()
+    solvers = make_solvers(args)
+    timings = {}
+    for backend in args.backend:
+        timings[backend] = []
+        for _ in range(args.repeats):
+            start = time.time()
+            solvers.parallel_solve(n_jobs=args.n_jobs, backend=backend, overwrite_solver=True,
+                                   verbose=False)
+            timings[backend].append(time.time() - start)
+
+    print('{} solvers, n_jobs={}'.format(len(solvers), args.n_jobs))
+    for backend, times in timings.items():
+        print('{:>16s}: {:8.2f} s (min of {})'.format(backend, min(times), len(times)))
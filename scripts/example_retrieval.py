@@ -115,7 +115,9 @@ def set_state_fn(state):
                                                 surface=solvers[wavelength].surface,
                                                 num_stokes=solvers[wavelength]._nstokes,
                                                 name=None
-                                                )
+                                                ),
+                                #initialize from the previous iteration's solution.
+                                warm_start=True
                                 )
 
 unknown_scatterers = pyshdom.containers.UnknownScatterers()
@@ -389,6 +389,7 @@ SUBROUTINE COMPUTE_MIE_ALL_SIZES (AVGFLAG, WAVELEN1, WAVELEN2, DELTAWAVE, &
  ! temperature depends on wavelength).  The Wigner d coefficients are
  ! returned with the product of the phase function times the scattering
  ! coefficient.
+!f2py threadsafe
   IMPLICIT NONE
   LOGICAL, INTENT(IN) :: VERBOSE
   INTEGER, INTENT(IN) :: NSIZE, MAXLEG
@@ -404,9 +405,14 @@ SUBROUTINE COMPUTE_MIE_ALL_SIZES (AVGFLAG, WAVELEN1, WAVELEN2, DELTAWAVE, &
   REAL    :: WAVECEN, WAVE, BBTEMP, PLANCK, SUMP, A
   REAL    :: MRE, MIM, EXT, SCAT, COEF(6,0:MAXLEG)
   COMPLEX :: REFIND
+  INTEGER :: LASTNQUAD
+  DOUBLE PRECISION, ALLOCATABLE :: MU(:), WTS(:)
 
   WRITE(*,*) 'Computing mie scattering for all sizes, this may take a while...'
   TABLE_TYPE = 'VECTOR'
+  ! Quadrature reused between the calls to MIE_ONE.
+  ALLOCATE (MU(MAXLEG), WTS(MAXLEG))
+  LASTNQUAD = -1
   IF (AVGFLAG == 'C') THEN
      ! For using one central wavelength: just call Mie routine for each radius
     DO I = 1, NSIZE
@@ -414,7 +420,8 @@ SUBROUTINE COMPUTE_MIE_ALL_SIZES (AVGFLAG, WAVELEN1, WAVELEN2, DELTAWAVE, &
         WRITE(*,*) 'Computing mie for radius: ', RADII(I), ' microns'
       ENDIF
       CALL MIE_ONE (WAVELENCEN, RINDEX, RADII(I), MAXLEG, &
-                    EXTINCT1(I), SCATTER1(I), NLEG1(I), LEGCOEF1(1,0,I) )
+                    EXTINCT1(I), SCATTER1(I), NLEG1(I), LEGCOEF1(1,0,I), &
+                    MU, WTS, LASTNQUAD)
     ENDDO
 
   ELSE
@@ -451,7 +458,8 @@ SUBROUTINE COMPUTE_MIE_ALL_SIZES (AVGFLAG, WAVELEN1, WAVELEN2, DELTAWAVE, &
           WRITE(*,*) 'Computing mie for radius: ', RADII(I), &
                   ' microns [wavelength = ', WAVE, 'microns]'
         ENDIF
-        CALL MIE_ONE (WAVE, REFIND, RADII(I), MAXLEG, EXT, SCAT, NL, COEF)
+        CALL MIE_ONE (WAVE, REFIND, RADII(I), MAXLEG, EXT, SCAT, NL, COEF, &
+                      MU, WTS, LASTNQUAD)
         EXTINCT1(I) = EXTINCT1(I) + PLANCK*EXT
         SCATTER1(I) = SCATTER1(I) + PLANCK*SCAT
         NLEG1(I) = MAX(NLEG1(I),NL)
@@ -463,6 +471,7 @@ SUBROUTINE COMPUTE_MIE_ALL_SIZES (AVGFLAG, WAVELEN1, WAVELEN2, DELTAWAVE, &
     SCATTER1(:) = SCATTER1(:)/SUMP
     LEGCOEF1(:,:,:) = LEGCOEF1(:,:,:)/SUMP
   ENDIF
+  DEALLOCATE (MU, WTS)
 END SUBROUTINE COMPUTE_MIE_ALL_SIZES
 
 
@@ -910,6 +919,7 @@ END SUBROUTINE WRITE_MONO_TABLE
 
 SUBROUTINE GET_POLY_TABLE (ND, NDIST, NSIZE, MAXLEG, NLEG1, EXTINCT1,&
 		      SCATTER1, LEGCOEF1, EXTINCT, SSALB, NLEG, LEGCOEF)
+!f2py threadsafe
   IMPLICIT NONE
   REAL, INTENT(IN) :: ND(NSIZE, NDIST)
   INTEGER, INTENT(IN) :: NDIST, NSIZE
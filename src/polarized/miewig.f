@@ -3,11 +3,17 @@ C     written by Frank Evans.
 C     https://nit.coloradolinux.com/~evans/shdom.html
 
       SUBROUTINE MIE_ONE (WAVELENGTH, MINDEX, RADIUS,
-     .                   MAXRANK, EXTINCTION, SCATTER, NRANK, WIGCOEF)
+     .                   MAXRANK, EXTINCTION, SCATTER, NRANK, WIGCOEF,
+     .                   MU, WTS, LASTNQUAD)
 C       Computes the Mie scattering properties for a single homogeneous
 C     sphere of radius RADIUS.  The six phase matrix elements times the
 C     scattering coefficient is returned as Wigner d-function series
 C     coefficients.
+C       The Gauss-Legendre quadrature (MU, WTS with LASTNQUAD points) is
+C     reused between calls. It is held by the caller (MU and WTS of length
+C     MAXRANK and LASTNQUAD=-1 before the first call) rather than SAVEd,
+C     and the work arrays are allocated, so that this routine is reentrant
+C     and may be called concurrently from multiple threads.
       IMPLICIT NONE
       INTEGER     MAXRANK, NRANK
       REAL        WAVELENGTH, RADIUS
@@ -18,15 +24,13 @@ C     coefficients.
       INTEGER     NMIE, NQUAD, LASTNQUAD
       INTEGER     I, J, L
       DOUBLE PRECISION X, PI, QEXT, QSCAT, GEOMAREA
-      DOUBLE PRECISION MU(MAXN), WTS(MAXN)
+      DOUBLE PRECISION MU(*), WTS(*)
       DOUBLE PRECISION P1, P2, P3, P4
-      DOUBLE PRECISION D00(0:MAXN), D20(0:MAXN)
-      DOUBLE PRECISION D22P(0:MAXN), D22M(0:MAXN)
-      DOUBLE PRECISION COEF(6,0:MAXN), F, A2, A3
+      DOUBLE PRECISION F, A2, A3
+      DOUBLE PRECISION, ALLOCATABLE :: D00(:), D20(:)
+      DOUBLE PRECISION, ALLOCATABLE :: D22P(:), D22M(:), COEF(:,:)
       DOUBLE COMPLEX MSPHERE
-      DOUBLE COMPLEX A(MAXN), B(MAXN)
-      SAVE MU, WTS, LASTNQUAD
-      DATA LASTNQUAD/-1/
+      DOUBLE COMPLEX, ALLOCATABLE :: A(:), B(:)
 
 
       PI = ACOS(-1.0D0)
@@ -35,6 +39,7 @@ C     coefficients.
       MSPHERE = MINDEX
 
 C         Compute the An's and Bn's and the cross sections
+      ALLOCATE (A(MAXN), B(MAXN))
       NMIE = 0
       CALL MIECALC (NMIE, X, MSPHERE, A, B)
       CALL MIECROSS (NMIE, X, A, B, QEXT, QSCAT)
@@ -59,6 +64,8 @@ C         Get the Gauss-Legendre quadrature abscissas and weights
 
 C         Calculate the phase function at the quadrature angles and then
 C         integrate over angle to get the Wigner d-function coefficients.
+      ALLOCATE (D00(0:NRANK), D20(0:NRANK), D22P(0:NRANK),
+     .          D22M(0:NRANK), COEF(6,0:NRANK))
       DO L = 0, NRANK
         DO J = 1, 6
           COEF(J,L) = 0.0D0
@@ -95,6 +102,7 @@ C         Calculate the series expansion coefficients
           WIGCOEF(J,L) = SNGL( (WAVELENGTH**2/PI) *COEF(J,L) )
         ENDDO
       ENDDO
+      DEALLOCATE (A, B, D00, D20, D22P, D22M, COEF)
 
       RETURN
       END
@@ -117,8 +125,9 @@ C      appropriate number is calculated and returned in NTERMS.
       PARAMETER   (MAXTERMS=10000)
       DOUBLE PRECISION  PSIN, PSIM, CHIN, CHIM, TMP
       DOUBLE PRECISION  DCOS, DSIN
-      DOUBLE COMPLEX  M, Y, D(MAXTERMS+15), XIN, XIM, CTMP
+      DOUBLE COMPLEX  M, Y, XIN, XIM, CTMP
       DOUBLE COMPLEX  DCMPLX
+      DOUBLE COMPLEX, ALLOCATABLE :: D(:)
 
 
 C           If NTERMS is not specified calculate it
@@ -134,6 +143,7 @@ C           Generate the Dn's by down recurrence  D = d(log(PSI(y)))/dy
       M = DCONJG(MN)
       Y = M*X
       NN = NTERMS + 15
+      ALLOCATE (D(NN))
       D(NN) = DCMPLX (0.0D0, 0.0D0)
       DO N = NN, 2, -1
           D(N-1) = N/Y - 1.0/ (D(N) + N/Y)
@@ -160,6 +170,7 @@ C             (PSIN = PSI(n), PSIM = PSI(n-1), same for CHI)
           CTMP = M*D(N) + N/X
           B(N) = (CTMP*PSIN - PSIM) / (CTMP*XIN - XIM)
       ENDDO
+      DEALLOCATE (D)
 
       RETURN
       END
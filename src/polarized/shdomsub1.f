@@ -182,7 +182,7 @@ Cf2py intent(in) :: ZCKD, GASABS
       INTEGER WORK1(8*MAXIG)
 Cf2py intent(in,out) :: WORK1
       REAL    BCRAD(NSTOKES,MAXBCRAD), WORK(MAXIDO*NSTOKES)
-      REAL    WORK2(MAXIG*NSTOKES)
+      REAL    WORK2(*)
 Cf2py intent(in,out) :: BCRAD, WORK, WORK2
       REAL    FLUXES(2,MAXIG)
 Cf2py intent(in,out) :: FLUXES
@@ -374,13 +374,17 @@ C           inequality holds.
      .               DELYD, ALBMAX, DELJDOT, DELJOLD, DELJNEW, JNORM,
      .               FFTFLAG, CMU1, CMU2, WTMU, CPHI1, CPHI2, WPHISAVE,
      .               WORK, WORK1, WORK2, UNIFORM_SFC_BRDF, SFC_BRDF_DO,
-     .               ITERFIXSH)
+     .               ITERFIXSH, STOPOUTOFMEM, OUTOFMEM)
 Cf2py threadsafe
 C       Performs the SHDOM solution procedure.
 C       Output is returned in SOURCE, RADIANCE, FLUXES, DIRFLUX.
 C       The adaptive grid stucture (NCELLS,GRIDPTR,NEIGHPTR,TREEPTR,
 C       CELLFLAGS,NPTS,GRIDPOS) is input and modified for new grid
 C       cells and points on output.
+C       If STOPOUTOFMEM is true then the iterations are stopped as soon as
+C       the cell splitting runs out of room in the grid point, grid cell, or
+C       spherical harmonic arrays (OUTOFMEM is returned true) so that the
+C       arrays can be enlarged and the solution continued.
       IMPLICIT NONE
       INTEGER NSTOKES, NX, NY, NZ, NX1, NY1, NXSFC, NYSFC, NSFCPAR
 Cf2py intent(in) :: NSTOKES, NX, NY, NX1, NY1, NZ, NXSFC, NYSFC, NSFCPAR
@@ -492,6 +496,9 @@ Cf2py intent(in, out) :: ITER
       LOGICAL UNIFORM_SFC_BRDF
       REAL    SFC_BRDF_DO(NSTOKES,NMU/2,NPHI0MAX,NSTOKES,NMU/2,NPHI0MAX)
 Cf2py intent(in) :: UNIFORM_SFC_BRDF, SFC_BRDF_DO
+      LOGICAL STOPOUTOFMEM, OUTOFMEM
+Cf2py intent(in) :: STOPOUTOFMEM
+Cf2py intent(out) :: OUTOFMEM
 
       REAL A
       INTEGER SP, STACK(50)
@@ -499,7 +506,7 @@ Cf2py intent(in) :: UNIFORM_SFC_BRDF, SFC_BRDF_DO
 
       INTEGER I
       INTEGER MAXNANGBND, NANGBND(4,2), IPA
-      LOGICAL FIXSH, SPLITTESTING, DOSPLIT, OUTOFMEM
+      LOGICAL FIXSH, SPLITTESTING, DOSPLIT
 
       REAL    STARTADAPTSOL, ENDADAPTSOL, ADAPTRANGE, SPLITCRIT
       REAL    STARTSPLITACC, CURSPLITACC, AVGSOLCRIT, BETA, ACCELPAR
@@ -518,11 +525,11 @@ C         The SPLIT_GRID routine is called and the splitting criterion returned
 C         as long as SPLITTESTING is true.
 C      ITER = 0
 
+      OUTOFMEM = .FALSE.
       IF (MAXITER .LE. ITER) RETURN
 
       FIXSH = .FALSE.
       SPLITTESTING = .TRUE.
-      OUTOFMEM = .FALSE.
       ENDADAPTSOL = 0.001
       STARTADAPTSOL = 0.1
       ADAPTRANGE = STARTADAPTSOL/(3.0*ENDADAPTSOL)
@@ -581,6 +588,12 @@ C           Make sure all processors are going to split cells if any want to
      .             XDOMAIN, YDOMAIN, EPSS, EPSZ, UNIFORMZLEV, NPART,
      .             NBPTS, TOTAL_EXT)
             IF (SOLCRIT .GT. STARTADAPTSOL)  STARTSPLITACC = SPLITCRIT
+C             Return the interpolated solution on the new grid so the caller
+C               can enlarge the arrays. This iteration is not counted.
+            IF (OUTOFMEM .AND. STOPOUTOFMEM) THEN
+              ITER = ITER - 1
+              EXIT
+            ENDIF
           ENDIF
 C           Find the maximum splitting criterion over all processors
           CALL TOTAL_SPLITCRIT_MAX (SPLITCRIT)
@@ -383,6 +383,7 @@ C         Trilinearly interpolate from the property grid to the adaptive grid
      .                CZINV, DI, DJ, DK, IPDIRECT, DELXD, DELYD,
      .                XDOMAIN, YDOMAIN, EPSS, EPSZ, UNIFORMZLEV,
      .		          NPART, NBPTS)
+Cf2py threadsafe
 C       Makes the direct beam solar flux for the internal base grid.
 C     DIRFLUX is set to F*exp(-tau_sun).
 C     Actually calls DIRECT_BEAM_PROP to do all the hard work.
@@ -1512,6 +1513,7 @@ C     If IFLAG=0 then the output array is set to the input times the weight.
       SUBROUTINE COMPUTE_NETFLUXDIV (NSTOKES, NPTS, RSHPTR, SRCTYPE,
      .             SOLARMU, EXTINCT, ALBEDO, PLANCK, DIRFLUX,
      .             RADIANCE,  NETFLUXDIV, NPART)
+Cf2py threadsafe
 C       Computes the net flux divergence at every grid point.
       IMPLICIT NONE
       INTEGER NSTOKES, NPTS, RSHPTR(NPTS+1), NPART
@@ -1557,6 +1559,7 @@ Cf2py intent(in) :: SRCTYPE
       SUBROUTINE COMPUTE_SH (NSHOUT, NSTOKES, NPTS, SRCTYPE,
      .                       SOLARMU, SOLARAZ, DIRFLUX,
      .                       RSHPTR, ML, MM, RADIANCE, SHTERMS)
+Cf2py threadsafe
 C       Computes the quantities for the spherical harmonic output.
 C     At each grid point the mean radiance and net flux (Fx, Fy, Fz)
 C     are computed.  The output includes the diffuse and direct solar
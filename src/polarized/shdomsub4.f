@@ -140,7 +140,7 @@ Cf2py intent(in) ::  CAMX, CAMY, CAMZ, CAMMU, CAMPHI
       INTEGER  NPIX, NSTPHASE, NSCATANGLE
 Cf2py intent(in) :: NPIX, NSTPHASE, NSCATANGLE
       REAL   STOKES(NSTOKES, NPIX)
-Cf2py intent(out) :: STOKES
+Cf2py intent(in,out) :: STOKES
       CHARACTER SRCTYPE*1, SFCTYPE*2, UNITS*1
 Cf2py intent(in) :: SRCTYPE, SFCTYPE, UNITS
       REAL YLMSUN(NSTLEG, NLM), PHASETAB(NSTPHASE,NUMPHASE,NSCATANGLE)
@@ -245,7 +245,10 @@ C         to calculate the Stokes radiance vector for this pixel
      .           JACOBIANPTR, NUM_JACOBIAN_PTS, RAYS_PER_PIXEL,
      .           RAY_WEIGHTS, STOKES_WEIGHTS, DIPHASEIND,
      .           COSTFUNC, NCOST, NGRAD, NUNCERTAINTY, PLANCK,
-     .           LONGRADIANCE, USELONGRAD, TAUTOL)
+     .           LONGRADIANCE, USELONGRAD, TAUTOL, MAKESPARSE,
+     .           MAXNNZ, SPARSEJAC, SPARSEPTR, PIXELPTR, NNZ,
+     .           MAKEJVP, JVPVECTOR, JVP, MAKEVJP, VJPWEIGHTS, VJP,
+     .           USESTOKESIN, STOKESIN)
 C    Calculates the cost function and its gradient using the Levis approximation
 C    to the Frechet derivatives of the radiative transfer equation.
 C    Calculates the Stokes Vector at the given directions (CAMMU, CAMPHI)
@@ -260,6 +263,20 @@ C    for evaluation of the Frechet derivatives.
 C    UNCERTAINTIES holds the inverse error-covariance matrix or other weighting matrix
 C    for evaluation of the cost function.
 C    Will also output specific Frechet derivative values if MAKEJACOBIAN is TRUE
+C    If MAKESPARSE is TRUE then the nonzero Frechet derivatives of each pixel
+C    at every base grid point are output in compressed sparse row format.
+C    The entries of pixel IPIX are PIXELPTR(IPIX) to PIXELPTR(IPIX+1)-1 of
+C    SPARSEJAC and SPARSEPTR (the base grid point of each entry).
+C    NNZ is the total number of entries which are only stored if NNZ <= MAXNNZ.
+C    If MAKEJVP is TRUE then the product of the Frechet derivatives with
+C    JVPVECTOR (the Jacobian-vector product) is output in JVP and if MAKEVJP
+C    is TRUE then the product of VJPWEIGHTS with the Frechet derivatives
+C    (the vector-Jacobian product) is output in VJP, without forming the Jacobian.
+C    If USESTOKESIN is TRUE then the pixel Stokes vectors are already known
+C    (e.g. rendered at the same state) and STOKESIN is used in place of the
+C    integrated Stokes vectors to evaluate the cost function. The rays of pixels
+C    which cannot contribute to the gradient (zero UNCERTAINTIES or STOKESIN
+C    equal to MEASUREMENTS) are then skipped unless other derivatives are output.
 
 Cf2py threadsafe
       IMPLICIT NONE
@@ -354,6 +371,23 @@ Cf2py intent(in,out) :: JACOBIAN
 Cf2py intent(in) :: MAKEJACOBIAN
       INTEGER JI,JJ,JK, NUM_JACOBIAN_PTS, JACOBIANPTR(NUM_JACOBIAN_PTS)
 Cf2py intent(in) :: NUM_JACOBIAN_PTS, JACOBIANPTR
+      LOGICAL MAKESPARSE
+Cf2py intent(in) :: MAKESPARSE
+      INTEGER MAXNNZ, NNZ, SPARSEPTR(*), PIXELPTR(NPIX+1)
+Cf2py intent(in) :: MAXNNZ
+Cf2py intent(in,out) :: SPARSEPTR
+Cf2py intent(out) :: PIXELPTR, NNZ
+      REAL SPARSEJAC(NSTOKES,NUMDER,*)
+Cf2py intent(in,out) :: SPARSEJAC
+      LOGICAL MAKEJVP, MAKEVJP
+Cf2py intent(in) :: MAKEJVP, MAKEVJP
+      DOUBLE PRECISION JVPVECTOR(NBPTS,NUMDER), VJPWEIGHTS(NSTOKES,NPIX)
+Cf2py intent(in) :: JVPVECTOR, VJPWEIGHTS
+      DOUBLE PRECISION JVP(NSTOKES,NPIX), VJP(NBPTS,NUMDER)
+Cf2py intent(out) :: JVP, VJP
+      LOGICAL USESTOKESIN
+      REAL STOKESIN(NSTOKES,NPIX)
+Cf2py intent(in) :: USESTOKESIN, STOKESIN
       INTEGER RAYS_PER_PIXEL(*)
 Cf2py intent(in) :: RAYS_PER_PIXEL
       DOUBLE PRECISION   RAY_WEIGHTS(*), STOKES_WEIGHTS(NSTOKES, *)
@@ -409,8 +443,22 @@ C          Compute the upwelling bottom radiances using the downwelling fluxes.
 C         Loop over pixels in image
       COST = 0.0D0
       IRAY = 0
+      NNZ = 0
+      PIXELPTR = 1
+      JVP = 0.0D0
+      VJP = 0.0D0
       DO IPIX = 1, NPIX
         RAYGRAD_PIXEL = 0.0D0
+        IF (USESTOKESIN) THEN
+          STOKESOUT(:,IPIX) = STOKESIN(:,IPIX)*STOKES_WEIGHTS(:,IPIX)
+          IF (.NOT. (MAKEJACOBIAN .OR. MAKESPARSE .OR. MAKEJVP .OR.
+     .        MAKEVJP) .AND. (ALL(UNCERTAINTIES(:,:,IPIX) .EQ. 0.0D0)
+     .        .OR. ALL(STOKESOUT(:,IPIX) .EQ. MEASUREMENTS(:,IPIX))))
+     .        THEN
+            IRAY = IRAY + RAYS_PER_PIXEL(IPIX)
+            GOTO 950
+          ENDIF
+        ENDIF
         DO I2=1 ,RAYS_PER_PIXEL(IPIX)
           IRAY = IRAY + 1
           X0 = CAMX(IRAY)
@@ -462,12 +510,15 @@ C         while traversing the SHDOM grid.
      .             LONGRADIANCE, USELONGRAD, TAUTOL)
   900     CONTINUE
           DO NS=1,NSTOKES
-            STOKESOUT(NS,IPIX) = STOKESOUT(NS,IPIX) + VISRAD(NS)*
-     .        RAY_WEIGHTS(IRAY)*STOKES_WEIGHTS(NS,IPIX)
+            IF (.NOT. USESTOKESIN) THEN
+              STOKESOUT(NS,IPIX) = STOKESOUT(NS,IPIX) + VISRAD(NS)*
+     .          RAY_WEIGHTS(IRAY)*STOKES_WEIGHTS(NS,IPIX)
+            ENDIF
             RAYGRAD_PIXEL(NS,:,:) = RAYGRAD_PIXEL(NS,:,:) +
      .        RAYGRAD(NS,:,:)*RAY_WEIGHTS(IRAY)*STOKES_WEIGHTS(NS,IPIX)
           ENDDO
         ENDDO
+  950   CONTINUE
         CALL UPDATE_COSTFUNCTION(DBLE(STOKESOUT(:,IPIX)), RAYGRAD_PIXEL,
      .             GRADOUT, COST, UNCERTAINTIES(:,:,IPIX), COSTFUNC,
      .             NSTOKES, NBPTS, NUMDER, NCOST, NGRAD,
@@ -479,7 +530,32 @@ C         while traversing the SHDOM grid.
      .      RAYGRAD_PIXEL(:,JACOBIANPTR(JI),:)
           END DO
         ENDIF
+
+        IF (MAKESPARSE .EQV. .TRUE.) THEN
+          PIXELPTR(IPIX) = NNZ + 1
+          DO JI = 1, NBPTS
+            IF (ANY(RAYGRAD_PIXEL(:,JI,:) .NE. 0.0D0)) THEN
+              NNZ = NNZ + 1
+              IF (NNZ .LE. MAXNNZ) THEN
+                SPARSEJAC(:,:,NNZ) = RAYGRAD_PIXEL(:,JI,:)
+                SPARSEPTR(NNZ) = JI
+              ENDIF
+            ENDIF
+          ENDDO
+        ENDIF
+
+        IF (MAKEJVP .EQV. .TRUE.) THEN
+          DO NS=1,NSTOKES
+            JVP(NS,IPIX) = SUM(RAYGRAD_PIXEL(NS,:,:)*JVPVECTOR)
+          ENDDO
+        ENDIF
+        IF (MAKEVJP .EQV. .TRUE.) THEN
+          DO NS=1,NSTOKES
+            VJP = VJP + VJPWEIGHTS(NS,IPIX)*RAYGRAD_PIXEL(NS,:,:)
+          ENDDO
+        ENDIF
       ENDDO
+      PIXELPTR(NPIX+1) = NNZ + 1
       RETURN
       END
 
@@ -1718,6 +1794,7 @@ Cf2py intent(out) ::  TABLE_TYPE
       SUBROUTINE PRECOMPUTE_PHASE_CHECK(NSCATANGLE, NUMPHASE, NSTPHASE,
      .                              NSTOKES, ML, NLM, NSTLEG, NLEG,
      .                              LEGEN, PHASETAB, DELTAM, NEGCHECK)
+Cf2py threadsafe
 C       Precomputes the phase matrix elements I-I and I-Q as a function
 C     of scattering angle for solar direct scattering for all the
 C     tabulated phase functions. Output is in PHASETAB.
@@ -1806,6 +1883,7 @@ C           If doing polarization, sum the second Wigner function series
      .                              NSTPHASE,
      .                              NSTOKES, ML, NLM, NSTLEG, NLEG,
      .                              DLEG, DPHASETAB, DELTAM, NEGCHECK)
+Cf2py threadsafe
 C       Precomputes the phase matrix elements I-I and I-Q as a function
 C     of scattering angle for solar direct scattering for all the
 C     tabulated phase functions. Output is in PHASETAB.
@@ -2124,6 +2202,7 @@ C          ENDIF
      .                     NPX, NPY, NPZ, NPTS, NBPTS, NUMPHASE, DELX,
      .                      DELY, XSTART, YSTART, ZLEVELS, EXTINCTP,
      .                      ALBEDOP, NPART, NUMDER)
+Cf2py threadsafe
 CPrepares the DIPHASEIND for use in the gradient calculation.
 CThis holds the pointer to the base grid point from which the
 C(adaptive) grid point's phase function comes from.
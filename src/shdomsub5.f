@@ -16,6 +16,7 @@ C     2020-2021.
      .             CAMMU, CAMPHI, NPIX, PATH, IPHASE,
      .             ALBEDO, LEGEN, DELTAMPATH, DELTAM,
      .             NPART, NSTLEG, NLEG,ML,PATHS_SIZE)
+Cf2py threadsafe
 C     Integrates the extinction field (EXTINCT) along a ray and stores the minimum
 C     optical path that intersects a cell adjacent to each gridpoint.
 C     Stores only the minimum across all the set of rays.
@@ -378,6 +379,7 @@ C             boundary then prepare for next cell
      .             CAMMU, CAMPHI, NPIX, PATH, IPHASE,
      .             ALBEDO, LEGEN, DELTAMPATH, DELTAM,
      .             NPART, NSTLEG, NLEG, ML)
+Cf2py threadsafe
 C    Integrates the extinction field along the line of sight,
 C    this may be delta-M scaled extinction or not depending on
 C    DELTAMPATH (and DELTAM). - JRLoveridge 2021/02/22
@@ -735,6 +737,7 @@ C             boundary then prepare for next cell
      .             BCFLAG, IPFLAG, CAMX, CAMY, CAMZ,
      .             CAMMU, CAMPHI, NPIX, VOLUME, FLAGS, WEIGHTS,
      .              LINEAR)
+Cf2py threadsafe
 C    Performs a space carving algorithm by counting intersections between
 C    cells and rays. Can also backproject a set of weights. A nearest neighbor
 C    interpolation kernel is assumed. The linear one does not operate correctly
@@ -1042,6 +1045,7 @@ C             boundary then prepare for next cell
      .             CAMMU, CAMPHI, NPIX,PATH, RETURN_MATRIX,
      .             MATRIX, MATRIX_PTRS, MATRIX_SIZE,
      .             PIXEL_INDICES, RAY_WEIGHTS, NRAYS)
+Cf2py threadsafe
 C     Performs ray integration (PATH) of a set of WEIGHTS assuming
 C     a linear interpolation kernel. Is also supposed to output
 C     the matrix of describing this integration but it is inconsistent and
@@ -1463,6 +1467,7 @@ C     Compute trilinear interpolation kernel F(8)
      .		         IPDIRECT, DI, DJ, DK, CX, CY, CZ, CXINV,
      .		         CYINV, CZINV, EPSS, EPSZ, XDOMAIN, YDOMAIN,
      .		         UNIFORMZLEV, DELXD, DELYD, DPATH, DPTR)
+Cf2py threadsafe
 C     Calculates the sensitvity of the direct beam to the extinction
 C     along the path from each grid point to the sun.
 C     Actually calls DIRECT_BEAM_AND_PATHS_PROP to do all the hard work.
@@ -1878,6 +1883,7 @@ C       Compute the inner derivatives (minus the path lengths)
      .                   NX, NY, NZ, NCELLS, NPTS, CELLFLAGS,
      .                   XGRID, YGRID, ZGRID, GRIDPOS,GRIDPTR,
      .                   NEIGHPTR, TREEPTR)
+Cf2py threadsafe
 
 C    Calculates the source function for a pencil-beam source.
 C    Completely untested.
@@ -2167,6 +2173,7 @@ C             boundary then prepare for next cell
 
       SUBROUTINE COMPUTE_RADIANCE_GRID(NSTOKES, RADIANCE, RSHPTR,
      .           NPTS, MU, PHI, ML, MM, NSTLEG, NLM, GRIDRAD)
+Cf2py threadsafe
 
       IMPLICIT NONE
       INTEGER NSTOKES, NPTS, ML, MM, NSTLEG, NLM
@@ -2197,6 +2204,7 @@ C             boundary then prepare for next cell
 
       SUBROUTINE COMPUTE_SOURCE_GRID(NSTOKES, SOURCE, SHPTR,
      .           NPTS, MU, PHI, ML, MM, NSTLEG, NLM, GRIDSOURCE)
+Cf2py threadsafe
 
       IMPLICIT NONE
       INTEGER NSTOKES, NPTS, ML, MM, NSTLEG, NLM
@@ -2229,6 +2237,7 @@ C             boundary then prepare for next cell
      .                       BCFLAG, IPFLAG, XGRID, YGRID, ZGRID,
      .                       GRIDPOS, MURAY, PHIRAY, MU2, PHI2,
      .			                 X0, Y0, Z0, XE,YE,ZE, SIDE)
+Cf2py threadsafe
 C    Finds the ending point of a ray integration so that we can
 C    trace a ray from the end point to the starting point.
       IMPLICIT NONE
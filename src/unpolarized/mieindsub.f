@@ -1,9 +1,15 @@
 
       SUBROUTINE MIE_ONE (WAVELENGTH, MINDEX, RADIUS,
-     .                    MAXLEG, EXTINCTION, SCATTER, NLEG, LEGEN)
+     .                    MAXLEG, EXTINCTION, SCATTER, NLEG, LEGEN,
+     .                    MU, WTS, LASTNQUAD)
 C       Computes the Mie scattering properties for a single homogeneous
 C     sphere of radius RADIUS.  The phase function times the scattering
 C     coefficient is returned as Legendre series coefficients.
+C       The Gauss-Legendre quadrature (MU, WTS with LASTNQUAD points) is
+C     reused between calls. It is held by the caller (MU and WTS of length
+C     MAXLEG and LASTNQUAD=-1 before the first call) rather than SAVEd,
+C     and the work arrays are allocated, so that this routine is reentrant
+C     and may be called concurrently from multiple threads.
       IMPLICIT NONE
       INTEGER     MAXLEG, NLEG
       REAL        WAVELENGTH, RADIUS
@@ -15,13 +21,11 @@ C     coefficient is returned as Legendre series coefficients.
       INTEGER     I, L
       REAL*8      X, PI
       REAL*8      QEXT, QSCAT, GEOMAREA
-      REAL*8      MU(MAXN), WTS(MAXN)
+      REAL*8      MU(*), WTS(*)
       REAL*8      P1, PL, PL1, PL2
-      REAL*8      COEF1(0:MAXN)
+      REAL*8, ALLOCATABLE :: COEF1(:)
       COMPLEX*16  MSPHERE
-      COMPLEX*16  A(MAXN), B(MAXN)
-      SAVE MU, WTS, LASTNQUAD
-      DATA LASTNQUAD/-1/
+      COMPLEX*16, ALLOCATABLE :: A(:), B(:)
       
 
       PI = ACOS(-1.0D0)      
@@ -30,6 +34,7 @@ C     coefficient is returned as Legendre series coefficients.
       MSPHERE = MINDEX
 
 C         Compute the An's and Bn's and the cross sections
+      ALLOCATE (A(MAXN), B(MAXN))
       NMIE = 0
       CALL MIECALC (NMIE, X, MSPHERE, A, B)
       CALL MIECROSS (NMIE, X, A, B, QEXT, QSCAT)
@@ -53,6 +58,7 @@ C         Get the Gauss-Legendre quadrature abscissas and weights
 
 C         Calculate the phase function for quadrature angles and then
 C         integrate over angle to get the Legendre coefficients. 
+      ALLOCATE (COEF1(0:NLEG))
       DO L = 0, NLEG
         COEF1(L) = 0.0
       ENDDO
@@ -70,6 +76,7 @@ C         integrate over angle to get the Legendre coefficients.
       DO L = 0, NLEG
         LEGEN(L) = (2*L+1)/2.0 *(WAVELENGTH**2/PI) *COEF1(L)
       ENDDO
+      DEALLOCATE (A, B, COEF1)
        
       RETURN
       END
@@ -92,8 +99,9 @@ C      appropriate number is calculated and returned in NTERMS.
       PARAMETER   (MAXTERMS=10000)
       REAL*8      PSIN, PSIM, CHIN, CHIM, TMP
       REAL*8      DCOS, DSIN
-      COMPLEX*16  M, Y, D(MAXTERMS+15), XIN, XIM, CTMP
+      COMPLEX*16  M, Y, XIN, XIM, CTMP
       COMPLEX*16  DCMPLX
+      COMPLEX*16, ALLOCATABLE :: D(:)
  
  
 C           If NTERMS is not specified calculate it
@@ -109,6 +117,7 @@ C           Generate the Dn's by down recurrence  D = d(log(PSI(y)))/dy
       M = DCONJG(MN)
       Y = M*X
       NN = NTERMS + 15
+      ALLOCATE (D(NN))
       D(NN) = DCMPLX (0.0D0, 0.0D0)
       DO N = NN, 2, -1
           D(N-1) = N/Y - 1.0/ (D(N) + N/Y)
@@ -135,6 +144,7 @@ C             (PSIN = PSI(n), PSIM = PSI(n-1), same for CHI)
           CTMP = M*D(N) + N/X
           B(N) = (CTMP*PSIN - PSIM) / (CTMP*XIN - XIM)
       ENDDO
+      DEALLOCATE (D)
  
       RETURN
       END
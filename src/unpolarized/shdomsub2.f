@@ -368,6 +368,7 @@ C         Trilinearly interpolate from the property grid to the adaptive grid
      .                CZINV, DI, DJ, DK, IPDIRECT, DELXD, DELYD,
      .                XDOMAIN, YDOMAIN, EPSS, EPSZ, UNIFORMZLEV,
      .		      NPART, NBPTS)
+Cf2py threadsafe
 C       Makes the direct beam solar flux for the internal base grid.
 C     DIRFLUX is set to F*exp(-tau_sun).
 C     Actually calls DIRECT_BEAM_PROP to do all the hard work.
@@ -1311,6 +1312,7 @@ C     If IFLAG=0 then the output array is set to the input times the weight.
       SUBROUTINE COMPUTE_NETFLUXDIV (NPTS, RSHPTR, SRCTYPE,
      .             SOLARMU, EXTINCT, ALBEDO, PLANCK, DIRFLUX,
      .             RADIANCE,  NETFLUXDIV)
+Cf2py threadsafe
 C       Computes the net flux divergence at every grid point.
       IMPLICIT NONE
       INTEGER NPTS, RSHPTR(NPTS+1)
@@ -1344,6 +1346,7 @@ C       Computes the net flux divergence at every grid point.
       SUBROUTINE COMPUTE_SH (NSHOUT, NPTS, SRCTYPE,
      .                       SOLARMU, SOLARAZ, DIRFLUX,
      .                       RSHPTR, ML,MM,NCS, RADIANCE, SHTERMS)
+Cf2py threadsafe
 C       Computes the quantities for the spherical harmonic output.
 C     At each grid point the mean radiance and net flux (Fx, Fy, Fz)
 C     are computed.  The output includes the diffuse and direct solar
@@ -1171,6 +1171,7 @@ C             Sum over the spherical harmonic series of the source function
       SUBROUTINE PRECOMPUTE_PHASE_CHECK(NSCATANGLE, NUMPHASE, NSTPHASE,
      .                              NSTOKES, ML, NLM, NSTLEG, NLEG,
      .                              LEGEN, PHASETAB, DELTAM, NEGCHECK)
+Cf2py threadsafe
 C       Precomputes the phase function as a function of scattering angle
 C     for all the tabulated phase functions.
       IMPLICIT NONE
@@ -1227,6 +1228,7 @@ C       for the untruncated solar single scattering computation.
      .                              NSTLEG, NLEG, DPHASETAB,
      .                              DELTAM, NEGCHECK,
      .                              DNUMPHASE, DLEG)
+Cf2py threadsafe
 C       Precomputes the phase function as a function of scattering angle
 C     for all the tabulated phase functions.
       IMPLICIT NONE
@@ -8,6 +8,7 @@
 
 subroutine average_subpixel_rays (npixels,nrays, weighted_stokes, nstokes, &
                               pixel_index, observables)
+!f2py threadsafe
 ! Averages over sub-pixel rays to calculate pixel average observables.
 ! See pyshdom.containers._calculate_observables.
 
@@ -200,6 +201,7 @@ end subroutine cell_average
 
 subroutine util_integrate_rays(nrays, nx, ny, nz, xgrid, ygrid, zgrid, &
   start_positions, end_positions, weights, paths)
+!f2py threadsafe
 
   implicit none
   integer nrays, nx, ny, nz
@@ -0,0 +1,83 @@
+from unittest import TestCase
+import threading
+import numpy as np
+import pyshdom
+
+def get_density_grid():
+    grid = pyshdom.grid.make_grid(0.05, 5, 0.05, 5, np.linspace(0.1, 0.6, 5))
+    grid['density'] = (['x', 'y', 'z'], np.ones((5, 5, 5)))
+    return grid
+
+class Checks_Trusted(TestCase):
+    def setUp(self):
+        pyshdom.checks.clear_schema_cache()
+        pyshdom.checks.timings(reset=True)
+
+    def test_skipped_after_validation(self):
+        grid = get_density_grid()
+        pyshdom.checks.check_positivity(grid, 'density')
+        grid['density'][0, 0, 0] = -1.0
+        #the schema has been validated so the values are not checked.
+        with pyshdom.checks.trusted():
+            pyshdom.checks.check_positivity(grid, 'density')
+        timings = pyshdom.checks.timings()
+        self.assertEqual(timings['check_positivity']['calls'], 2)
+        self.assertEqual(timings['check_positivity']['skipped'], 1)
+
+    def test_not_trusted(self):
+        grid = get_density_grid()
+        pyshdom.checks.check_positivity(grid, 'density')
+        grid['density'][0, 0, 0] = -1.0
+        with self.assertRaises(pyshdom.exceptions.NegativeValueError):
+            pyshdom.checks.check_positivity(grid, 'density')
+
+    def test_new_schema(self):
+        grid = get_density_grid()
+        pyshdom.checks.check_positivity(grid, 'density')
+        grid['density2'] = -1*grid.density
+        #the schema of `grid` has changed so it is validated again.
+        with pyshdom.checks.trusted():
+            with self.assertRaises(pyshdom.exceptions.NegativeValueError):
+                pyshdom.checks.check_positivity(grid, 'density2')
+
+    def test_structure_always_checked(self):
+        grid = get_density_grid()
+        with pyshdom.checks.trusted():
+            with self.assertRaises(KeyError):
+                pyshdom.checks.check_positivity(grid, 'extinction')
+
+    def test_context_restored(self):
+        with pyshdom.checks.trusted():
+            self.assertTrue(pyshdom.checks.is_trusted())
+        self.assertFalse(pyshdom.checks.is_trusted())
+
+    def test_nested_timing(self):
+        #check_grid calls check_exists which should not be counted separately.
+        pyshdom.checks.check_grid(get_density_grid())
+        self.assertEqual(list(pyshdom.checks.timings()), ['check_grid'])
+
+    def test_thread_local(self):
+        #trusted mode entered in this thread doesn't apply to other threads.
+        trusted = []
+        with pyshdom.checks.trusted():
+            thread = threading.Thread(target=lambda: trusted.append(pyshdom.checks.is_trusted()))
+            thread.start()
+            thread.join()
+            self.assertTrue(pyshdom.checks.is_trusted())
+        self.assertEqual(trusted, [False])
+
+    def test_cache_bounded(self):
+        cache_size = pyshdom.checks.SCHEMA_CACHE_SIZE
+        pyshdom.checks.SCHEMA_CACHE_SIZE = 2
+        try:
+            grids = [get_density_grid().isel(x=slice(0, i)) for i in range(2, 5)]
+            for grid in grids:
+                pyshdom.checks.check_positivity(grid, 'density')
+            self.assertEqual(len(pyshdom.checks._VALIDATED_SCHEMAS), 2)
+            #the least recently used schema was forgotten so it is checked again.
+            grids[0]['density'][0, 0, 0] = -1.0
+            with pyshdom.checks.trusted():
+                with self.assertRaises(pyshdom.exceptions.NegativeValueError):
+                    pyshdom.checks.check_positivity(grids[0], 'density')
+        finally:
+            pyshdom.checks.SCHEMA_CACHE_SIZE = cache_size
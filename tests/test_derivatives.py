@@ -1,6 +1,7 @@
 from unittest import TestCase
 from collections import OrderedDict
 import numpy as np
+import scipy.sparse
 import xarray as xr
 import pyshdom
 
@@ -207,6 +208,25 @@ class Microphysical_Derivatives(TestCase):
                 all([np.all(solvers[key]._dleg[0,10]==1.0/(2*10.0 + 1.0))for key in solvers]),
                 ]))
 
+    def test_cached_tables(self):
+        unknown_scatterers = pyshdom.containers.UnknownScatterers()
+        unknown_scatterers.add_unknown('cloud', ['reff'],self.cloud_poly_tables)
+        unknown_scatterers.create_derivative_tables()
+        solvers = self.solvers
+        solvers.add_microphysical_partial_derivatives(unknown_scatterers)
+        dphasetabs = [solvers[key]._dphasetab.copy() for key in solvers]
+        tables = [list(unknown_scatterers.derivative_phase_tables(key).values()) for key in solvers]
+        solvers.add_microphysical_partial_derivatives(unknown_scatterers)
+
+        self.assertTrue(all([len(table) == 1 for table in tables]))
+        self.assertTrue(all([list(unknown_scatterers.derivative_phase_tables(key).values())[0] is table[0]
+                             for key, table in zip(solvers, tables)]))
+        self.assertTrue(all([np.allclose(solvers[key]._dphasetab, dphasetab)
+                             for key, dphasetab in zip(solvers, dphasetabs)]))
+        self.assertTrue(all([solvers[key]._dnumphase ==
+                             self.cloud_poly_tables[key].legcoef.sizes['reff']*
+                             self.cloud_poly_tables[key].legcoef.sizes['veff'] for key in solvers]))
+
 
 class Verify_Jacobian(TestCase):
     @classmethod
@@ -302,11 +322,39 @@ class Verify_Jacobian(TestCase):
         'indices_for_jacobian': ([1],[1],[1])}, uncertainty_kwargs={'add_noise': False})
         out, gradient, jacobian_exact = gradient_call()
 
+        gradient_call = pyshdom.gradient.LevisApproxGradientUncorrelated(Sensordict,
+        solvers, forward_sensors, unknown_scatterers,
+        parallel_solve_kwargs={'n_jobs':4, 'maxiter': 100, 'setup_grid':True, 'verbose':False},
+        gradient_kwargs={'exact_single_scatter': True, 'cost_function': 'L2',
+        'sparse_jacobian': True}, uncertainty_kwargs={'add_noise': False})
+        out, gradient, jacobian_sparse = gradient_call()
+        #too little space for the entries so most pixels are traversed twice.
+        gradient_call._sparse_density = {key: 1e-3 for key in solvers}
+        out, gradient, jacobian_split = gradient_call()
+
         cls.jacobian_exact = jacobian_exact
+        cls.jacobian_sparse = jacobian_sparse
+        cls.jacobian_split = jacobian_split
+        cls.grid_shape = (solvers[0.86]._pa.npx, solvers[0.86]._pa.npy, solvers[0.86]._pa.npz)
 
     def test_jacobian(self):
         self.assertAlmostEqual(self.jacobian_exact['jacobian_0.860'][0,0,0,0].data, 0.00396336, places=5)
 
+    def test_sparse_jacobian(self):
+        values = self.jacobian_sparse['jacobian_0.860']
+        jacobian = scipy.sparse.coo_matrix(
+            (values.data, (self.jacobian_sparse['row_0.860'].data,
+                           self.jacobian_sparse['column_0.860'].data)),
+            shape=values.attrs['shape']).tocsr()
+        column = np.ravel_multi_index((1, 1, 1), self.grid_shape)
+        self.assertAlmostEqual(jacobian[0, column], 0.00396336, places=5)
+
+    def test_sparse_jacobian_split(self):
+        for name in ('row_0.860', 'column_0.860'):
+            self.assertTrue(np.all(self.jacobian_split[name].data == self.jacobian_sparse[name].data))
+        self.assertTrue(np.allclose(self.jacobian_split['jacobian_0.860'].data,
+                                    self.jacobian_sparse['jacobian_0.860'].data))
+
 #A function for computing clouds.
 def cloud(mie_mono_table,ext,veff,reff,ssalb,solarmu,surfacealb,ground_temperature, step=0.0, index=(1,1,1),
           nmu=16, split=0.03, load_solution=None, resolution=1):
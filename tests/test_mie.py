@@ -1,5 +1,7 @@
 from unittest import TestCase
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import xarray as xr
 import pathlib
@@ -87,3 +89,44 @@ class Mie_tables(TestCase):
     @classmethod
     def tearDownClass(cls):
         os.remove(cls.path)
+
+
+class Mie_tables_threaded(TestCase):
+    """
+    The mie routines release the GIL (f2py threadsafe) so tables for different
+    wavelengths can be computed concurrently. These check that concurrent calls
+    reproduce the serial results and give a speedup when cores are available.
+    """
+    @staticmethod
+    def get_tables(wavelengths, n_jobs):
+        def get_table(wavelength):
+            return pyshdom.mie.get_mono_table('Water', (wavelength, wavelength),
+                                              minimum_effective_radius=4.0,
+                                              max_integration_radius=20.0,
+                                              wavelength_averaging=False,
+                                              verbose=False)
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            tables = list(executor.map(get_table, wavelengths))
+        return tables
+
+    def test_threaded_tables_match_serial(self):
+        wavelengths = [0.6, 0.65, 0.7, 0.75]
+        serial = self.get_tables(wavelengths, n_jobs=1)
+        threaded = self.get_tables(wavelengths, n_jobs=len(wavelengths))
+        for table1, table2 in zip(serial, threaded):
+            self.assertTrue(np.array_equal(table1.extinction.data, table2.extinction.data))
+            self.assertTrue(np.array_equal(table1.nleg.data, table2.nleg.data))
+            self.assertTrue(np.array_equal(table1.legendre.data, table2.legendre.data))
+
+    def test_threaded_speedup(self):
+        n_jobs = 2
+        if (os.cpu_count() or 1) < n_jobs:
+            self.skipTest('Speedup requires at least {} cores.'.format(n_jobs))
+        wavelengths = [0.6, 0.65]
+        start = time.time()
+        self.get_tables(wavelengths, n_jobs=1)
+        serial_time = time.time() - start
+        start = time.time()
+        self.get_tables(wavelengths, n_jobs=n_jobs)
+        threaded_time = time.time() - start
+        self.assertLess(threaded_time, 0.8*serial_time)
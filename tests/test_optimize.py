@@ -0,0 +1,151 @@
+from unittest import TestCase, skipIf
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import pyshdom
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+def quadratic_objective(target, mpi_comm=None):
+    """
+    A least squares objective function. With `mpi_comm`, each rank
+    evaluates the misfit for a subset of the components of the state
+    and the loss and gradient are summed across ranks.
+    """
+    counter = {'evaluations': 0}
+    def loss_fn(state, measurements):
+        counter['evaluations'] += 1
+        residual = state - target
+        if mpi_comm is not None:
+            owned = np.zeros(residual.shape)
+            owned[mpi_comm.Get_rank()::mpi_comm.Get_size()] = 1.0
+            residual = residual*owned
+        loss = np.array([np.sum(residual**2)])
+        gradient = 2*residual
+        if mpi_comm is not None:
+            loss, local_loss = np.empty_like(loss), loss
+            gradient, local_gradient = np.empty_like(gradient), gradient
+            mpi_comm.Allreduce(local_loss, loss)
+            mpi_comm.Allreduce(local_gradient, gradient)
+        return loss[0], gradient
+    objective = pyshdom.optimize.ObjectiveFunction(None, loss_fn)
+    return objective, counter
+
+def exponential_objective(measurements):
+    """
+    A nonlinear least squares objective function with residual exp(state) - `measurements`
+    which can be linearized for Optimizer.gauss_newton.
+    """
+    def loss_fn(state, measurements):
+        residual = np.exp(state) - measurements
+        return 0.5*np.sum(residual**2), np.exp(state)*residual
+    def linear_fn(state):
+        operator = scipy.sparse.linalg.aslinearoperator(scipy.sparse.diags(np.exp(state)))
+        return operator, np.exp(state) - measurements
+    return pyshdom.optimize.ObjectiveFunction(measurements, loss_fn, linear_fn=linear_fn)
+
+def sampled_objective(target, fraction, seed):
+    """
+    A least squares objective function that is estimated (without bias) from a
+    random `fraction` of the components of the state at each evaluation.
+    """
+    rng = np.random.default_rng(seed)
+    nchosen = max(int(round(fraction*target.size)), 1)
+    def loss_fn(state, measurements):
+        chosen = rng.choice(target.size, size=nchosen, replace=False)
+        residual = np.zeros(target.shape)
+        residual[chosen] = (state - target)[chosen]*target.size/nchosen
+        return np.sum(residual*(state - target)), 2*residual
+    return pyshdom.optimize.ObjectiveFunction(None, loss_fn)
+
+class Optimizer_Serial(TestCase):
+    def test_minimize(self):
+        target = np.array([1.0, 2.0, 3.0, 4.0])
+        objective, _ = quadratic_objective(target)
+        optimizer = pyshdom.optimize.Optimizer(objective, options={'maxiter': 50, 'disp': False})
+        result = optimizer.minimize(np.zeros(target.shape))
+        self.assertTrue(np.allclose(result.x, target))
+
+    def test_gauss_newton(self):
+        target = np.array([0.5, 1.0, 1.5, 2.0])
+        optimizer = pyshdom.optimize.Optimizer(exponential_objective(np.exp(target)))
+        result = optimizer.gauss_newton(target + 0.5, maxiter=6)
+        self.assertTrue(np.allclose(result.x, target))
+        #the optimization ends on ftol/xtol once the steps only change the loss by
+        #round-off (how soon depends on the round-off) rather than rejecting them.
+        self.assertTrue(result.success)
+        self.assertLessEqual(result.nfev, 7)
+
+    def test_levenberg_marquardt(self):
+        target = np.array([0.5, 1.0, 1.5, 2.0])
+        optimizer = pyshdom.optimize.Optimizer(exponential_objective(np.exp(target)))
+        result = optimizer.gauss_newton(np.zeros(target.shape), maxiter=50, damping=1.0,
+                                        linear_solver='cg')
+        self.assertTrue(np.allclose(result.x, target))
+
+    def test_adam(self):
+        target = np.array([1.0, 2.0, 3.0, 4.0])
+        objective, counter = quadratic_objective(target)
+        optimizer = pyshdom.optimize.Optimizer(objective)
+        result = optimizer.stochastic_gradient(np.zeros(target.shape), maxiter=1000,
+                                               learning_rate=0.05)
+        self.assertTrue(np.allclose(result.x, target, atol=1e-3))
+        self.assertEqual(counter['evaluations'], 1000)
+
+    def test_stochastic_gradient(self):
+        target = np.array([1.0, 2.0, 3.0, 4.0])
+        #each component reaches the target when it is first sampled.
+        optimizer = pyshdom.optimize.Optimizer(sampled_objective(target, 0.5, seed=1))
+        result = optimizer.stochastic_gradient(np.zeros(target.shape), maxiter=50,
+                                               learning_rate=0.25, method='sgd', beta1=0.0)
+        self.assertTrue(np.allclose(result.x, target))
+
+    def test_reproducible(self):
+        target = np.array([1.0, 2.0, 3.0, 4.0])
+        results = [pyshdom.optimize.Optimizer(
+            sampled_objective(target, 0.5, seed=1)).stochastic_gradient(
+                np.zeros(target.shape), maxiter=3) for _ in range(2)]
+        self.assertTrue(np.array_equal(results[0].x, results[1].x))
+
+@skipIf(MPI is None, 'mpi4py is not installed.')
+class Optimizer_PersistentMPIWorkers(TestCase):
+    """
+    Can be run with any number of ranks (e.g. `mpirun -n 2 python -m pytest test_optimize.py`).
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.mpi_comm = MPI.COMM_WORLD
+        cls.target = np.array([1.0, 2.0, 3.0, 4.0])
+        objective, cls.counter = quadratic_objective(cls.target, cls.mpi_comm)
+        optimizer = pyshdom.optimize.Optimizer(objective, options={'maxiter': 50, 'disp': False},
+                                               mpi_comm=cls.mpi_comm)
+        cls.result = optimizer.minimize(np.zeros(cls.target.shape))
+
+    def test_result(self):
+        if self.mpi_comm.Get_rank() == 0:
+            self.assertTrue(np.allclose(self.result.x, self.target))
+        else:
+            self.assertIsNone(self.result)
+
+    def test_evaluations(self):
+        #the workers evaluate the objective exactly when the root does.
+        evaluations = self.mpi_comm.allgather(self.counter['evaluations'])
+        self.assertTrue(all([count == evaluations[0] for count in evaluations]))
+
+    def test_root_error(self):
+        #the workers are released when the root raises between evaluations (in a callback).
+        objective, _ = quadratic_objective(self.target, self.mpi_comm)
+        def failing_callback():
+            raise RuntimeError("callback failed")
+        optimizer = pyshdom.optimize.Optimizer(objective, callback_fn=failing_callback,
+                                               options={'maxiter': 50, 'disp': False},
+                                               mpi_comm=self.mpi_comm)
+        if self.mpi_comm.Get_rank() == 0:
+            with self.assertRaises(RuntimeError):
+                optimizer.minimize(np.zeros(self.target.shape))
+        else:
+            self.assertIsNone(optimizer.minimize(np.zeros(self.target.shape)))
+        self.assertEqual(self.mpi_comm.allgather(1), [1]*self.mpi_comm.Get_size())
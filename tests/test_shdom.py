@@ -1,6 +1,14 @@
-from unittest import TestCase
+from unittest import TestCase, skipIf
 from collections import OrderedDict
+import copy
+import gc
+import hashlib
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import scipy.sparse
 import xarray as xr
 import pyshdom
 
@@ -61,6 +69,70 @@ def get_basic_state_for_surface():
     return sensor, rayleigh, config
 
 
+def get_small_cloud_problem(wavelengths=(0.86, 1.38), ext=20.0, num_stokes=1,
+                            return_poly_tables=False):
+    """
+    A small cloud and sensors at two view angles for each wavelength used
+    for testing the parallelization and solution management of SolversDict.
+    If `return_poly_tables` the mie tables of the cloud are also returned
+    for defining pyshdom.containers.UnknownScatterers.
+    """
+    rte_grid = pyshdom.grid.make_grid(0.05, 11, 0.05, 11, np.linspace(0.1, 0.6, 11))
+    shape = (rte_grid.x.size, rte_grid.y.size, rte_grid.z.size)
+    rte_grid['density'] = (['x','y','z'], np.ones(shape))
+    rte_grid['reff'] = (['x','y','z'], np.zeros(shape)+0.5)
+    rte_grid['veff'] = (['x','y','z'], np.zeros(shape)+0.1)
+    cloud_scatterer_on_rte_grid = pyshdom.grid.resample_onto_grid(rte_grid, rte_grid)
+
+    sensors = pyshdom.containers.SensorsDict()
+    solvers = pyshdom.containers.SolversDict()
+    poly_tables = OrderedDict()
+    for wavelength in wavelengths:
+        for zenith, azimuth in ((0.0, 0.0), (45.6, 90.0)):
+            sensors.add_sensor('MISR',
+                               pyshdom.sensor.orthographic_projection(
+                                   wavelength, cloud_scatterer_on_rte_grid, 0.04, 0.04,
+                                   azimuth, zenith, altitude='TOA', stokes=['I'])
+                              )
+        mie_mono_table = pyshdom.mie.get_mono_table('Water', (wavelength, wavelength),
+                                                    max_integration_radius=10.0,
+                                                    minimum_effective_radius=0.1,
+                                                    relative_dir='../mie_tables',
+                                                    verbose=False)
+        cloud_size_distribution = pyshdom.size_distribution.get_size_distribution_grid(
+            mie_mono_table.radius.data,
+            size_distribution_function=pyshdom.size_distribution.gamma, particle_density=1.0,
+            reff={'coord_min':0.2, 'coord_max': 1.0, 'npoints': 10,
+                  'spacing': 'logarithmic', 'units': 'micron'},
+            veff={'coord_min':0.09, 'coord_max': 0.11, 'npoints': 12,
+                  'spacing': 'linear', 'units': 'unitless'}
+            )
+        poly_table = pyshdom.mie.get_poly_table(cloud_size_distribution, mie_mono_table)
+        poly_tables[wavelength] = poly_table
+        optical_properties = pyshdom.medium.table_to_grid(cloud_scatterer_on_rte_grid, poly_table)
+        extinction = np.zeros(optical_properties.extinction.shape)
+        np.random.seed(1)
+        extinction[1:-1, 1:-1, 1:-1] = ext + np.random.uniform(low=0.0, high=10.0, size=(9, 9, 9))
+        optical_properties['extinction'][:, :, :] = extinction
+        config = pyshdom.configuration.get_config('../default_config.json')
+        config['num_mu_bins'] = 4
+        config['num_phi_bins'] = 8
+        config['split_accuracy'] = 0.1
+        config['spherical_harmonics_accuracy'] = 0.0
+        config['solution_accuracy'] = 1e-4
+        solvers.add_solver(wavelength,
+                           pyshdom.solver.RTE(numerical_params=config,
+                                              medium={'cloud': optical_properties},
+                                              source=pyshdom.source.solar(wavelength, -0.5, 0.0,
+                                                                          solarflux=1.0),
+                                              surface=pyshdom.surface.lambertian(albedo=0.05),
+                                              num_stokes=num_stokes,
+                                              name=None)
+                          )
+    if return_poly_tables:
+        return sensors, solvers, poly_tables
+    return sensors, solvers
+
 def solve_prop(solver, filename='data/rico32x36x26w672.prp'):
     """
     This function is for verification against SHDOM.
@@ -313,6 +385,7 @@ class Parallelization_Subdivide_Rays(TestCase):
         solvers = pyshdom.containers.SolversDict({3.4: None, 0.8: None, 1.6:None, 2.0:None})
         rte_sensors, sensor_mapping = Sensordict.sort_sensors(solvers)
         keys, ray_start_end, pixel_start_end = pyshdom.parallel.subdivide_raytrace_jobs(rte_sensors, 4)
+        cls.rte_sensors = rte_sensors
         cls.ray_start_end = ray_start_end
         cls.pixel_start_end = pixel_start_end
 
@@ -334,6 +407,46 @@ class Parallelization_Subdivide_Rays(TestCase):
                                                  (0, 323),
                                                  (0, 323)])
 
+    def test_ray_costs(self):
+        #rays in the first half of each sensor are ten times more expensive.
+        ray_costs = OrderedDict()
+        for key, rte_sensor in self.rte_sensors.items():
+            ray_costs[key] = np.ones(rte_sensor.sizes['nrays'])
+            ray_costs[key][:rte_sensor.sizes['nrays']//2] = 10.0
+        keys, ray_start_end, pixel_start_end = pyshdom.parallel.subdivide_raytrace_jobs(
+            self.rte_sensors, 4, ray_costs=ray_costs)
+        job_costs = [ray_costs[key][start:end].sum() for key, (start, end) in zip(keys, ray_start_end)]
+        default_costs = [ray_costs[key][start:end].sum() for key, (start, end) in
+                         zip(keys, self.ray_start_end)]
+        self.assertLess(max(job_costs), max(default_costs))
+        for key, rte_sensor in self.rte_sensors.items():
+            self.assertEqual([end for job_key, (start, end) in zip(keys, ray_start_end)
+                              if job_key == key][-1], rte_sensor.sizes['nrays'])
+
+    def test_ray_costs_concentrated(self):
+        #the first ray holds most of the cost so several of the equal cost fractions end there.
+        ray_costs = OrderedDict()
+        for key, rte_sensor in self.rte_sensors.items():
+            ray_costs[key] = np.ones(rte_sensor.sizes['nrays'])
+            ray_costs[key][0] = 1e6
+        keys, ray_start_end, pixel_start_end = pyshdom.parallel.subdivide_raytrace_jobs(
+            self.rte_sensors, 4, ray_costs=ray_costs)
+        for (ray_start, ray_end), (pix_start, pix_end) in zip(ray_start_end, pixel_start_end):
+            self.assertLess(ray_start, ray_end)
+            self.assertLess(pix_start, pix_end)
+        for key, rte_sensor in self.rte_sensors.items():
+            start_end = [job for job_key, job in zip(keys, ray_start_end) if job_key == key]
+            self.assertEqual(start_end[0][0], 0)
+            self.assertEqual(start_end[-1][1], rte_sensor.sizes['nrays'])
+            self.assertTrue(all([previous[1] == job[0] for previous, job in
+                                 zip(start_end[:-1], start_end[1:])]))
+
+    def test_ray_costs_shape(self):
+        ray_costs = OrderedDict([(key, np.ones(rte_sensor.sizes['nrays'] + 1))
+                                 for key, rte_sensor in self.rte_sensors.items()])
+        with self.assertRaises(ValueError):
+            pyshdom.parallel.subdivide_raytrace_jobs(self.rte_sensors, 4, ray_costs=ray_costs)
+
 class Parallelization_No_SubpixelRays(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -546,6 +659,1078 @@ class Parallelization_SubpixelRays(TestCase):
         self.assertTrue(test.equals(self.Sensordict['MISR']['sensor_list'][0]))
 
 
+class Parallelization_ProcessBackend(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        sensors_thread, solvers_thread = get_small_cloud_problem()
+        sensors_process, solvers_process = get_small_cloud_problem()
+        sensors_thread.get_measurements(solvers_thread, n_jobs=2, verbose=False)
+        sensors_process.get_measurements(solvers_process, n_jobs=2, verbose=False,
+                                         backend='loky')
+        cls.sensors_thread = sensors_thread
+        cls.sensors_process = sensors_process
+        cls.solvers_thread = solvers_thread
+        cls.solvers_process = solvers_process
+
+    def test_radiance(self):
+        self.assertTrue(all([np.allclose(thread.I, process.I) for thread, process in
+                             zip(self.sensors_thread['MISR']['sensor_list'],
+                                 self.sensors_process['MISR']['sensor_list'])]))
+
+    def test_solved(self):
+        self.assertTrue(all([solver.check_solved(verbose=False) for solver in
+                             self.solvers_process.values()]))
+
+    def test_continue_solution(self):
+        thread = self.solvers_thread[0.86]
+        process = self.solvers_process[0.86]
+        for solver in (thread, process):
+            solver.set_solution_accuracy(1e-5)
+            solver.solve(maxiter=100, init_solution=False, verbose=False)
+        #the acceleration history is not returned from the worker processes so
+        #the continued solutions agree only to within the solution accuracy.
+        self.assertTrue(process.check_solved(verbose=False))
+        self.assertTrue(np.allclose(thread._source, process._source, atol=1e-4))
+
+    def test_invalid_backend(self):
+        with self.assertRaises(ValueError):
+            self.solvers_thread.parallel_solve(n_jobs=2, backend='dask')
+
+
+class Parallelization_Scheduling(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        sensors_serial, solvers_serial = get_small_cloud_problem(wavelengths=(0.86, 1.38, 1.65))
+        sensors_scheduled, solvers_scheduled = get_small_cloud_problem(wavelengths=(0.86, 1.38, 1.65))
+        sensors_serial.get_measurements(solvers_serial, n_jobs=1, verbose=False)
+        sensors_scheduled.get_measurements(solvers_scheduled, n_jobs=3, verbose=False)
+        cls.sensors_serial = sensors_serial
+        cls.sensors_scheduled = sensors_scheduled
+        cls.solvers_scheduled = solvers_scheduled
+
+    def test_radiance(self):
+        self.assertTrue(all([np.allclose(serial.I, scheduled.I) for serial, scheduled in
+                             zip(self.sensors_serial['MISR']['sensor_list'],
+                                 self.sensors_scheduled['MISR']['sensor_list'])]))
+
+    def test_iterations_recorded(self):
+        self.assertEqual(dict(self.solvers_scheduled._previous_iterations),
+                         {key: solver.num_iterations for key, solver in self.solvers_scheduled.items()})
+
+    def test_order_by_cost(self):
+        _, solvers = get_small_cloud_problem(wavelengths=(0.86, 1.38, 1.65))
+        #without previous solutions the solvers have the same cost so the order is unchanged.
+        self.assertEqual(solvers.order_by_cost(solvers.keys()), [0.86, 1.38, 1.65])
+        solvers._previous_iterations[0.86] = 5
+        solvers._previous_iterations[1.65] = 20
+        #1.38 is assumed to take the mean number of iterations.
+        self.assertEqual(solvers.order_by_cost(solvers.keys()), [1.65, 1.38, 0.86])
+
+
+class Parallelization_BalancedRays(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        sensors, solvers = get_small_cloud_problem()
+        sensors_balanced, solvers_balanced = get_small_cloud_problem()
+        sensors.get_measurements(solvers, n_jobs=1, verbose=False)
+        #the second call uses the costs estimated from the first.
+        sensors_balanced.get_measurements(solvers_balanced, n_jobs=3, verbose=False, balance_rays=True)
+        cls.ray_costs = solvers_balanced.ray_costs(sensors_balanced.sort_sensors(solvers_balanced)[0])
+        sensors_balanced.get_measurements(solvers_balanced, n_jobs=3, verbose=False, balance_rays=True)
+        cls.sensors = sensors
+        cls.sensors_balanced = sensors_balanced
+        cls.solvers_balanced = solvers_balanced
+
+    def test_ray_costs(self):
+        self.assertIsNotNone(self.ray_costs)
+        self.assertTrue(all([np.all(costs > 0.0) for costs in self.ray_costs.values()]))
+
+    def test_threaded_ray_costs(self):
+        rte_sensors, _ = self.sensors_balanced.sort_sensors(self.solvers_balanced)
+        serial = pyshdom.parallel.parallel_estimate_ray_costs(self.solvers_balanced, rte_sensors)
+        threaded = pyshdom.parallel.parallel_estimate_ray_costs(self.solvers_balanced, rte_sensors,
+                                                                n_jobs=3, ray_costs=self.ray_costs)
+        for key in rte_sensors:
+            self.assertTrue(np.allclose(serial[key], threaded[key]))
+
+    def test_radiance(self):
+        self.assertTrue(all([np.allclose(serial.I, balanced.I) for serial, balanced in
+                             zip(self.sensors['MISR']['sensor_list'],
+                                 self.sensors_balanced['MISR']['sensor_list'])]))
+
+
+class SolversDict_WarmStart(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        _, solvers = get_small_cloud_problem(wavelengths=(0.86,))
+        _, solvers_updated = get_small_cloud_problem(wavelengths=(0.86,), ext=20.5)
+        _, solvers_changed = get_small_cloud_problem(wavelengths=(0.86,), ext=40.0)
+        _, solvers_cold = get_small_cloud_problem(wavelengths=(0.86,), ext=20.5)
+        solvers.parallel_solve(verbose=False)
+        cls.cold_iterations = solvers[0.86].num_iterations
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            solvers.add_solver(0.86, solvers_updated[0.86], warm_start=True)
+            solvers.parallel_solve(verbose=False)
+        cls.warm_iterations = solvers[0.86].num_iterations
+        cls.iterations_saved = OrderedDict(solvers.iterations_saved)
+        solvers_cold.parallel_solve(verbose=False)
+        cls.solver_warm = solvers[0.86]
+        cls.solver_cold = solvers_cold[0.86]
+        solvers.add_solver(0.86, solvers_changed[0.86], warm_start=True)
+        cls.warm_start_keys = set(solvers._warm_start_keys)
+
+    def test_iterations_saved(self):
+        self.assertLess(self.warm_iterations, self.cold_iterations)
+        self.assertEqual(self.iterations_saved[0.86], self.cold_iterations - self.warm_iterations)
+
+    def test_fluxes(self):
+        #both solutions are converged to the solution accuracy on their own adaptive grids
+        #so they only agree to within a few percent of the maximum flux.
+        self.assertTrue(np.allclose(self.solver_warm.fluxes.flux_down.data,
+                                    self.solver_cold.fluxes.flux_down.data, atol=5e-2))
+
+    def test_cold_start_large_change(self):
+        self.assertEqual(self.warm_start_keys, set())
+
+
+class RTE_UpdateMedium(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        _, solvers = get_small_cloud_problem(wavelengths=(0.86,))
+        _, solvers_new = get_small_cloud_problem(wavelengths=(0.86,), ext=20.5)
+        _, solvers_unsolved = get_small_cloud_problem(wavelengths=(0.86,))
+        cls.new_medium = solvers_new[0.86].medium
+        solver = solvers[0.86]
+        solver.solve(maxiter=100, verbose=False)
+        cls.cold_iterations = solver.num_iterations
+        solver.update_medium({'cloud': cls.new_medium['cloud']})
+        cls.solved_after_update = solver.check_solved(verbose=False)
+        solver.solve(maxiter=100, init_solution=False, verbose=False)
+        solvers_new[0.86].solve(maxiter=100, verbose=False)
+        solvers_unsolved[0.86].update_medium(
+            {'cloud': {'extinction': cls.new_medium['cloud'].extinction.data}})
+        cls.solver = solver
+        cls.solver_new = solvers_new[0.86]
+        cls.solver_unsolved = solvers_unsolved[0.86]
+
+    def test_unsolved_after_update(self):
+        self.assertFalse(self.solved_after_update)
+
+    def test_iterations(self):
+        self.assertLess(self.solver.num_iterations, self.cold_iterations)
+
+    def test_fluxes(self):
+        #the updated solution is continued on the adaptive grid refined for the old
+        #extinction so its diffuse flux matches the fresh solution only to the solution
+        #accuracy, while the direct beam is recomputed from scratch for the new medium.
+        self.assertTrue(np.allclose(self.solver.fluxes.flux_down.data,
+                                    self.solver_new.fluxes.flux_down.data, atol=5e-2))
+        self.assertTrue(np.allclose(self.solver.fluxes.flux_direct.data,
+                                    self.solver_new.fluxes.flux_direct.data, atol=1e-5))
+
+    def test_optical_properties(self):
+        #without a solution the grid is the base grid so the properties are identical.
+        npts = self.solver_new._nbpts
+        for name in ('_extinct', '_albedo', '_iphase', '_total_ext'):
+            self.assertTrue(np.array_equal(getattr(self.solver_unsolved, name)[:npts],
+                                           getattr(self.solver_new, name)[:npts]))
+
+    def test_medium(self):
+        self.assertTrue(self.solver_unsolved.medium['cloud'].extinction.equals(
+            self.new_medium['cloud'].extinction))
+
+    def test_negative_extinction(self):
+        extinction = -1*self.new_medium['cloud'].extinction.data
+        with self.assertRaises(pyshdom.exceptions.NegativeValueError):
+            self.solver_unsolved.update_medium({'cloud': {'extinction': extinction}})
+
+    def test_table_index_range(self):
+        table_index = self.new_medium['cloud'].table_index.data + 10000
+        with self.assertRaises(pyshdom.exceptions.OutOfRangeError):
+            self.solver_unsolved.update_medium({'cloud': {'table_index': table_index}})
+
+    def test_table_index_zero(self):
+        #table_index is 1-based.
+        table_index = np.zeros_like(self.new_medium['cloud'].table_index.data)
+        with self.assertRaises(pyshdom.exceptions.OutOfRangeError):
+            self.solver_unsolved.update_medium({'cloud': {'table_index': table_index}})
+
+    def test_shape(self):
+        with self.assertRaises(ValueError):
+            self.solver_unsolved.update_medium({'cloud': {'ssalb': np.ones(3)}})
+
+    def test_unknown_scatterer(self):
+        with self.assertRaises(KeyError):
+            self.solver_unsolved.update_medium({'rayleigh': {'ssalb': np.ones(3)}})
+
+
+class SolvedSmallCloud(TestCase):
+    """
+    Solves the RTE for the small cloud from get_small_cloud_problem at
+    `wavelengths` with `num_stokes` Stokes components. Subclasses extend
+    setUpClass with their own set up.
+    """
+    wavelengths = (0.86,)
+    num_stokes = 1
+    solve_kwargs = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sensors, cls.solvers = get_small_cloud_problem(wavelengths=cls.wavelengths,
+                                                           num_stokes=cls.num_stokes)
+        cls.solvers.parallel_solve(maxiter=100, verbose=False, **cls.solve_kwargs)
+        cls.solver = cls.solvers[cls.wavelengths[0]]
+
+
+class Memory_Tuning(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        _, solvers = get_small_cloud_problem(wavelengths=(0.86,))
+        solver = solvers[0.86]
+        cls.projected = solvers.dry_run(verbose=False)[0.86]
+        tuner = pyshdom.configuration.MemoryTuner(safety_factor=1.2)
+        cls.reduced_solver = tuner.pre_solve(solver, key=0.86)
+        solver.solve(maxiter=100, verbose=False)
+        cls.solver = solver
+        tuner.record(solver, key=0.86)
+        cls.tuned_params = tuner.propose(solver.numerical_params, key=0.86, match_key=True)
+        cls.tuner = tuner
+
+    def test_projected_memory(self):
+        #the memory actually used must be less than projected for the allocated sizes.
+        self.assertLessEqual(self.solver.final_maxmb, self.projected)
+        self.assertAlmostEqual(self.solver.estimate_memory(
+            adapt_grid_factor=self.solver.final_adapt_grid_factor,
+            num_sh_term_factor=self.solver.final_shterm_factor,
+            cell_to_point_ratio=self.solver.final_cell_point_ratio), self.solver.final_maxmb, places=0)
+
+    def test_pre_solve(self):
+        self.assertEqual(self.reduced_solver._nmu, self.solver._nmu//2)
+        self.assertTrue(self.reduced_solver.check_solved(verbose=False))
+
+    def test_proposed_parameters(self):
+        for name, final in (('adapt_grid_factor', 'final_adapt_grid_factor'),
+                            ('num_sh_term_factor', 'final_shterm_factor'),
+                            ('cell_to_point_ratio', 'final_cell_point_ratio')):
+            self.assertGreaterEqual(self.tuned_params[name].data, 1.2*getattr(self.solver, final)-1e-6)
+        self.assertLess(self.tuned_params.adapt_grid_factor.data,
+                        self.solver.numerical_params.adapt_grid_factor.data)
+
+    def test_tuned_solution(self):
+        _, solvers = get_small_cloud_problem(wavelengths=(0.86,))
+        solver = pyshdom.solver.RTE(numerical_params=self.tuned_params,
+                                    medium=solvers[0.86].medium,
+                                    source=solvers[0.86].source,
+                                    surface=solvers[0.86].surface)
+        self.assertLess(solver.estimate_memory(), self.projected)
+        solver.solve(maxiter=100, verbose=False)
+        self.assertTrue(solver.check_solved(verbose=False))
+
+    def test_no_observations(self):
+        with self.assertRaises(KeyError):
+            self.tuner.propose(self.solver.numerical_params, key=1.0, match_key=True)
+
+class Memory_AutoGrow(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        _, solvers = get_small_cloud_problem(wavelengths=(0.86,))
+        def make_solver(adapt_grid_factor):
+            numerical_params = solvers[0.86].numerical_params.copy(deep=True)
+            numerical_params['adapt_grid_factor'] = adapt_grid_factor
+            return pyshdom.solver.RTE(numerical_params=numerical_params,
+                                      medium=solvers[0.86].medium,
+                                      source=solvers[0.86].source,
+                                      surface=solvers[0.86].surface)
+        cls.reference = make_solver(5.0)
+        cls.reference.solve(maxiter=100, verbose=False)
+        #the adaptive grid runs out of memory with this adapt_grid_factor.
+        cls.capped = make_solver(1.1)
+        cls.initial_maxig = cls.capped._maxig
+        cls.capped.solve(maxiter=100, verbose=False)
+        cls.grown = make_solver(1.1)
+        cls.grown.solve(maxiter=100, verbose=False, auto_grow=True)
+
+    def test_grown(self):
+        self.assertGreater(self.grown._maxig, self.initial_maxig)
+        self.assertGreater(self.grown._npts, self.capped._npts)
+        self.assertTrue(self.grown.check_solved(verbose=False))
+
+    def test_matches_reference(self):
+        self.assertEqual(self.grown._npts, self.reference._npts)
+        reference = self.reference.fluxes.flux_down.data
+        grown_error = np.abs(self.grown.fluxes.flux_down.data - reference).max()
+        capped_error = np.abs(self.capped.fluxes.flux_down.data - reference).max()
+        self.assertLess(grown_error, capped_error)
+
+    def test_growth_factor(self):
+        with self.assertRaises(ValueError):
+            self.capped.solve(maxiter=100, verbose=False, auto_grow=True, growth_factor=1.0)
+
+class RTE_Compact(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        sensors, solvers = get_small_cloud_problem(wavelengths=(0.86, 1.38))
+        cls.rte_sensors, _ = sensors.sort_sensors(solvers)
+        solvers.parallel_solve(maxiter=100, verbose=False)
+        cls.reference = {key: solver.integrate_to_sensor(cls.rte_sensors[key].copy(deep=True)).I.data
+                         for key, solver in solvers.items()}
+        cls.allocated = {key: solver._source.shape for key, solver in solvers.items()}
+        cls.nbytes = {key: solver._radiance.nbytes for key, solver in solvers.items()}
+        _, cls.solvers = get_small_cloud_problem(wavelengths=(0.86, 1.38))
+        cls.solvers.parallel_solve(maxiter=100, verbose=False, compact=True)
+
+    def test_trimmed(self):
+        for key, solver in self.solvers.items():
+            self.assertEqual(solver._source.shape[1], solver._shptr[solver._npts])
+            self.assertLess(solver._radiance.nbytes, self.nbytes[key])
+            self.assertIsNone(solver._work)
+
+    def test_render(self):
+        for key, solver in self.solvers.items():
+            radiances = solver.integrate_to_sensor(self.rte_sensors[key].copy(deep=True)).I.data
+            self.assertTrue(np.allclose(radiances, self.reference[key]))
+
+    def test_continue_solution(self):
+        solver = copy.deepcopy(self.solvers[0.86])
+        solver.solve(maxiter=100, init_solution=False, verbose=False)
+        self.assertEqual(solver._source.shape, self.allocated[0.86])
+        self.assertTrue(solver.check_solved(verbose=False))
+
+    def test_unsolved(self):
+        _, solvers = get_small_cloud_problem(wavelengths=(0.86,))
+        with self.assertRaises(pyshdom.exceptions.SHDOMError):
+            solvers[0.86].compact()
+
+class RTE_Compress(SolvedSmallCloud):
+    solve_kwargs = {'compact': True}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.sensor = cls.sensors.sort_sensors(cls.solvers)[0][0.86]
+        cls.nbytes = cls.solver._source.nbytes + cls.solver._radiance.nbytes
+        cls.fluxes = cls.solver.fluxes
+        cls.errors = cls.solver.compress(sensor=cls.sensor)
+
+    def test_memory(self):
+        self.assertIsNone(self.solver._source)
+        nbytes = sum([compressed['data'].nbytes + compressed['scales'].nbytes
+                      for compressed in self.solver._compressed.values()])
+        self.assertLess(nbytes, 0.6*self.nbytes)
+
+    def test_errors(self):
+        self.assertEqual(list(self.errors), ['_source', '_radiance', 'I'])
+        for error in self.errors.values():
+            self.assertLess(error, 1e-3)
+
+    def test_fluxes(self):
+        self.assertTrue(np.allclose(self.solver.fluxes.flux_down, self.fluxes.flux_down))
+
+    def test_decompress(self):
+        solver = copy.deepcopy(self.solver)
+        solver.decompress()
+        self.assertIsNone(solver._compressed)
+        self.assertEqual(solver._source.dtype, np.float32)
+        self.assertEqual(solver._source.shape[1], solver._shptr[solver._npts])
+
+    def test_block_scaling(self):
+        #values spanning many orders of magnitude are each accurate relative to their block.
+        array = np.asfortranarray(np.outer([1.0, -1e3], 10.0**np.arange(-8, 8)).astype(np.float32))
+        compressed = pyshdom.util.float16_compress(array, block_size=1)
+        self.assertTrue(np.allclose(pyshdom.util.float16_decompress(compressed), array, rtol=1e-3))
+
+
+class RTE_SolutionStore(SolvedSmallCloud):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.rte_sensors, _ = cls.sensors.sort_sensors(cls.solvers)
+        cls.reference = cls.solver.integrate_to_sensor(cls.rte_sensors[0.86].copy(deep=True)).I.data
+        cls.allocated = cls.solver._source.shape
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.store = pyshdom.containers.SolutionStore(cls.directory.name)
+        cls.store.save_solvers(cls.solvers)
+        _, cls.solvers = get_small_cloud_problem(wavelengths=(0.86,))
+        cls.store.load_solvers(cls.solvers)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_memory_mapped(self):
+        solver = self.solvers[0.86]
+        self.assertIsInstance(solver._source.base, np.memmap)
+        self.assertFalse(solver._radiance.flags.writeable)
+        self.assertTrue(solver.check_solved(verbose=False))
+
+    def test_render(self):
+        radiances = self.solvers[0.86].integrate_to_sensor(self.rte_sensors[0.86].copy(deep=True)).I.data
+        self.assertTrue(np.allclose(radiances, self.reference))
+
+    def test_continue_solution(self):
+        solver = copy.deepcopy(self.solvers[0.86])
+        solver.solve(maxiter=100, init_solution=False, verbose=False)
+        self.assertEqual(solver._source.shape, self.allocated)
+        self.assertTrue(solver._source.flags.writeable)
+
+    def test_missing_key(self):
+        self.assertNotIn(1.38, self.store)
+        with self.assertRaises(KeyError):
+            self.store.load(1.38, copy.deepcopy(self.solvers[0.86]))
+
+    def test_mismatched_grid(self):
+        _, solvers = get_small_cloud_problem(wavelengths=(0.86,), num_stokes=3)
+        with self.assertRaises(ValueError):
+            self.store.load(0.86, solvers[0.86])
+
+
+class RTE_SolutionCache(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.cache = pyshdom.containers.SolutionCache(cls.directory.name)
+        sensors, solvers = get_small_cloud_problem(wavelengths=(0.86, 1.38))
+        cls.rte_sensors, _ = sensors.sort_sensors(solvers)
+        solvers.parallel_solve(maxiter=100, verbose=False, cache=cls.cache)
+        cls.reference = {key: solver.integrate_to_sensor(cls.rte_sensors[key].copy(deep=True)).I.data
+                         for key, solver in solvers.items()}
+        cls.first_stats = cls.cache.stats
+        _, cls.solvers = get_small_cloud_problem(wavelengths=(0.86, 1.38))
+        cls.solvers.parallel_solve(maxiter=100, verbose=False, cache=cls.cache)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_stats(self):
+        self.assertEqual(self.first_stats['misses'], 2)
+        self.assertEqual(self.first_stats['hits'], 0)
+        self.assertEqual(self.first_stats['entries'], 2)
+        self.assertEqual(self.cache.stats['hits'], 2)
+
+    def test_render(self):
+        for key, solver in self.solvers.items():
+            #restored from the cache rather than solved.
+            self.assertIsInstance(solver._source.base, np.memmap)
+            radiances = solver.integrate_to_sensor(self.rte_sensors[key].copy(deep=True)).I.data
+            self.assertTrue(np.allclose(radiances, self.reference[key]))
+
+    def test_key(self):
+        _, solvers = get_small_cloud_problem(wavelengths=(0.86,), ext=10.0)
+        _, stokes_solvers = get_small_cloud_problem(wavelengths=(0.86,), num_stokes=3)
+        keys = [pyshdom.containers.SolutionCache.solver_key(solver) for solver in
+                (self.solvers[0.86], solvers[0.86], stokes_solvers[0.86], self.solvers[1.38])]
+        self.assertEqual(len(set(keys)), 4)
+        self.assertIn(keys[0], self.cache)
+
+    def test_object_arrays(self):
+        digests = []
+        for middle in ('a', 'b'):
+            value = np.array(['x']*2000, dtype=object)
+            value[1000] = middle
+            hasher = hashlib.sha256()
+            pyshdom.containers._update_hash(hasher, value)
+            digests.append(hasher.hexdigest())
+        self.assertNotEqual(digests[0], digests[1])
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = pyshdom.containers.SolutionCache(directory)
+            cache.insert(self.solvers[0.86])
+            #back-date the first solution so that the eviction order doesn't depend
+            #on the resolution of the file modification times.
+            os.utime(cache.path(cache.solver_key(self.solvers[0.86])), ns=(0, 0))
+            cache.max_size_mb = 0.0
+            cache.insert(self.solvers[1.38])
+            self.assertEqual(cache.stats['evictions'], 1)
+            self.assertEqual(cache.stats['entries'], 1)
+            self.assertIn(cache.solver_key(self.solvers[1.38]), cache)
+
+
+class RTE_RenderBatch(SolvedSmallCloud):
+    num_stokes = 3
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.sensors = [sensor.copy(deep=True) for sensor in cls.sensors['MISR']['sensor_list']]
+        cls.stokes, cls.offsets = cls.solver.render_batch(
+            cls.sensors + [tuple(cls.sensors[0][name].data for name in
+                                 ('ray_x', 'ray_y', 'ray_z', 'ray_mu', 'ray_phi'))]
+            )
+
+    def test_offsets(self):
+        self.assertEqual(self.offsets[-1], self.stokes.shape[0])
+        self.assertEqual(self.offsets.size, len(self.sensors) + 2)
+        self.assertEqual(self.stokes.shape[1], 3)
+        self.assertTrue(self.stokes.flags.c_contiguous)
+
+    def test_integrate_to_sensor(self):
+        for i, sensor in enumerate(self.sensors + self.sensors[:1]):
+            reference = self.solver.integrate_to_sensor(sensor.copy(deep=True))
+            stokes = self.stokes[self.offsets[i]:self.offsets[i+1]]
+            for j, name in enumerate(('I', 'Q', 'U')):
+                self.assertTrue(np.allclose(stokes[:, j], reference[name].data))
+
+    def test_invalid_rays(self):
+        with self.assertRaises(TypeError):
+            self.solver.render_batch([np.zeros(5)])
+
+
+class RTE_RenderRays(SolvedSmallCloud):
+    num_stokes = 3
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.sensor = cls.sensors['MISR']['sensor_list'][1].copy(deep=True)
+        cls.rays = [cls.sensor[name].data for name in ('ray_x', 'ray_y', 'ray_z', 'ray_mu', 'ray_phi')]
+        cls.reference = cls.solver.integrate_to_sensor(cls.sensor.copy(deep=True))
+
+    def test_out(self):
+        out = np.zeros((self.sensor.sizes['nrays'], 3), dtype=np.float32)
+        stokes = self.solver.render_rays(*self.rays, out=out)
+        self.assertIs(stokes, out)
+        for i, name in enumerate(('I', 'Q', 'U')):
+            self.assertTrue(np.allclose(out[:, i], self.reference[name].data))
+
+    def test_allocated(self):
+        stokes = self.solver.render_rays(*self.rays)
+        self.assertEqual(stokes.shape, (self.sensor.sizes['nrays'], 3))
+        self.assertTrue(np.allclose(stokes[:, 0], self.reference.I.data))
+
+    def test_invalid_out(self):
+        for out in (np.zeros((self.sensor.sizes['nrays'], 3)),
+                    np.zeros((3, self.sensor.sizes['nrays']), dtype=np.float32).T,
+                    np.zeros((self.sensor.sizes['nrays'], 1), dtype=np.float32)):
+            with self.assertRaises(ValueError):
+                self.solver.render_rays(*self.rays, out=out)
+
+    def test_mismatched_rays(self):
+        with self.assertRaises(ValueError):
+            self.solver.render_rays(*self.rays[:4], self.rays[4][1:])
+
+
+class RTE_RenderChunks(SolvedSmallCloud):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.sub_pixel_ray_args = {'method': pyshdom.sensor.gaussian, 'degree': (2, 3)}
+        cls.pixel_sensors = [
+            pyshdom.sensor.orthographic_projection(0.86, cls.solver._grid, 0.04, 0.04, 30.0, 20.0,
+                                                   stokes=['I']),
+            pyshdom.sensor.perspective_projection(0.86, 30.0, 8, 6, [0.25, 0.25, 3.0],
+                                                  [0.25, 0.25, 0.0], [0, 1, 0], stokes=['I'])
+            ]
+        sensors = pyshdom.containers.SensorsDict()
+        sensors.add_sensor('Orthographic', pyshdom.sensor.orthographic_projection(
+            0.86, cls.solver._grid, 0.04, 0.04, 30.0, 20.0, stokes=['I'],
+            sub_pixel_ray_args=dict(cls.sub_pixel_ray_args)))
+        sensors.add_sensor('Perspective', pyshdom.sensor.perspective_projection(
+            0.86, 30.0, 8, 6, [0.25, 0.25, 3.0], [0.25, 0.25, 0.0], [0, 1, 0], stokes=['I'],
+            sub_pixel_ray_args=dict(cls.sub_pixel_ray_args)))
+        sensors.get_measurements(cls.solvers, verbose=False)
+        cls.reference = [sensors[name]['sensor_list'][0].I.data
+                         for name in ('Orthographic', 'Perspective')]
+
+    def test_chunks(self):
+        for sensor, reference in zip(self.pixel_sensors, self.reference):
+            chunks = list(self.solver.render_chunks(sensor, chunk_size=50,
+                                                    sub_pixel_ray_args=self.sub_pixel_ray_args))
+            self.assertGreater(len(chunks), 1)
+            stokes = np.concatenate([chunk for _, chunk in chunks])
+            self.assertTrue(np.allclose(stokes[:, 0], reference))
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'stokes.npy')
+            self.solver.stream_render(self.pixel_sensors[0], path, chunk_size=100,
+                                      sub_pixel_ray_args=self.sub_pixel_ray_args)
+            self.assertTrue(np.allclose(np.load(path)[:, 0], self.reference[0]))
+
+    def test_callback(self):
+        pixels_list = []
+        self.solver.stream_render(self.pixel_sensors[0], lambda pixels, stokes: pixels_list.append(pixels),
+                                  chunk_size=100, sub_pixel_ray_args=self.sub_pixel_ray_args)
+        self.assertEqual(pixels_list[-1].stop, self.pixel_sensors[0].sizes['npixels'])
+
+    def test_no_subpixel_rays(self):
+        stokes = np.concatenate([chunk for _, chunk in
+                                 self.solver.render_chunks(self.pixel_sensors[0], chunk_size=10)])
+        reference = self.solver.integrate_to_sensor(self.pixel_sensors[0].copy(deep=True)).I.data
+        self.assertTrue(np.allclose(stokes[:, 0], reference))
+
+
+class RTE_PhaseTableCache(SolvedSmallCloud):
+    wavelengths = (0.86, 1.38)
+
+    @classmethod
+    def setUpClass(cls):
+        pyshdom.solver.clear_phase_table_cache()
+        super().setUpClass()
+        _, cls.other_solvers = get_small_cloud_problem(wavelengths=(0.86,))
+        cls.other_solvers.parallel_solve(maxiter=100, verbose=False)
+
+    def test_shared(self):
+        self.solvers[0.86]._precompute_phase()
+        self.other_solvers[0.86]._precompute_phase()
+        self.assertIs(self.solvers[0.86]._phasetab, self.other_solvers[0.86]._phasetab)
+        self.assertFalse(self.solvers[0.86]._phasetab.flags.writeable)
+
+    def test_distinct(self):
+        self.solvers[0.86]._precompute_phase()
+        self.solvers[1.38]._precompute_phase()
+        self.assertIsNot(self.solvers[0.86]._phasetab, self.solvers[1.38]._phasetab)
+
+    def test_invalidated(self):
+        solver = copy.deepcopy(self.other_solvers[0.86])
+        solver._precompute_phase()
+        reference = solver._phasetab
+        solver._legen = solver._legen*0.5
+        solver._precompute_phase()
+        self.assertIsNot(solver._phasetab, reference)
+        self.assertFalse(np.allclose(solver._phasetab, reference))
+
+    def test_retained(self):
+        solvers = list(self.solvers.values()) + list(self.other_solvers.values())
+        for solver in solvers:
+            solver._precompute_phase()
+        self.assertTrue(all([pyshdom.solver._PHASE_TABLES[solver._phasetab_key] is solver._phasetab
+                             for solver in solvers]))
+
+    def test_released(self):
+        solver = copy.deepcopy(self.other_solvers[0.86])
+        solver._legen = solver._legen*0.25
+        solver._precompute_phase()
+        key = solver._phasetab_key
+        self.assertIn(key, pyshdom.solver._PHASE_TABLES)
+        del solver
+        gc.collect()
+        self.assertNotIn(key, pyshdom.solver._PHASE_TABLES)
+
+
+def get_small_cloud_gradient_call(mpi_comm=None, n_jobs=1, batch_kwargs=None,
+                                  indices_for_jacobian=([1], [1], [1]), sparse_jacobian=False,
+                                  zero_uncertainties=False):
+    """
+    Prepares the gradient for a perturbed cloud from measurements of
+    the cloud from get_small_cloud_problem at three wavelengths.
+    If `zero_uncertainties` then the inverse error-covariance of the first half
+    of the pixels of each sensor is zero.
+    """
+    sensors, solvers, poly_tables = get_small_cloud_problem(wavelengths=(0.86, 1.38, 1.65),
+                                                            return_poly_tables=True)
+    sensors.get_measurements(solvers, n_jobs=1, verbose=False)
+    unknown_scatterers = pyshdom.containers.UnknownScatterers()
+    unknown_scatterers.add_unknown('cloud', ['extinction'], poly_tables)
+    unknown_scatterers.create_derivative_tables()
+    perturbed_solvers = pyshdom.containers.SolversDict()
+    for key, solver in solvers.items():
+        medium = solver.medium['cloud'].copy(deep=True)
+        medium['extinction'][:] *= 1.1
+        perturbed_solvers.add_solver(key, pyshdom.solver.RTE(numerical_params=solver.numerical_params,
+                                                             medium={'cloud': medium},
+                                                             source=solver.source,
+                                                             surface=solver.surface,
+                                                             num_stokes=1))
+    forward_sensors = sensors.make_forward_sensors()
+    gradient_call = pyshdom.gradient.LevisApproxGradientUncorrelated(
+        sensors, perturbed_solvers, forward_sensors, unknown_scatterers,
+        parallel_solve_kwargs={'n_jobs': n_jobs, 'mpi_comm': mpi_comm, 'maxiter': 100,
+                               'verbose': False},
+        gradient_kwargs={'exact_single_scatter': True, 'cost_function': 'L2',
+                         'indices_for_jacobian': indices_for_jacobian,
+                         'sparse_jacobian': sparse_jacobian},
+        uncertainty_kwargs={'add_noise': False}, batch_kwargs=batch_kwargs)
+    if zero_uncertainties:
+        for sensor in sensors['MISR']['sensor_list']:
+            sensor.uncertainties.data[..., :sensor.sizes['npixels']//2] = 0.0
+    return gradient_call, forward_sensors
+
+def get_small_cloud_gradient(mpi_comm=None, n_jobs=1, batch_kwargs=None,
+                             precomputed_stokes=False, indices_for_jacobian=([1], [1], [1]),
+                             zero_uncertainties=False):
+    """
+    Evaluates the gradient from get_small_cloud_gradient_call.
+    If `precomputed_stokes` then the gradient is evaluated a second time using
+    the Stokes vectors from the first evaluation.
+    """
+    gradient_call, forward_sensors = get_small_cloud_gradient_call(
+        mpi_comm=mpi_comm, n_jobs=n_jobs, batch_kwargs=batch_kwargs,
+        indices_for_jacobian=indices_for_jacobian, zero_uncertainties=zero_uncertainties)
+    loss, gradient, jacobian = gradient_call()
+    if precomputed_stokes:
+        loss, gradient, jacobian = gradient_call(precomputed_stokes=True)
+    return loss, gradient, jacobian, forward_sensors
+
+class Gradient_Linearize(TestCase):
+    """
+    Compares the products of the linearization of the gradient with those of
+    the sparse Jacobian, weighted like the residual.
+    """
+    @classmethod
+    def setUpClass(cls):
+        gradient_call, forward_sensors = get_small_cloud_gradient_call(
+            indices_for_jacobian=None, sparse_jacobian=True)
+        cls.loss, cls.gradient, jacobian = gradient_call()
+        cls.operator, cls.residual = gradient_call.linearize()
+        blocks = []
+        for key in gradient_call.solvers:
+            rte_sensor = gradient_call._rte_sensors[key]
+            nstokes = rte_sensor.sizes['nstokes']
+            values = jacobian['jacobian_{:1.3f}'.format(key)]
+            block = scipy.sparse.coo_matrix(
+                (values.data, (jacobian['row_{:1.3f}'.format(key)].data,
+                               jacobian['column_{:1.3f}'.format(key)].data)),
+                shape=values.attrs['shape']).tocsr()
+            #the rows are ordered by pixel then Stokes component.
+            weights = rte_sensor.uncertainties.data[:nstokes, :nstokes].sum(axis=1)
+            weights = np.sqrt(weights/forward_sensors.nmeasurements).T.ravel()
+            blocks.append(scipy.sparse.diags(weights) @ block)
+        cls.jacobian = scipy.sparse.vstack(blocks, format='csr')
+
+    def test_shape(self):
+        self.assertEqual(self.operator.shape, self.jacobian.shape)
+        self.assertEqual(self.residual.shape, (self.jacobian.shape[0],))
+
+    def test_loss(self):
+        self.assertAlmostEqual(0.5*np.sum(self.residual**2)/self.loss, 1.0, places=4)
+
+    def test_matvec(self):
+        vector = np.random.default_rng(1).normal(size=self.jacobian.shape[1])
+        reference = self.jacobian @ vector
+        self.assertTrue(np.allclose(self.operator.matvec(vector), reference,
+                                    rtol=1e-4, atol=1e-4*np.abs(reference).max()))
+
+    def test_rmatvec(self):
+        gradient = self.gradient.gradient.data.ravel()
+        for reference in (gradient, self.jacobian.T @ self.residual):
+            self.assertTrue(np.allclose(self.operator.rmatvec(self.residual), reference,
+                                        rtol=1e-4, atol=1e-4*np.abs(reference).max()))
+
+class SensorsDict_SortCache(SolvedSmallCloud):
+    wavelengths = (0.86, 1.38)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.sensors.get_measurements(cls.solvers, verbose=False)
+        cls.reference = [sensor.I.data.copy() for sensor in cls.sensors['MISR']['sensor_list']]
+
+    def test_cached(self):
+        rte_sensors, _ = self.sensors.sort_sensors(self.solvers)
+        self.assertIs(self.sensors.sort_sensors(self.solvers)[0], rte_sensors)
+
+    def test_invalidated(self):
+        sensors = copy.deepcopy(self.sensors)
+        rte_sensors, _ = sensors.sort_sensors(self.solvers)
+        sensor = sensors['MISR']['sensor_list'][0]
+        sensor['ray_weight'] = ('nrays', sensor.ray_weight.data.copy())
+        self.assertIsNot(sensors.sort_sensors(self.solvers)[0], rte_sensors)
+
+    def make_measurements(self):
+        """
+        A copy of the sensors with uncertainties attached (as in LevisApproxGradient)
+        for use as measurements.
+        """
+        measurements = copy.deepcopy(self.sensors)
+        uncertainty_model = pyshdom.uncertainties.NullUncertainty('L2')
+        for sensor in measurements['MISR']['sensor_list']:
+            uncertainty_model.calculate_uncertainties(sensor)
+        return measurements
+
+    def test_measurements_modified(self):
+        #add_noise modifies the measured radiances in place.
+        sensors = copy.deepcopy(self.sensors)
+        measurements = self.make_measurements()
+        rte_sensors, _ = sensors.sort_sensors(self.solvers, measurements)
+        measurements['MISR']['sensor_list'][0].I.data[:] *= 2.0
+        self.assertIsNot(sensors.sort_sensors(self.solvers, measurements)[0], rte_sensors)
+
+    def test_clear(self):
+        sensors = copy.deepcopy(self.sensors)
+        rte_sensors, _ = sensors.sort_sensors(self.solvers)
+        sensors['MISR']['sensor_list'][0].ray_x.data[:] += 0.01
+        sensors.clear_sort_cache()
+        self.assertIsNot(sensors.sort_sensors(self.solvers)[0], rte_sensors)
+
+    def test_alternating(self):
+        #rendering (without measurements) and the gradient (with measurements)
+        #each keep their own cached output.
+        sensors = copy.deepcopy(self.sensors)
+        measurements = self.make_measurements()
+        rte_sensors, _ = sensors.sort_sensors(self.solvers)
+        rte_measured, _ = sensors.sort_sensors(self.solvers, measurements)
+        self.assertIs(sensors.sort_sensors(self.solvers)[0], rte_sensors)
+        self.assertIs(sensors.sort_sensors(self.solvers, measurements)[0], rte_measured)
+
+    def test_split_rendering(self):
+        sensors = copy.deepcopy(self.sensors)
+        sensors.get_measurements(self.solvers, n_jobs=3, verbose=False)
+        for sensor, reference in zip(sensors['MISR']['sensor_list'], self.reference):
+            self.assertTrue(np.allclose(sensor.I.data, reference))
+
+class Gradient_MiniBatch(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        gradient_call, forward_sensors = get_small_cloud_gradient_call()
+        cls.full = tuple(gradient_call()) + (forward_sensors,)
+        #the pixels are labelled so that the sampled pixels can be matched to them.
+        rte_sensors, cls.sensor_mapping = forward_sensors.sort_sensors(
+            gradient_call.solvers, gradient_call.measurements)
+        cls.rte_sensors = OrderedDict([
+            (key, rte_sensor.assign(pixel_id=('npixels', np.arange(rte_sensor.sizes['npixels']))))
+            for key, rte_sensor in rte_sensors.items()])
+        cls.forward_sensors = forward_sensors
+        cls.full_batch = get_small_cloud_gradient(batch_kwargs={'fraction': 1.0, 'seed': 1})
+        cls.pixels = [get_small_cloud_gradient(batch_kwargs={'fraction': 0.3, 'seed': 1})
+                      for _ in range(2)]
+        cls.sensors = get_small_cloud_gradient(
+            batch_kwargs={'fraction': 0.5, 'sampling': 'sensors', 'seed': 1})
+
+    def test_full_batch(self):
+        self.assertAlmostEqual(self.full[0], self.full_batch[0])
+        self.assertTrue(np.allclose(self.full[1].gradient, self.full_batch[1].gradient))
+
+    def test_reproducible(self):
+        self.assertEqual(self.pixels[0][0], self.pixels[1][0])
+        self.assertTrue(np.array_equal(self.pixels[0][1].gradient, self.pixels[1][1].gradient))
+
+    def test_sampled(self):
+        for loss, gradient, _, _ in (self.pixels[0], self.sensors):
+            self.assertTrue(np.isfinite(loss))
+            self.assertTrue(np.all(np.isfinite(gradient.gradient)))
+
+    def test_unbiased(self):
+        #the sampled pixels are weighted by the ratio of the number of pixels (or sensors)
+        #to the number sampled.
+        for sampling in ('pixels', 'sensors'):
+            sampled_sensors = self.forward_sensors.sample_sensors(
+                self.rte_sensors, self.sensor_mapping, 0.3, sampling=sampling,
+                rng=np.random.default_rng(1))
+            for key, sampled in sampled_sensors.items():
+                full = self.rte_sensors[key]
+                if sampling == 'pixels':
+                    ratio = full.sizes['npixels']/sampled.sizes['npixels']
+                else:
+                    ratio = sampled.sizes['nimage']/np.count_nonzero(sampled.rays_per_image.data)
+                with self.subTest(sampling=sampling, key=key):
+                    self.assertGreater(ratio, 1.0)
+                    self.assertTrue(np.allclose(
+                        sampled.uncertainties.data,
+                        full.uncertainties.data[..., sampled.pixel_id.data]*ratio))
+
+    def test_forward_sensors(self):
+        #the forward sensors are not updated from a sample of the pixels so they
+        #still hold the measurements rather than the perturbed cloud's radiances.
+        self.assertFalse(all([np.allclose(full.I, batch.I) for full, batch in
+                              zip(self.full[3]['MISR']['sensor_list'],
+                                  self.pixels[0][3]['MISR']['sensor_list'])]))
+
+class Gradient_PrecomputedStokes(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.integrated = get_small_cloud_gradient()
+        cls.precomputed = get_small_cloud_gradient(precomputed_stokes=True)
+
+    def test_loss(self):
+        self.assertAlmostEqual(self.integrated[0], self.precomputed[0])
+
+    def test_gradient(self):
+        self.assertTrue(np.allclose(self.integrated[1].gradient, self.precomputed[1].gradient))
+
+    def test_jacobian(self):
+        self.assertTrue(all([np.allclose(self.integrated[2].data_vars[name],
+                                         self.precomputed[2].data_vars[name])
+                             for name in self.integrated[2].data_vars]))
+
+    def test_forward_sensors(self):
+        self.assertTrue(all([np.allclose(integrated.I, precomputed.I) for integrated, precomputed
+                             in zip(self.integrated[3]['MISR']['sensor_list'],
+                                    self.precomputed[3]['MISR']['sensor_list'])]))
+
+    def test_gradient_kwargs(self):
+        #the forward sensors are only valid at one state so this can't be set for every call.
+        sensors, solvers = get_small_cloud_problem(wavelengths=(0.86,))
+        with self.assertRaises(ValueError):
+            pyshdom.gradient.LevisApproxGradientUncorrelated(
+                sensors, solvers, sensors.make_forward_sensors(),
+                pyshdom.containers.UnknownScatterers(), parallel_solve_kwargs={},
+                gradient_kwargs={'cost_function': 'L2', 'precomputed_stokes': True},
+                uncertainty_kwargs={'add_noise': False})
+
+
+class Gradient_PrecomputedStokesSkipped(TestCase):
+    """
+    Without a Jacobian, the rays of the pixels with zero inverse error-covariance
+    are skipped when the Stokes vectors are precomputed.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.integrated = get_small_cloud_gradient(indices_for_jacobian=None,
+                                                  zero_uncertainties=True)
+        cls.precomputed = get_small_cloud_gradient(indices_for_jacobian=None,
+                                                   zero_uncertainties=True,
+                                                   precomputed_stokes=True)
+
+    def test_loss(self):
+        self.assertAlmostEqual(self.integrated[0], self.precomputed[0])
+
+    def test_gradient(self):
+        self.assertTrue(np.allclose(self.integrated[1].gradient, self.precomputed[1].gradient))
+
+    def test_forward_sensors(self):
+        #the skipped pixels still take their Stokes vectors from the forward sensors.
+        self.assertTrue(all([np.allclose(integrated.I, precomputed.I) for integrated, precomputed
+                             in zip(self.integrated[3]['MISR']['sensor_list'],
+                                    self.precomputed[3]['MISR']['sensor_list'])]))
+
+
+class ThreadedHarness:
+    """
+    Checks that the jobs from `make_jobs`, which call a Fortran routine that releases
+    the GIL (f2py threadsafe), give the same results when run concurrently on each of
+    `n_threads` threads as when run serially, and that they are faster on two threads
+    when the cores are available. Mixed into a TestCase for each routine.
+    """
+    n_threads = (2, 4)
+    #the jobs are repeated so that there is enough work to time.
+    repeats = 4
+
+    def make_jobs(self):
+        raise NotImplementedError
+
+    def run_jobs(self, n_threads):
+        jobs = self.make_jobs()*self.repeats
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            return list(executor.map(lambda job: job(), jobs))
+
+    def test_threaded_matches_serial(self):
+        serial = self.run_jobs(1)
+        for n_threads in self.n_threads:
+            with self.subTest(n_threads=n_threads):
+                threaded = self.run_jobs(n_threads)
+                for serial_result, threaded_result in zip(serial, threaded):
+                    self.assertTrue(np.array_equal(serial_result, threaded_result))
+
+    def test_threaded_speedup(self):
+        n_threads = 2
+        if (os.cpu_count() or 1) < n_threads:
+            self.skipTest('Speedup requires at least {} cores.'.format(n_threads))
+        start = time.time()
+        self.run_jobs(1)
+        serial_time = time.time() - start
+        start = time.time()
+        self.run_jobs(n_threads)
+        threaded_time = time.time() - start
+        self.assertLess(threaded_time, 0.8*serial_time)
+
+class Threaded_OpticalDepth(ThreadedHarness, SolvedSmallCloud):
+    def make_jobs(self):
+        return [lambda sensor=sensor: self.solver.optical_path(sensor.copy(deep=True)).optical_path.data
+                for sensor in self.sensors['MISR']['sensor_list']]
+
+class Threaded_MinOpticalDepth(ThreadedHarness, SolvedSmallCloud):
+    def make_jobs(self):
+        return [lambda sensor=sensor: self.solver.min_optical_path(
+            sensor.copy(deep=True)).min_optical_path.data
+                for sensor in self.sensors['MISR']['sensor_list']]
+
+class Threaded_SpaceCarve(ThreadedHarness, SolvedSmallCloud):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.carver = pyshdom.space_carve.SpaceCarver(cls.solver._grid)
+        cls.masked_sensors = []
+        for sensor in cls.sensors['MISR']['sensor_list']:
+            sensor = sensor.copy(deep=True)
+            sensor['cloud_mask'] = ('nrays', (sensor.ray_x.data > np.median(sensor.ray_x.data)).astype(int))
+            cls.masked_sensors.append(sensor)
+
+    def make_jobs(self):
+        return [lambda sensor=sensor: self.carver.carve(sensor).to_array().data
+                for sensor in self.masked_sensors]
+
+class Threaded_Project(ThreadedHarness, SolvedSmallCloud):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.carver = pyshdom.space_carve.SpaceCarver(cls.solver._grid)
+        cls.weights = cls.solver.medium['cloud'][['extinction']].rename(extinction='density')
+
+    def project(self, sensor):
+        sensor = sensor.copy(deep=True)
+        self.carver.project(self.weights, sensor)
+        return sensor.integrated_weights.data
+
+    def make_jobs(self):
+        return [lambda sensor=sensor: self.project(sensor)
+                for sensor in self.sensors['MISR']['sensor_list']]
+
+class Threaded_AverageSubpixelRays(ThreadedHarness, SolvedSmallCloud):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rng = np.random.default_rng(1)
+        cls.weighted_stokes = [
+            np.asfortranarray(rng.random((1, sensor.sizes['nrays'])), dtype=np.float32)
+            for sensor in cls.sensors['MISR']['sensor_list']]
+
+    def make_jobs(self):
+        return [lambda sensor=sensor, weighted_stokes=weighted_stokes:
+                pyshdom.core.average_subpixel_rays(
+                    pixel_index=sensor.pixel_index.data, nstokes=1,
+                    weighted_stokes=weighted_stokes, nrays=sensor.sizes['nrays'],
+                    npixels=sensor.sizes['npixels'])
+                for sensor, weighted_stokes in zip(self.sensors['MISR']['sensor_list'],
+                                                   self.weighted_stokes)]
+
+class Threaded_LevisApproxGradient(ThreadedHarness, TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.gradient_call, _ = get_small_cloud_gradient_call(indices_for_jacobian=None)
+        #prepares the solutions, derivatives and sorted sensors.
+        cls.gradient_call()
+
+    def make_jobs(self):
+        return [lambda key=key: self.gradient_call.levis_approximation_grad(
+            self.gradient_call.solvers[key], self.gradient_call._rte_sensors[key])[0]
+                for key in self.gradient_call.solvers]
+
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+@skipIf(MPI is None, 'mpi4py is not installed.')
+class Parallelization_MPIGradient(TestCase):
+    """
+    Compares the MPI parallelization of the gradient with the serial evaluation.
+    Can be run with any number of ranks (e.g. `mpirun -n 2 python -m pytest test_shdom.py`).
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.serial = get_small_cloud_gradient()
+        cls.mpi = get_small_cloud_gradient(mpi_comm=MPI.COMM_WORLD, n_jobs=2)
+
+    def test_loss(self):
+        self.assertAlmostEqual(self.serial[0], self.mpi[0])
+
+    def test_gradient(self):
+        self.assertTrue(np.allclose(self.serial[1].gradient, self.mpi[1].gradient))
+
+    def test_jacobian(self):
+        self.assertTrue(all([np.allclose(self.serial[2].data_vars[name], self.mpi[2].data_vars[name])
+                             for name in self.serial[2].data_vars]))
+
+    def test_forward_sensors(self):
+        self.assertTrue(all([np.allclose(serial.I, mpi.I) for serial, mpi in
+                             zip(self.serial[3]['MISR']['sensor_list'],
+                                 self.mpi[3]['MISR']['sensor_list'])]))
+
+
 class Verify_Lambertian_Surfaces(TestCase):
     @classmethod
     def setUpClass(cls):